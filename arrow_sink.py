@@ -0,0 +1,215 @@
+import os
+import time
+
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet
+
+import batch
+import retry
+import telemetry
+import utils
+
+FILE_NAMES = {
+    "parquet": "block.parquet",
+    "arrow": "block.arrow",
+}
+# the types of the ClickHouse Arrow output (with its default settings) of the columns that are not parameterized
+ARROW_TYPES = {
+    "UInt8": pa.uint8(), "UInt16": pa.uint16(), "UInt32": pa.uint32(), "UInt64": pa.uint64(),
+    "Int8": pa.int8(), "Int16": pa.int16(), "Int32": pa.int32(), "Int64": pa.int64(),
+    "Float32": pa.float32(), "Float64": pa.float64(),
+    "String": pa.string(), "Date": pa.uint16(), "Date32": pa.date32(), "DateTime": pa.uint32(),
+}
+
+
+def get_part_file_name(a_output_format, a_part):
+    # neither format can be appended to, so every incremental dump of a block adds a part file: block.00001.parquet...
+    if a_part == 0:
+        return FILE_NAMES[a_output_format]
+    base_name, extension = os.path.splitext(FILE_NAMES[a_output_format])
+    return "{}.{:05d}{}".format(base_name, a_part, extension)
+
+
+def get_arrow_type(a_clickhouse_type):
+    # only used for the schema of a block without rows, pa.null() for the types it does not know
+    for wrapper in ["Nullable(", "LowCardinality("]:
+        if a_clickhouse_type.startswith(wrapper):
+            return get_arrow_type(a_clickhouse_type[len(wrapper):-1])
+    if a_clickhouse_type.startswith("Array("):
+        return pa.list_(get_arrow_type(a_clickhouse_type[len("Array("):-1]))
+    return ARROW_TYPES.get(a_clickhouse_type, pa.null())
+
+
+def get_empty_schema(a_client, args):
+    table_schema = retry.call_with_retry(args, "table schema", lambda: utils.get_table_schema(
+        a_client, args.database, args.table))
+    return pa.schema([pa.field(stream_name, get_arrow_type(table_schema[column]))
+                      for stream_name, column in zip(batch.get_stream_names(args.columns),
+                                                     batch.get_selected_columns(args.columns))])
+
+
+def get_part_file_paths(a_output_format, a_directory):
+    file_paths = []
+    while os.path.isfile(os.path.join(a_directory, get_part_file_name(a_output_format, len(file_paths)))):
+        file_paths.append(os.path.join(a_directory, get_part_file_name(a_output_format, len(file_paths))))
+    return file_paths
+
+
+class ArrowFileWriter:
+    def __init__(self, a_output_format, a_directory, a_part=0):
+        self.output_format = a_output_format
+        self.file_path = os.path.join(a_directory, get_part_file_name(a_output_format, a_part))
+        self.writer = None
+
+    def open(self, a_schema):
+        if self.output_format == "parquet":
+            self.writer = pyarrow.parquet.ParquetWriter(self.file_path, a_schema, compression="zstd")
+        else:
+            self.writer = pyarrow.ipc.new_file(self.file_path, a_schema,
+                                               options=pyarrow.ipc.IpcWriteOptions(compression="zstd"))
+
+    def write(self, a_table):
+        # the schema is only known once the first batch arrives
+        if self.writer is None:
+            self.open(a_table.schema)
+        self.writer.write_table(a_table)
+
+    def close(self, a_empty_schema=None):
+        # a_empty_schema: written to a file without rows if nothing was, so that a block without rows is still a block
+        if self.writer is None and a_empty_schema is not None:
+            self.open(a_empty_schema)
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def deduplicate(a_table, a_prev_event_time):
+    mask = batch.deduplication_mask(a_table.column(0).to_numpy(), a_prev_event_time)
+    if mask.all():
+        return a_table
+    return a_table.filter(pa.array(mask))
+
+
+def read_table(a_output_format, a_directory):
+    tables = []
+    for file_path in get_part_file_paths(a_output_format, a_directory):
+        if a_output_format == "parquet":
+            tables.append(pyarrow.parquet.read_table(file_path, memory_map=True))
+        else:
+            # the record batches stay views over the mapped file instead of being copied into memory
+            tables.append(pyarrow.ipc.open_file(pa.memory_map(file_path)).read_all())
+    # the schema of a part without rows is only a guess from the table schema (see get_arrow_type)
+    tables_with_rows = [table for table in tables if table.num_rows > 0]
+    if len(tables_with_rows) == 0:
+        return tables[0]
+    return pa.concat_tables(tables_with_rows)
+
+
+def compare_outputs(a_output_format, a_expected_directory, a_directory):
+    # the row groups / record batches follow the stream blocks, so the tables are compared instead of the files
+    expected_table = read_table(a_output_format, a_expected_directory)
+    table = read_table(a_output_format, a_directory)
+    if expected_table.schema != table.schema:
+        return "schemas differ: {} and {}".format(expected_table.schema, table.schema)
+    if expected_table.num_rows != table.num_rows:
+        return "{} rows instead of {}".format(table.num_rows, expected_table.num_rows)
+    for column_name in expected_table.column_names:
+        if not expected_table.column(column_name).equals(table.column(column_name)):
+            return "column {} differs".format(column_name)
+    return None
+
+
+def dump_block_arrow(
+        a_client,
+        args,
+        a_instrument,
+        a_instrument_date,
+        a_block_info,
+        a_directory,
+        a_block_stats,
+        a_last_event_time=0,
+        a_append=False
+):
+    utils.quiet_print(args.quiet, "Streaming block to {} file (block size: {} rows):".format(args.output_format,
+                                                                                       args.intended_batch_size))
+    utils.quiet_print(args.quiet, "------------------------------------")
+
+    part = len(get_part_file_paths(args.output_format, a_directory)) if a_append else 0
+    arrow_file_writer = ArrowFileWriter(args.output_format, a_directory, part)
+    stream_names = batch.get_stream_names(args.columns)
+
+    last_event_time = a_last_event_time
+    # an appended block only streams the rows after the output, see utils.dump_block_streaming
+    event_time_min = max(a_last_event_time + 1, a_block_info.min_event_time) if a_append else 0
+
+    # see utils.dump_block_streaming on why reopening the stream from last_event_time is safe
+    retrier = retry.Retrier(args, "stream of {} {}".format(a_instrument, a_instrument_date))
+    while True:
+        retrier.before_attempt()
+        try:
+            fetch_start_time = time.time()
+            with utils.get_block_arrow_stream(
+                    a_client,
+                    args.database,
+                    args.table,
+                    args.is_snapshot,
+                    a_instrument,
+                    a_instrument_date,
+                    max(last_event_time, event_time_min),
+                    args.intended_batch_size,
+                    args.columns,
+                    args.pushdown,
+                    args.order_column
+            ) as stream:
+                # the driver reads the result with pyarrow.ipc.open_stream, one RecordBatch per server block
+                for record_batch in stream:
+                    if record_batch.num_rows == 0:
+                        continue
+                    retrier.on_success()
+                    batch_stats = telemetry.BatchStats(a_block_stats.count_batches)
+                    batch_stats.fetch_time = time.time() - fetch_start_time
+                    format_start_time = time.time()
+
+                    # the file writers only take tables
+                    table = pa.Table.from_batches([record_batch]).rename_columns(stream_names)
+                    deduplicated_table = deduplicate(table, last_event_time)
+                    write_start_time = time.time()
+                    # the arrow writers encode and compress inside write_table, so that time is counted as write;
+                    # the file (a new part when appending) is only created with its first row
+                    if deduplicated_table.num_rows > 0:
+                        arrow_file_writer.write(deduplicated_table)
+                    last_event_time = table.column(0)[-1].as_py()
+
+                    batch_stats.rows_in = table.num_rows
+                    batch_stats.rows_written = deduplicated_table.num_rows
+                    batch_stats.format_time = write_start_time - format_start_time
+                    batch_stats.write_time = time.time() - write_start_time
+                    a_block_stats.add_batch(batch_stats)
+                    telemetry.emit(args.telemetry_path, batch_stats.to_record(a_block_stats))
+
+                    utils.quiet_print(args.quiet,
+                                "\tStream block {0}: fetch: {1:0.3f} s, processing: {2:0.3f} s (got: {3} rows, "
+                                "wrote: {4} rows, progress: {5}/{6})".format(a_block_stats.count_batches,
+                                                                             batch_stats.fetch_time,
+                                                                             batch_stats.format_time +
+                                                                             batch_stats.write_time,
+                                                                             table.num_rows,
+                                                                             deduplicated_table.num_rows,
+                                                                             a_block_stats.rows_in,
+                                                                             a_block_info.count_rows))
+                    fetch_start_time = time.time()
+        except Exception as e:
+            retrier.on_failure(e)
+            utils.quiet_print(args.quiet, "Reopening stream from eventTime {}...".format(last_event_time))
+            continue
+        break
+
+    # a whole block without rows (after the whitelist or deduplication) still gets its file, appends add none
+    arrow_file_writer.close(get_empty_schema(a_client, args) if arrow_file_writer.writer is None and not a_append
+                            else None)
+
+    utils.quiet_print(args.quiet, "------------------------------------")
+    utils.quiet_print(args.quiet, "Streamed {} blocks (wrote: {} rows)".format(a_block_stats.count_batches,
+                                                                             a_block_stats.rows_written))
+    return last_event_time
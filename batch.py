@@ -0,0 +1,237 @@
+import itertools
+import threading
+
+import numpy as np
+
+# Every query selects TIME_COLUMN followed by the dumped columns (--columns), and every selected column goes to its
+# own output stream. Rows are ordered by TIME_COLUMN, then by the order column of the table if it has one
+# (--order_column), and deduplicated by TIME_COLUMN: the row kept for an eventTime is then the one with the smallest
+# order column, whether the server or the client sorts.
+TIME_COLUMN = "eventTime"
+DEFAULT_ORDER_COLUMN = "lastUpdateId"
+DEFAULT_COLUMNS = ["asks.price", "asks.quantity", "bids.price", "bids.quantity"]
+STREAM_NAMES = {
+    "eventTime": "event_times",
+    "asks.price": "asks_prices",
+    "asks.quantity": "asks_quantities",
+    "bids.price": "bids_prices",
+    "bids.quantity": "bids_quantities",
+}
+
+
+def get_selected_columns(a_columns, a_order_column=None):
+    # a_order_column comes last, only to sort by, when the client sorts
+    return [TIME_COLUMN] + list(a_columns) + ([a_order_column] if a_order_column is not None else [])
+
+
+def get_stream_names(a_columns):
+    # one stream per selected column, columns of other tables are named after the column itself
+    return [STREAM_NAMES.get(column, column.replace(".", "_")) for column in get_selected_columns(a_columns)]
+
+
+def deduplication_mask(a_event_times, a_prev_event_time):
+    # a row is written only if its eventTime differs from the eventTime of the row before it
+    prev_event_times = np.empty_like(a_event_times)
+    if len(a_event_times) > 0:
+        prev_event_times[0] = a_prev_event_time
+        prev_event_times[1:] = a_event_times[:-1]
+    return a_event_times != prev_event_times
+
+
+# Text is written as bytes. A book repeats the same few thousand prices and quantities all day, so float columns are
+# not formatted value by value: every distinct value of a batch gets its str() once, most of them from a cache kept
+# across batches, and the lines are assembled in one join from those tokens. Values are told apart by their bits, so
+# -0.0 and 0.0 keep their own text, and the output is byte for byte the str() of every value.
+FORMAT_CACHE_SIZE = 1 << 16  # tokens kept per thread between batches
+
+format_cache_state = threading.local()
+
+
+class FormatCache:
+    def __init__(self, a_max_size):
+        self.max_size = a_max_size
+        self.tokens = {}  # float64 bits -> str() of the value, as bytes
+
+    def get_tokens(self, a_bits):
+        # a_bits: distinct float64 bit patterns, as uint64
+        keys = a_bits.tolist()
+        tokens = self.tokens
+        missing_keys = [key for key in keys if key not in tokens]
+        if len(missing_keys) > 0:
+            for key, token in zip(missing_keys, map(str, np.array(missing_keys, dtype=np.uint64)
+                                                     .view(np.float64).tolist())):
+                tokens[key] = token.encode()
+        result = [tokens[key] for key in keys]
+        if len(tokens) > self.max_size:
+            # evicts everything the current batch did not use
+            self.tokens = dict(zip(keys, result)) if len(keys) <= self.max_size else {}
+        return result
+
+
+def get_format_cache():
+    # one per thread, the transform stages of several blocks may run in the same process
+    if not hasattr(format_cache_state, "cache"):
+        format_cache_state.cache = FormatCache(FORMAT_CACHE_SIZE)
+    return format_cache_state.cache
+
+
+def format_float_lines(a_values, a_offsets):
+    # the lines of a float64 column, the values of a row separated by spaces; row i is a_values[a_offsets[i]:
+    # a_offsets[i + 1]], a_offsets None for one value per row
+    unique_bits, inverse = np.unique(np.ascontiguousarray(a_values).view(np.uint64), return_inverse=True)
+    tokens = get_format_cache().get_tokens(unique_bits)
+    inverse = inverse.reshape(-1)
+    # every value is followed by a space, or by a newline if it ends its row
+    ended_tokens = np.array([token + b"\n" for token in tokens], dtype=object)
+    if a_offsets is None:
+        return b"".join(ended_tokens[inverse].tolist())
+
+    lengths = np.diff(a_offsets)
+    is_empty = lengths == 0
+    # an empty row is a lone newline, between the values of the rows around it
+    empty_rows_before = np.cumsum(is_empty) - is_empty
+    pieces = np.empty(len(a_values) + int(is_empty.sum()), dtype=object)
+    value_positions = np.arange(len(a_values)) + np.repeat(empty_rows_before, lengths)
+    pieces[value_positions] = np.array([token + b" " for token in tokens], dtype=object)[inverse]
+    last_values = a_offsets[1:][~is_empty] - 1
+    pieces[value_positions[last_values]] = ended_tokens[inverse[last_values]]
+    pieces[a_offsets[:-1][is_empty] + empty_rows_before[is_empty]] = b"\n"
+    return b"".join(pieces.tolist())
+
+
+def format_values(a_values):
+    if a_values.dtype == np.float64:
+        return format_float_lines(a_values, None)
+    return ("\n".join(map(str, a_values.tolist())) + "\n").encode()
+
+
+class ScalarColumn:
+    def __init__(self, a_values):
+        self.values = a_values
+
+    def __len__(self):
+        return len(self.values)
+
+    def take(self, a_indices):
+        return ScalarColumn(self.values[a_indices])
+
+    def format_lines(self):
+        return format_values(self.values)
+
+
+class RaggedColumn:
+    # An array column stored as one flat array of values plus row offsets: row i is values[offsets[i]:offsets[i + 1]]
+    def __init__(self, a_values, a_offsets):
+        self.values = a_values
+        self.offsets = a_offsets
+
+    @staticmethod
+    def from_lists(a_lists):
+        lengths = np.fromiter(map(len, a_lists), dtype=np.int64, count=len(a_lists))
+        offsets = np.zeros(len(a_lists) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.array(list(itertools.chain.from_iterable(a_lists)))
+        if len(values) == 0:
+            values = values.astype(np.float64)
+        return RaggedColumn(values, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def take(self, a_indices):
+        lengths = self.lengths()[a_indices]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # position of every value of the selected rows in self.values
+        value_indices = np.repeat(self.offsets[:-1][a_indices] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return RaggedColumn(self.values[value_indices], offsets)
+
+    def format_lines(self):
+        if self.values.dtype == np.float64:
+            return format_float_lines(self.values, self.offsets)
+        # format the whole column in one pass, then cut it into space-separated lines
+        tokens = list(map(str, self.values.tolist()))
+        offsets = self.offsets.tolist()
+        lines = [" ".join(tokens[offsets[i]:offsets[i + 1]]) for i in range(len(offsets) - 1)]
+        lines.append("")
+        return "\n".join(lines).encode()
+
+
+def concatenate_columns(a_columns):
+    # columns of the same kind, e.g. the pieces of one stream
+    if len(a_columns) == 1:
+        return a_columns[0]
+    if isinstance(a_columns[0], RaggedColumn):
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for column in a_columns:
+            offsets.append(column.offsets[1:] - column.offsets[0] + offsets[-1][-1])
+        values = [column.values[column.offsets[0]:column.offsets[-1]] for column in a_columns]
+        return RaggedColumn(np.concatenate(values), np.concatenate(offsets))
+    return ScalarColumn(np.concatenate([column.values for column in a_columns]))
+
+
+class Batch:
+    def __init__(self, a_event_times, a_columns):
+        self.event_times = a_event_times
+        # a ScalarColumn or a RaggedColumn per dumped column, in --columns order
+        self.columns = a_columns
+
+    @staticmethod
+    def from_columns(a_columns, a_are_arrays):
+        # a_columns: the column oriented result of a query selecting get_selected_columns() (query.result_columns or a
+        # column block of a stream), a_are_arrays: whether each of the dumped columns is an Array (see
+        # utils.get_column_layout). A trailing order column is left out of the batch.
+        return Batch(np.asarray(a_columns[0]),
+                     [RaggedColumn.from_lists(column) if is_array else ScalarColumn(np.asarray(column))
+                      for column, is_array in zip(a_columns[1:], a_are_arrays)])
+
+    def __len__(self):
+        return len(self.event_times)
+
+    def __str__(self):
+        return "\trows: {}\n" \
+               "\tmin_event_time: {}\n" \
+               "\tmax_event_time: {}" \
+            .format(len(self),
+                    self.event_times.min() if len(self) > 0 else None,
+                    self.event_times.max() if len(self) > 0 else None)
+
+    def take(self, a_indices):
+        return Batch(self.event_times[a_indices], [column.take(a_indices) for column in self.columns])
+
+    def sorted(self, a_order_keys=None):
+        # a_order_keys: the order column of every row, which orders rows with equal eventTime; without it the sort is
+        # stable, so they keep the order in which the server returned them
+        if a_order_keys is None:
+            return self.take(np.argsort(self.event_times, kind='stable'))
+        return self.take(np.lexsort((a_order_keys, self.event_times)))
+
+    def deduplicated(self, a_prev_event_time):
+        mask = deduplication_mask(self.event_times, a_prev_event_time)
+        # the common case when the server already deduplicated the rows (--pushdown)
+        if mask.all():
+            return self
+        return self.take(np.flatnonzero(mask))
+
+    def last_event_time(self, a_default):
+        if len(self) == 0:
+            return a_default
+        return self.event_times[-1].item()
+
+    def get_stream_columns(self):
+        # the column of every output stream, in get_stream_names order
+        return [ScalarColumn(self.event_times)] + self.columns
+
+    def format_streams(self):
+        # the text of every output stream, in get_stream_names order, as bytes
+        if len(self) == 0:
+            return [b""] * (len(self.columns) + 1)
+        return [format_values(self.event_times)] + [column.format_lines() for column in self.columns]
+
+
+def write_streams(a_buffered_file_writer_set, a_event_times, a_streams):
+    # the set cuts all streams into chunks at the same rows, so it needs their eventTimes
+    a_buffered_file_writer_set.write(a_event_times, a_streams)
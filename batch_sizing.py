@@ -0,0 +1,135 @@
+import os
+
+# Sources of the eventTime windows fetched by utils.fetch_interval_batches. A source hands out one window at a time and
+# is told what fetching it cost, or that it came back truncated at the row limit, in which case the same eventTime
+# range is handed out again in smaller windows: rows are never dropped.
+
+ADAPTIVE_TARGET_FETCH_TIME = 1.0  # seconds per batch: long enough to amortize the round trip, short enough to pipeline
+ADAPTIVE_MAX_GROWTH = 2.0  # per batch, so one quiet window does not make the next one swallow a burst
+ADAPTIVE_MEMORY_FRACTION = 0.01  # of the available memory, per batch, counted in received bytes
+ADAPTIVE_SMOOTHING = 0.3  # weight of the last batch in the per-row cost estimates
+MEMINFO_PATH = "/proc/meminfo"
+
+
+def get_available_memory():
+    # MemAvailable counts the page cache that can be reclaimed, which fills the free pages of a dump host quickly
+    try:
+        with open(MEMINFO_PATH) as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    # no /proc/meminfo (or a kernel without MemAvailable): only the free pages are known
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def split_interval(a_interval):
+    middle = (a_interval[0] + a_interval[1]) // 2
+    expected_rows = a_interval[2] // 2 if len(a_interval) > 2 and a_interval[2] is not None else None
+    return [[a_interval[0], middle, expected_rows], [middle + 1, a_interval[1], expected_rows]]
+
+
+def clip_intervals(a_intervals, a_event_time_min):
+    # the intervals cut at a_event_time_min, those entirely before it dropped
+    if a_event_time_min is None:
+        return a_intervals
+    return [[max(interval[0], a_event_time_min)] + interval[1:] for interval in a_intervals
+            if interval[1] >= a_event_time_min]
+
+
+class PlannedIntervals:
+    # the intervals of a batch planner, fetched in order, from a_event_time_min on if given
+    def __init__(self, a_intervals, a_event_time_min=None):
+        intervals = clip_intervals(a_intervals, a_event_time_min)
+        self.intervals = list(reversed(intervals))  # a stack, the next interval last
+        self.count_batches = len(intervals)
+
+    def done(self):
+        return len(self.intervals) == 0
+
+    def next_interval(self):
+        return self.intervals[-1]
+
+    def on_batch(self, a_interval, a_count_rows, a_bytes_received, a_fetch_time):
+        self.intervals.pop()
+
+    def on_overflow(self, a_interval):
+        if a_interval[0] >= a_interval[1]:
+            raise RuntimeError("More than the row limit in the single eventTime {}".format(a_interval[0]))
+        self.intervals.pop()
+        self.intervals.extend(reversed(split_interval(a_interval)))
+        self.count_batches += 1
+
+
+class AdaptiveIntervals:
+    # Cuts the block into windows on the fly: every window is sized from the row density of the previous one and the
+    # measured cost of a row (fetch time and received bytes), so that a batch takes about ADAPTIVE_TARGET_FETCH_TIME
+    # and holds no more than ADAPTIVE_MEMORY_FRACTION of the available memory and half of the row limit.
+    def __init__(self, a_block_info, a_initial_batch_size, a_max_rows, a_event_time_min=None):
+        self.next_event_time = a_block_info.min_event_time
+        if a_event_time_min is not None:
+            self.next_event_time = max(self.next_event_time, a_event_time_min)
+        self.max_event_time = a_block_info.max_event_time
+        self.max_rows = a_max_rows // 2
+        self.count_batches = None  # not known in advance
+        self.seconds_per_row = None
+        self.bytes_per_row = None
+
+        if a_block_info.count_rows == 0 or self.next_event_time > self.max_event_time:
+            self.next_event_time = self.max_event_time + 1
+
+        # the first window assumes the average density of the block
+        self.rows_per_event_time = a_block_info.count_rows / (self.max_event_time - self.next_event_time + 1) \
+            if not self.done() else 0.0
+        self.intended_rows = min(a_initial_batch_size, self.max_rows)
+        self.window = self.get_window(self.intended_rows)
+
+    def get_window(self, a_rows):
+        if self.rows_per_event_time <= 0:
+            return self.max_event_time - self.next_event_time + 1
+        return max(1, int(a_rows / self.rows_per_event_time))
+
+    def done(self):
+        return self.next_event_time > self.max_event_time
+
+    def next_interval(self):
+        interval_max = min(self.next_event_time + self.window - 1, self.max_event_time)
+        return [self.next_event_time, interval_max,
+                int(self.rows_per_event_time * (interval_max - self.next_event_time + 1))]
+
+    def on_overflow(self, a_interval):
+        if a_interval[0] >= a_interval[1]:
+            raise RuntimeError("More than the row limit in the single eventTime {}".format(a_interval[0]))
+        self.window = max(1, (a_interval[1] - a_interval[0] + 1) // 2)
+
+    def on_batch(self, a_interval, a_count_rows, a_bytes_received, a_fetch_time):
+        self.next_event_time = a_interval[1] + 1
+        window = a_interval[1] - a_interval[0] + 1
+        if a_count_rows == 0:
+            # nothing there, grow as fast as allowed
+            self.window = int(window * ADAPTIVE_MAX_GROWTH)
+            return
+
+        self.rows_per_event_time = a_count_rows / window
+        self.seconds_per_row = self.smooth(self.seconds_per_row, a_fetch_time / a_count_rows)
+        if a_bytes_received is not None:
+            self.bytes_per_row = self.smooth(self.bytes_per_row, a_bytes_received / a_count_rows)
+
+        intended_rows = self.max_rows
+        if self.seconds_per_row > 0:
+            intended_rows = min(intended_rows, ADAPTIVE_TARGET_FETCH_TIME / self.seconds_per_row)
+        available_memory = get_available_memory()
+        if self.bytes_per_row is not None and self.bytes_per_row > 0 and available_memory is not None:
+            intended_rows = min(intended_rows, available_memory * ADAPTIVE_MEMORY_FRACTION / self.bytes_per_row)
+        self.intended_rows = max(1, int(min(intended_rows, a_count_rows * ADAPTIVE_MAX_GROWTH)))
+        self.window = self.get_window(self.intended_rows)
+
+    @staticmethod
+    def smooth(a_estimate, a_value):
+        if a_estimate is None:
+            return a_value
+        return (1 - ADAPTIVE_SMOOTHING) * a_estimate + ADAPTIVE_SMOOTHING * a_value
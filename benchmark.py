@@ -0,0 +1,271 @@
+import os
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import batch
+import compression
+import fake_clickhouse
+import loader
+import manifest
+import utils
+
+##############################################
+# CONFIG
+SYMBOLS = ["BTCUSDT"]
+DATES = ["2023-01-01"]
+ROWS_PER_DAY = 200000
+BOOK_DEPTH = 20
+IS_SNAPSHOT = 1
+
+INTENDED_BATCH_SIZE = 20000
+CODEC = "gzip"
+COMPRESSION_LEVEL = 9
+MEASURE_MEMORY = 1  # second pass with tracemalloc to get the peak allocation of every stage
+
+# full process_block runs, one line of the report each
+END_TO_END_ARGUMENTS = [
+    [],
+    ["--pipelined"],
+    ["--streaming"],
+    ["--streaming", "--pipelined"],
+    ["--pushdown"],
+    ["--pushdown", "--verify_pushdown"],
+    ["--batch_planner", "adaptive"],
+    ["--streaming", "--pipelined", "--pushdown"],
+]
+# incremental dumps of a day cut in half, then of the whole day, checked against a full dump, one line each
+INCREMENTAL_ARGUMENTS = [
+    [],
+    ["--streaming"],
+    ["--batch_planner", "adaptive"],
+    ["--output_format", "delta"],
+    ["--output_format", "delta", "--streaming"],
+]
+##############################################
+
+STAGES = ["get_batch", "build batch", "sort", "dedup + format", "compress"]
+
+
+class StageStats:
+    def __init__(self):
+        self.time = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.peak_alloc = 0
+
+    def add(self, a_time, a_rows, a_bytes):
+        self.time += a_time
+        self.rows += a_rows
+        self.bytes += a_bytes
+
+
+def get_peak_rss():
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_stages(a_client, a_codec, a_stages_stats, a_measure_memory):
+    def measure(a_stage, a_function):
+        if a_measure_memory:
+            tracemalloc.reset_peak()
+            result = a_function()
+            a_stages_stats[a_stage].peak_alloc = max(a_stages_stats[a_stage].peak_alloc,
+                                                     tracemalloc.get_traced_memory()[1])
+            return result, 0.0
+        start_time = time.perf_counter()
+        result = a_function()
+        return result, time.perf_counter() - start_time
+
+    column_layout = utils.get_column_layout(a_client, a_client.database, a_client.table, batch.DEFAULT_COLUMNS)
+    for block in utils.get_blocks_plan(a_client, a_client.database, a_client.table, IS_SNAPSHOT, [".*"], [".*"]):
+        intervals = utils.get_balanced_intervals(a_client, a_client.database, a_client.table, IS_SNAPSHOT, block[0],
+                                                 block[1], block[2], INTENDED_BATCH_SIZE)
+        last_event_time = 0
+        for interval in intervals:
+            batch_query, elapsed = measure("get_batch", lambda: utils.get_batch(
+                a_client, a_client.database, a_client.table, IS_SNAPSHOT, block[0], block[1], interval[0],
+                interval[1], batch.DEFAULT_COLUMNS, a_order_column=batch.DEFAULT_ORDER_COLUMN))
+            batch_bytes = int(batch_query.summary["result_bytes"])
+            count_rows = len(batch_query.result_columns[0])
+            a_stages_stats["get_batch"].add(elapsed, count_rows, batch_bytes)
+
+            rows, elapsed = measure("build batch",
+                                    lambda: batch.Batch.from_columns(batch_query.result_columns, column_layout))
+            a_stages_stats["build batch"].add(elapsed, count_rows, batch_bytes)
+
+            rows, elapsed = measure("sort", lambda: rows.sorted(np.asarray(batch_query.result_columns[-1])))
+            a_stages_stats["sort"].add(elapsed, count_rows, batch_bytes)
+
+            streams, elapsed = measure("dedup + format",
+                                       lambda: rows.deduplicated(last_event_time).format_streams())
+            last_event_time = rows.last_event_time(last_event_time)
+            text_bytes = sum(map(len, streams))
+            a_stages_stats["dedup + format"].add(elapsed, count_rows, text_bytes)
+
+            _, elapsed = measure("compress", lambda: [a_codec.compress(stream) for stream in streams])
+            a_stages_stats["compress"].add(elapsed, count_rows, text_bytes)
+
+
+def get_args(a_client, a_root_folder_path, a_arguments):
+    return utils.get_args_parser().parse_args([
+        "--root_folder_path", a_root_folder_path,
+        "--intended_batch_size", str(INTENDED_BATCH_SIZE),
+        "--database", a_client.database,
+        "--table", a_client.table,
+        "--is_snapshot", str(IS_SNAPSHOT),
+        "--codec", CODEC,
+        "--compression_level", str(COMPRESSION_LEVEL),
+        "--quiet",
+    ] + a_arguments)
+
+
+def run_end_to_end(a_client, a_arguments):
+    root_folder_path = tempfile.mkdtemp(prefix="clickhouse_dumper_benchmark_")
+    args = get_args(a_client, root_folder_path, a_arguments)
+    count_rows = 0
+    start_time = time.perf_counter()
+    try:
+        for block in utils.get_blocks_plan(a_client, args.database, args.table, args.is_snapshot, [".*"], [".*"]):
+            utils.process_block(a_client, args, block[0], block[1], block[2])
+            count_rows += block[2].count_rows
+    finally:
+        shutil.rmtree(root_folder_path, ignore_errors=True)
+    return [count_rows, time.perf_counter() - start_time]
+
+
+def compare_blocks(args, a_expected_directory, a_directory):
+    # the first difference between two dumps of the same block, None if they hold the same rows
+    expected_manifest = manifest.read_manifest(a_expected_directory)
+    actual_manifest = manifest.read_manifest(a_directory)
+    for key in ["rows_written", "last_event_time"]:
+        if expected_manifest[key] != actual_manifest[key]:
+            return "{} is {} instead of {}".format(key, actual_manifest[key], expected_manifest[key])
+    if args.output_format != "delta":
+        if args.output_format in utils.STREAM_OUTPUT_FORMATS:
+            return utils.compare_text_outputs(args, a_expected_directory, a_directory)
+        import arrow_sink
+
+        return arrow_sink.compare_outputs(args.output_format, a_expected_directory, a_directory)
+
+    # appending cuts the delta chunks elsewhere than a full dump does, so the decoded rows are compared
+    expected_data = loader.load_block(a_expected_directory)
+    actual_data = loader.load_block(a_directory)
+    if not np.array_equal(expected_data.event_times, actual_data.event_times):
+        return "event times differ"
+    for stream_name, expected_column in expected_data.columns.items():
+        actual_column = actual_data.columns[stream_name]
+        if not np.array_equal(expected_column.values.view(np.uint64), actual_column.values.view(np.uint64)) or \
+                not np.array_equal(getattr(expected_column, "offsets", None), getattr(actual_column, "offsets", None)):
+            return "stream {} differs".format(stream_name)
+    return None
+
+
+def run_incremental_check(a_client, a_arguments):
+    # Every block is dumped with only the first half of its day in the table, appended to without new rows, once
+    # normally and once after an append that was interrupted, then appended to with the rest of the day. The result
+    # must hold exactly the rows of a full dump. Returns the first difference, None if there is none.
+    root_folder_path = tempfile.mkdtemp(prefix="clickhouse_dumper_benchmark_")
+    incremental_folder_path = os.path.join(root_folder_path, "incremental")
+    full_folder_path = os.path.join(root_folder_path, "full")
+    incremental_args = get_args(a_client, incremental_folder_path, a_arguments + ["--incremental"])
+    full_args = get_args(a_client, full_folder_path, a_arguments)
+    try:
+        for block in utils.get_blocks_plan(a_client, full_args.database, full_args.table, full_args.is_snapshot,
+                                           [".*"], [".*"]):
+            block_folder_path = manifest.get_block_folder(incremental_folder_path, block[0], block[1])
+            a_client.event_time_max = (block[2].min_event_time + block[2].max_event_time) // 2
+            utils.process_block(a_client, incremental_args, block[0], block[1])
+            for interrupted in [False, True]:
+                if interrupted:
+                    manifest.begin_append(block_folder_path, manifest.read_manifest(block_folder_path))
+                block_stats = utils.process_block(a_client, incremental_args, block[0], block[1])
+                if block_stats.rows_written > 0:
+                    return "{} {}: {} rows appended without new rows{}".format(
+                        block[0], block[1], block_stats.rows_written, " after an interrupted append" if interrupted
+                        else "")
+            a_client.event_time_max = None
+            utils.process_block(a_client, incremental_args, block[0], block[1])
+            utils.process_block(a_client, full_args, block[0], block[1], block[2])
+            difference = compare_blocks(full_args, manifest.get_block_folder(full_folder_path, block[0], block[1]),
+                                        block_folder_path)
+            if difference is not None:
+                return "{} {}: {}".format(block[0], block[1], difference)
+    finally:
+        a_client.event_time_max = None
+        shutil.rmtree(root_folder_path, ignore_errors=True)
+    return None
+
+
+def print_report(a_stages_stats, a_end_to_end_results, a_incremental_results):
+    table_width = 100
+    print("=" * table_width)
+    print("{:^100}".format("Stages ({} rows/day, book depth {}, batch size {}, codec {} level {})".format(
+        ROWS_PER_DAY, BOOK_DEPTH, INTENDED_BATCH_SIZE, CODEC, COMPRESSION_LEVEL)))
+    print("-" * table_width)
+    print("{:20}|{:^15}|{:^15}|{:^15}|{:^15}|{:^15}|".format("Stage", "Time", "Rows/s", "MB/s", "MB", "Peak alloc"))
+    print("-" * table_width)
+    for stage in STAGES:
+        stats = a_stages_stats[stage]
+        print("{:20}|{:^15}|{:^15}|{:^15}|{:^15}|{:^15}|".format(
+            stage,
+            "{:0.3f} s".format(stats.time),
+            utils.pretty_print_number(int(stats.rows / stats.time)) if stats.time > 0 else "-",
+            "{:0.1f}".format(stats.bytes / 1e6 / stats.time) if stats.time > 0 else "-",
+            "{:0.1f}".format(stats.bytes / 1e6),
+            "{:0.1f} MB".format(stats.peak_alloc / 1e6) if MEASURE_MEMORY else "-",
+        ))
+    print("-" * table_width)
+    print("{:^100}".format("End to end (process_block)"))
+    print("-" * table_width)
+    for arguments, result in a_end_to_end_results:
+        print("{:52}|{:^15}|{:^15}|{:^15}|".format(
+            " ".join(arguments) if len(arguments) > 0 else "(defaults)",
+            "{:0.3f} s".format(result[1]),
+            utils.pretty_print_number(int(result[0] / result[1])) + " rows/s",
+            ""))
+    print("-" * table_width)
+    print("{:^100}".format("Incremental dumps against a full dump"))
+    print("-" * table_width)
+    for arguments, difference in a_incremental_results:
+        print("{:52}|{:^47}|".format(" ".join(arguments) if len(arguments) > 0 else "(defaults)",
+                                     "identical" if difference is None else difference))
+    print("-" * table_width)
+    print("Peak RSS: {:0.1f} MB".format(get_peak_rss() / 1e6))
+    print("=" * table_width)
+
+
+if __name__ == "__main__":
+    print("Generating synthetic data...", end="\t")
+    client = fake_clickhouse.FakeClient(a_symbols=SYMBOLS, a_dates=DATES, a_rows_per_day=ROWS_PER_DAY,
+                                        a_book_depth=BOOK_DEPTH, a_is_snapshot=IS_SNAPSHOT)
+    for symbol in SYMBOLS:
+        for date in DATES:
+            client.get_data(symbol, date)
+    print("Done!\n")
+
+    codec = compression.Codec(CODEC, COMPRESSION_LEVEL)
+    stages_stats = {stage: StageStats() for stage in STAGES}
+    run_stages(client, codec, stages_stats, False)
+    if MEASURE_MEMORY:
+        # timings come from the first pass, tracemalloc would distort them; peaks come from this one
+        tracemalloc.start()
+        memory_stats = {stage: StageStats() for stage in STAGES}
+        run_stages(client, codec, memory_stats, True)
+        tracemalloc.stop()
+        for stage in STAGES:
+            stages_stats[stage].peak_alloc = memory_stats[stage].peak_alloc
+
+    end_to_end_results = []
+    for arguments in END_TO_END_ARGUMENTS:
+        end_to_end_results.append([arguments, run_end_to_end(client, arguments)])
+
+    incremental_results = []
+    for arguments in INCREMENTAL_ARGUMENTS:
+        incremental_results.append([arguments, run_incremental_check(client, arguments)])
+
+    print_report(stages_stats, end_to_end_results, incremental_results)
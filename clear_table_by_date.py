@@ -1,4 +1,10 @@
+import datetime
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import clickhouse_connect
+import partitions
 import utils
 
 ##############################################
@@ -9,12 +15,54 @@ DATE_UNTIL = 'yyyy-mm-dd'  # DOUBLE CHECK THIS!!!
 # TODO: make a config of date expression eg. '<' or '<=' or ...
 HOST = "clickhouse.giant.agtrading.ru"
 PORT = 443
+# 1 drops the partitions entirely before DATE_UNTIL and mutates only the one around it, 0 clears every table with a
+# single mutation (rewrites every part holding older dates)
+DROP_PARTITIONS = 1
+NUM_THREADS = 8  # tables cleared at the same time, each over its own connection
+WAIT_FOR_MUTATIONS = 1  # 0 exits as soon as the mutations are started, they keep running in the background
+# the wait stops at the first mutation that reports a failure, ClickHouse keeps retrying it in the background
+MUTATIONS_POLL_INTERVAL = 10  # seconds
 ##############################################
 
+def get_client():
+    return clickhouse_connect.get_client(host=HOST, port=PORT, username='default', password='')
+
+
+def run_table_clearing(a_table_clearing):
+    # a failure is reported with the table instead of stopping the report of the others
+    try:
+        a_table_clearing.run(utils.get_thread_client(get_client))
+    except Exception as e:
+        a_table_clearing.error = e
+    return a_table_clearing
+
+
+# fails on the placeholder or a typo before anything is touched
+datetime.date.fromisoformat(DATE_UNTIL)
+
 print("Attempting to connect...", end="\t")
-client = clickhouse_connect.get_client(host=HOST, port=PORT, username='default', password='')
+client = get_client()
 print("Connected to ClickHouse!\n")
 
+print("Getting tables...", end="\t")
+tables = utils.get_tables(client, DATABASE)
+print("Got {} tables!".format(len(tables)))
+print()
+
+table_clearings = []
+for table in tables:
+    table_clearing = partitions.TableClearing(DATABASE, table, DATE_UNTIL)
+    if DROP_PARTITIONS:
+        table_clearing.plan(client)
+    else:
+        table_clearing.mutate_whole_table = True
+    if table_clearing.is_empty():
+        print("Nothing to clear in table {:30}".format(table))
+        continue
+    print("Table {:30}\t{}".format(table, table_clearing))
+    table_clearings.append(table_clearing)
+print()
+
 print("This script will clear ALL data from:\n\tdatabase:\t{}\n\tuntil date:\t{}".format(DATABASE, DATE_UNTIL))
 print()
 print(utils.make_red("This operation cannot be aborted or undone!"))
@@ -23,20 +71,49 @@ utils.magic_number_verify()
 
 print(utils.make_red("DOUBLE CHECK THE DATABASE AND DATE!!!"))
 utils.magic_number_verify()
-
-print()
-print("Getting tables...", end="\t")
-tables = utils.get_tables(client, DATABASE)
-print("Got {} tables!".format(len(tables)))
 print()
 
-for table in tables:
-    print("Marking to clear table {:30}".format(table), end="\t")
-    utils.clear_table_by_date(client, DATABASE, table, DATE_UNTIL)
-    print("Table marked!")
+print("Clearing {} tables in up to {} threads...".format(len(table_clearings), NUM_THREADS))
+with ThreadPoolExecutor(max_workers=NUM_THREADS) as clearing_executor:
+    for table_clearing in clearing_executor.map(run_table_clearing, table_clearings):
+        if table_clearing.error is not None:
+            print(utils.make_red("Table failed:  {:30}\t{} mutations started, {}".format(
+                table_clearing.table, len(table_clearing.mutation_ids), table_clearing.error)))
+            continue
+        print("Table cleared: {:30}\t{} mutations started".format(table_clearing.table,
+                                                                   len(table_clearing.mutation_ids)))
 print()
 
+failed_tables = [table_clearing.table for table_clearing in table_clearings if table_clearing.error is not None]
+failed_mutations = []
+count_mutations = sum(len(table_clearing.mutation_ids) for table_clearing in table_clearings)
+if count_mutations > 0 and WAIT_FOR_MUTATIONS:
+    print("Waiting for {} mutations to finish...".format(count_mutations))
+    while True:
+        unfinished_mutations = partitions.get_unfinished_mutations(client, DATABASE, table_clearings)
+        if len(unfinished_mutations) == 0:
+            break
+        print("\t{} mutations running, {} parts left".format(len(unfinished_mutations),
+                                                              sum(row[2] for row in unfinished_mutations)))
+        failed_mutations = [row for row in unfinished_mutations if row[3] != ""]
+        if len(failed_mutations) > 0:
+            break
+        time.sleep(MUTATIONS_POLL_INTERVAL)
+    print()
+
 print("===================================================================")
-print("All tables marked to be cleared!")
-print("The actual clearing will happen asynchronously in the background.")
+if len(failed_tables) > 0 or len(failed_mutations) > 0:
+    for table in failed_tables:
+        print(utils.make_red("Table {} was not fully cleared, see its error above".format(table)))
+    for row in failed_mutations:
+        print(utils.make_red("Mutation {} of table {} failed: {}".format(row[1], row[0], row[3])))
+    if len(failed_mutations) > 0:
+        print("Failed mutations are retried by ClickHouse until they are killed (KILL MUTATION).")
+    print("===================================================================")
+    sys.exit(1)
+if count_mutations == 0 or WAIT_FOR_MUTATIONS:
+    print("All tables cleared!")
+else:
+    print("All tables marked to be cleared!")
+    print("The actual clearing will happen asynchronously in the background.")
 print("===================================================================")
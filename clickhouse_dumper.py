@@ -1,21 +1,9 @@
 import clickhouse_connect
+import manifest
+import partitions
 import utils
-from argparse import ArgumentParser
 
-parser = ArgumentParser()
-parser.add_argument("--root_folder_path", dest="root_folder_path", default='./data', nargs='?')
-parser.add_argument("--intended_batch_size", dest="intended_batch_size", default=100000, nargs='?', type=int)
-parser.add_argument("--database", dest="database", nargs='?', required=True)
-parser.add_argument("--table", dest="table", nargs='?', required=True)
-parser.add_argument("--is_snapshot", dest="is_snapshot", default=1, nargs='?')
-parser.add_argument("--host", dest="host", default="clickhouse.giant.agtrading.ru", nargs='?')
-parser.add_argument("--port", dest="port", default=443, nargs='?', type=int)
-parser.add_argument("--dump_one_block", dest="dump_one_block", default=None, nargs='+')
-parser.add_argument("--instrument_white_list", dest="instrument_white_list", default=['.*'], nargs='+')
-parser.add_argument("--date_white_list", dest="date_white_list", default=['.*'], nargs='+')
-parser.add_argument("--quiet", dest="quiet", const=1, default=0, nargs='?')
-parser.add_argument("--use_gzip", dest="use_gzip", const=1, default=0, nargs='?')
-args = parser.parse_args()
+args = utils.get_args_parser().parse_args()
 
 utils.quiet_print(args.quiet,
                   "####################################################################################################")
@@ -25,6 +13,7 @@ utils.quiet_print(args.quiet, "ROOT_FOLDER_PATH: {}".format(args.root_folder_pat
 utils.quiet_print(args.quiet, "INTENDED_BATCH_SIZE: {}".format(args.intended_batch_size))
 utils.quiet_print(args.quiet, "DATABASE: {}".format(args.database))
 utils.quiet_print(args.quiet, "TABLE: {}".format(args.table))
+utils.quiet_print(args.quiet, "COLUMNS: {}".format(args.columns))
 utils.quiet_print(args.quiet, "IS_SNAPSHOT: {}".format(args.is_snapshot))
 utils.quiet_print(args.quiet, "HOST: {}".format(args.host))
 utils.quiet_print(args.quiet, "PORT: {}".format(args.port))
@@ -33,29 +22,37 @@ utils.quiet_print(args.quiet, "INSTRUMENT_WHITE_LIST: {}".format(args.instrument
 utils.quiet_print(args.quiet, "DATE_WHITE_LIST: {}".format(args.date_white_list))
 utils.quiet_print(args.quiet, "QUIET: {}".format(args.quiet))
 utils.quiet_print(args.quiet, "USE_GZIP: {}".format(args.use_gzip))
+utils.quiet_print(args.quiet, "CODEC: {}".format(args.codec))
+utils.quiet_print(args.quiet, "COMPRESSION_LEVEL: {}".format(args.compression_level))
+utils.quiet_print(args.quiet, "COMPRESSION_THREADS: {}".format(args.compression_threads))
+utils.quiet_print(args.quiet, "INDEX_INTERVAL: {}".format(args.index_interval))
+utils.quiet_print(args.quiet, "OUTPUT_FORMAT: {}".format(args.output_format))
+utils.quiet_print(args.quiet, "STREAMING: {}".format(args.streaming))
+utils.quiet_print(args.quiet, "PIPELINED: {}".format(args.pipelined))
+utils.quiet_print(args.quiet, "ORDER_COLUMN: {}".format(args.order_column))
+utils.quiet_print(args.quiet, "PUSHDOWN: {}".format(args.pushdown))
+utils.quiet_print(args.quiet, "VERIFY_PUSHDOWN: {}".format(args.verify_pushdown))
+utils.quiet_print(args.quiet, "BATCH_PLANNER: {}".format(args.batch_planner))
+utils.quiet_print(args.quiet, "FORCE: {}".format(args.force))
+utils.quiet_print(args.quiet, "VERIFY_CHECKSUMS: {}".format(args.verify_checksums))
+utils.quiet_print(args.quiet, "QUERY_TIMEOUT: {}".format(args.query_timeout))
+utils.quiet_print(args.quiet, "TELEMETRY_PATH: {}".format(args.telemetry_path))
+utils.quiet_print(args.quiet, "INCREMENTAL: {}".format(args.incremental))
+utils.quiet_print(args.quiet, "PLAN_CACHE_PATH: {}".format(args.plan_cache_path))
 
 utils.quiet_print(args.quiet, "Attempting to connect...", end="\t")
-client = clickhouse_connect.get_client(host=args.host, port=args.port, username='default', password='')
+client = clickhouse_connect.get_client(host=args.host, port=args.port, username='default', password='',
+                                       send_receive_timeout=args.query_timeout)
 utils.quiet_print(args.quiet, "Connected to ClickHouse!\n")
 
 blocks = []
 if args.dump_one_block is None:
-    utils.quiet_print(args.quiet, "Getting instruments...", end="\t")
-    instruments = utils.get_instruments(client, args.database, args.table)
-    # utils.quiet_print(args.quiet, "Got {} instruments!".format(len(instruments)), end="\t")
-    instruments = utils.filter_list_whitelist(instruments, args.instrument_white_list)
-    utils.quiet_print(args.quiet, "Got {} instruments after filtering!\n".format(len(instruments)))
-
-    for instrument in instruments:
-        utils.quiet_print(args.quiet, "Getting dates for instrument {0:20}".format(instrument + "..."), end="\t")
-        instrument_dates = utils.get_instrument_dates(client, args.database, args.table, instrument)
-        # utils.quiet_print(args.quiet, "Got {} dates!".format(len(instrument_dates)), end="\t")
-        instrument_dates = utils.filter_list_whitelist(instrument_dates, args.date_white_list)
-        utils.quiet_print(args.quiet, "Got {} dates after filtering!".format(len(instrument_dates)))
-
-        for instrument_date in instrument_dates:
-            blocks.append([instrument, instrument_date])
-    utils.quiet_print(args.quiet, "")
+    utils.quiet_print(args.quiet, "Planning blocks...", end="\t")
+    blocks_plan = partitions.get_blocks_plan(client, args.database, args.table, args.is_snapshot,
+                                             args.instrument_white_list, args.date_white_list, args.plan_cache_path)
+    blocks = blocks_plan.blocks
+    utils.quiet_print(args.quiet, "Got {} blocks after filtering, from {}!\n".format(len(blocks),
+                                                                                    blocks_plan.get_summary()))
 else:
     assert len(args.dump_one_block) == 2, "dump_one_block should be in format instrument,date"
     utils.quiet_print(args.quiet,
@@ -63,11 +60,21 @@ else:
                                                                            args.dump_one_block[1]))
     blocks.append([args.dump_one_block[0], args.dump_one_block[1]])
 
+# complete blocks are skipped, unless they are to be extended with their new rows
+if not args.force and not args.incremental:
+    for block in manifest.get_in_progress_blocks(args.root_folder_path):
+        utils.quiet_print(args.quiet, "Found interrupted block, it will be redone if selected: instrument: {}, "
+                                      "date: {}".format(block[0], block[1]))
+    count_blocks = len(blocks)
+    blocks = manifest.filter_complete_blocks(args.root_folder_path, blocks, args.verify_checksums)
+    utils.quiet_print(args.quiet, "Skipping {} already complete blocks\n".format(count_blocks - len(blocks)))
+
 for block_id in range(0, len(blocks)):
     instrument = blocks[block_id][0]
     instrument_date = blocks[block_id][1]
     utils.quiet_print(args.quiet, "Processing block {} of {}".format(block_id + 1, len(blocks)))
-    utils.process_block(client, args, instrument, instrument_date)
+    block_info = blocks[block_id][2] if len(blocks[block_id]) > 2 else None
+    utils.process_block(client, args, instrument, instrument_date, block_info)
 
 utils.quiet_print(args.quiet,
                   "####################################################################################################")
@@ -0,0 +1,153 @@
+import collections
+import gzip
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Every chunk a BufferedFileWriter flushes is compressed on its own into a complete gzip member / zstd frame / lz4
+# frame. Concatenated members and frames are valid files for the standard tools (zcat, zstdcat, lz4cat), and since the
+# chunks are independent they can be compressed in parallel, off the thread that formats the data. For the same reason,
+# an incremental dump simply appends its chunks to the existing file.
+# The text streams of a block are cut into chunks at the same rows, and the index file of the block lists, for every
+# chunk, its eventTime range, its row count and where it starts in each stream. A reader decompresses from the first
+# chunk of the time range it wants instead of from the start of the day.
+CODECS = ["gzip", "zstd", "lz4", "none"]
+EXTENSIONS = {"gzip": ".gz", "zstd": ".zst", "lz4": ".lz4", "none": ""}
+DEFAULT_LEVELS = {"gzip": 9, "zstd": 3, "lz4": 0, "none": 0}
+
+CHUNK_SIZE = 1 << 20
+MAX_PENDING_CHUNKS_PER_FILE = 4
+INDEX_FILE_NAME = "_index.jsonl"
+
+compression_state = threading.local()
+
+
+def get_compression_pool(a_threads):
+    # One pool per worker, so that every worker compresses with its own --compression_threads: per process, and per
+    # thread of the process with the thread executor. Created lazily, so every worker process gets its own pool after
+    # the fork, and taken when the files are opened, by the worker thread rather than the stage threads that write.
+    if not hasattr(compression_state, "pool"):
+        compression_state.pool = ThreadPoolExecutor(max_workers=a_threads)
+    return compression_state.pool
+
+
+class Codec:
+    def __init__(self, a_name, a_level=None, a_threads=0):
+        self.name = a_name
+        self.level = DEFAULT_LEVELS[a_name] if a_level is None else a_level
+        self.threads = a_threads
+        self.extension = EXTENSIONS[a_name]
+        self.local = threading.local()
+
+        # the optional libraries are only needed (and checked) when their codec is selected
+        if self.name == "zstd":
+            import zstandard
+            self.zstandard = zstandard
+        elif self.name == "lz4":
+            import lz4.frame
+            self.lz4_frame = lz4.frame
+
+    def __str__(self):
+        return "{} (level: {}, threads: {})".format(self.name, self.level, self.threads)
+
+    def compress(self, a_data):
+        if self.name == "gzip":
+            return gzip.compress(a_data, compresslevel=self.level, mtime=0)
+        if self.name == "zstd":
+            # a ZstdCompressor must not be shared between threads
+            if not hasattr(self.local, "compressor"):
+                self.local.compressor = self.zstandard.ZstdCompressor(level=self.level, write_content_size=True)
+            return self.local.compressor.compress(a_data)
+        if self.name == "lz4":
+            return self.lz4_frame.compress(a_data, compression_level=self.level)
+        return a_data
+
+
+def get_codec(args):
+    codec_name = args.codec
+    if codec_name is None:
+        codec_name = "gzip" if args.use_gzip else "none"
+    return Codec(codec_name, args.compression_level, args.compression_threads)
+
+
+def open_decompressed(a_codec_name, a_file):
+    # a binary file object reading back everything a CompressedFileWriter wrote, across all members / frames, from the
+    # current position of a_file (a path, or an open binary file positioned at the start of a chunk) on. A file passed
+    # in is still closed by the caller.
+    if a_codec_name == "gzip":
+        return gzip.open(a_file, "rb")
+    if a_codec_name == "zstd":
+        import zstandard
+        if isinstance(a_file, str):
+            return zstandard.ZstdDecompressor().stream_reader(open(a_file, "rb"), read_across_frames=True)
+        return zstandard.ZstdDecompressor().stream_reader(a_file, read_across_frames=True, closefd=False)
+    if a_codec_name == "lz4":
+        import lz4.frame
+        return lz4.frame.open(a_file, "rb")
+    return open(a_file, "rb") if isinstance(a_file, str) else a_file
+
+
+class CompressedFileWriter:
+    def __init__(self, a_codec, a_file_path, a_append=False):
+        self.codec = a_codec
+        self.file = open(a_file_path, "ab" if a_append else "wb")
+        self.position = self.file.tell()
+        self.chunk_offsets = []  # where every chunk written so far starts in the file
+        self.pending_chunks = collections.deque()
+        self.pool = get_compression_pool(a_codec.threads) if a_codec.threads > 0 and a_codec.name != "none" else None
+        self.closed = False
+        # summed over the compression threads, so it can exceed the wall time
+        self.compress_time = 0.0
+        self.compress_time_lock = threading.Lock()
+
+    def compress(self, a_data):
+        start_time = time.time()
+        data = self.codec.compress(a_data)
+        with self.compress_time_lock:
+            self.compress_time += time.time() - start_time
+        return data
+
+    def write_compressed_chunk(self, a_data):
+        self.chunk_offsets.append(self.position)
+        self.file.write(a_data)
+        self.position += len(a_data)
+
+    def write_chunk(self, a_data):
+        if self.codec.name == "none":
+            self.write_compressed_chunk(a_data)
+            return
+        if self.pool is None:
+            self.write_compressed_chunk(self.compress(a_data))
+            return
+
+        self.pending_chunks.append(self.pool.submit(self.compress, a_data))
+        # chunks are written in submission order; bound the memory held by chunks in flight
+        while len(self.pending_chunks) > 0 and (self.pending_chunks[0].done() or
+                                                len(self.pending_chunks) > MAX_PENDING_CHUNKS_PER_FILE):
+            self.write_compressed_chunk(self.pending_chunks.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        while len(self.pending_chunks) > 0:
+            self.write_compressed_chunk(self.pending_chunks.popleft().result())
+        self.file.close()
+        self.closed = True
+
+
+def write_index(a_directory, a_entries, a_append=False):
+    # a_entries: [first_event_time, last_event_time, rows, offsets in every stream] of every chunk, in order
+    with open(os.path.join(a_directory, INDEX_FILE_NAME), "a" if a_append else "w") as f:
+        for entry in a_entries:
+            f.write(json.dumps({"first_event_time": entry[0], "last_event_time": entry[1], "rows": entry[2],
+                                "offsets": entry[3]}) + "\n")
+
+
+def read_index(a_directory):
+    index_file_path = os.path.join(a_directory, INDEX_FILE_NAME)
+    if not os.path.isfile(index_file_path):
+        return None
+    with open(index_file_path) as f:
+        return [json.loads(line) for line in f]
@@ -0,0 +1,179 @@
+import numpy as np
+
+import batch
+
+# The "delta" output format: the streams of a text dump, in binary and with every row stored relative to the row before
+# it, which is where the redundancy of order book updates is. Every value is stored relative to the same level of the
+# previous row (the previous value for a column that is not an array): eventTimes as differences, prices and quantities
+# as differences of their decimal mantissas when all the values of the chunk are decimals with at most MAX_SCALE digits
+# (16000.01 is 1600001 at scale 2), the XOR of their float64 bits otherwise. Both are exact: a chunk only gets the
+# decimal encoding if dividing the mantissas gives back every float bit for bit. The arrays are then byte shuffled (the
+# first bytes of all values, then the second bytes...), so the zero bytes of the small residuals line up for the
+# compressor; differences are zigzag encoded first (0, -1, 1, -2... as 0, 1, 2, 3...), so small negative ones do not
+# fill their high bytes with ones.
+# Every chunk of a stream (see utils.BufferedFileWriterSet) is encoded on its own, starting from zeros, so it can be
+# decoded from its offset in the block index. A chunk is a header of HEADER_FIELDS int64 (rows, values, is an array,
+# encoding, scale), the int32 lengths of the rows for an array stream, then the residuals.
+
+FILE_SUFFIX = ".bin"
+HEADER_DTYPE = np.dtype("<i8")
+HEADER_FIELDS = 5
+HEADER_SIZE = HEADER_FIELDS * HEADER_DTYPE.itemsize
+LENGTH_DTYPE = np.dtype("<i4")
+RESIDUAL_DTYPE = np.dtype("<u8")
+ENCODING_DELTA = 0  # integers, e.g. eventTime
+ENCODING_DECIMAL_DELTA = 1  # float64 values that are integers / 10 ** scale
+ENCODING_XOR = 2  # any other float64 values
+MAX_SCALE = 9
+MAX_MANTISSA = 1 << 53  # larger integers are not exact in a float64
+
+
+def get_file_name(a_codec, a_stream_name):
+    return a_stream_name + FILE_SUFFIX + a_codec.extension
+
+
+def shuffle(a_values):
+    return a_values.view(np.uint8).reshape(-1, a_values.itemsize).T.tobytes()
+
+
+def unshuffle(a_data, a_dtype):
+    planes = np.frombuffer(a_data, dtype=np.uint8).reshape(a_dtype.itemsize, -1)
+    return np.ascontiguousarray(planes.T).view(a_dtype).reshape(-1)
+
+
+def zigzag(a_values):
+    return ((a_values << 1) ^ (a_values >> 63)).view(np.uint64)
+
+
+def unzigzag(a_residuals):
+    return ((a_residuals >> np.uint64(1)) ^ (np.uint64(0) - (a_residuals & np.uint64(1)))).view(np.int64)
+
+
+def get_row_sizes(a_column):
+    # the encoded bytes of every row, to cut chunks before they are encoded
+    if isinstance(a_column, batch.RaggedColumn):
+        return a_column.lengths() * RESIDUAL_DTYPE.itemsize + LENGTH_DTYPE.itemsize
+    return np.full(len(a_column), RESIDUAL_DTYPE.itemsize)
+
+
+def get_levels(a_offsets):
+    # the row and the level of every value
+    rows = np.repeat(np.arange(len(a_offsets) - 1), np.diff(a_offsets))
+    return rows, np.arange(a_offsets[-1]) - a_offsets[:-1][rows]
+
+
+def get_previous_level_indices(a_offsets):
+    # the index of the same level in the previous row for every value, -1 where the previous row is shorter
+    lengths = np.diff(a_offsets)
+    rows, levels = get_levels(a_offsets)
+    previous_indices = np.full(len(levels), -1, dtype=np.int64)
+    has_previous = rows > 0
+    has_previous[has_previous] = levels[has_previous] < lengths[rows[has_previous] - 1]
+    previous_indices[has_previous] = a_offsets[rows[has_previous] - 1] + levels[has_previous]
+    return previous_indices
+
+
+def get_decimal_mantissas(a_values):
+    # [scale, int64 mantissas] of the smallest scale that gives back every value exactly, None if there is none
+    if not np.isfinite(a_values).all() or (len(a_values) > 0 and np.abs(a_values).max() >= MAX_MANTISSA):
+        return None
+    bits = a_values.view(np.uint64)
+    for scale in range(MAX_SCALE + 1):
+        mantissas = np.round(a_values * 10.0 ** scale)
+        if len(mantissas) > 0 and np.abs(mantissas).max() >= MAX_MANTISSA:
+            return None
+        # the same operation as the decoding, which also rejects -0.0
+        if (np.divide(mantissas.astype(np.int64), 10.0 ** scale).view(np.uint64) == bits).all():
+            return [scale, mantissas.astype(np.int64)]
+    return None
+
+
+def encode_chunk(a_column):
+    # a_column: a batch.ScalarColumn or batch.RaggedColumn holding the rows of one chunk
+    is_array = isinstance(a_column, batch.RaggedColumn)
+    offsets = a_column.offsets if is_array else np.arange(len(a_column) + 1)
+    previous_indices = get_previous_level_indices(offsets)
+    has_previous = previous_indices >= 0
+
+    scale = 0
+    if a_column.values.dtype.kind in "iu":
+        encoding = ENCODING_DELTA
+        values = a_column.values.astype(np.int64)
+    else:
+        values = np.ascontiguousarray(a_column.values, dtype=np.float64)
+        decimal_mantissas = get_decimal_mantissas(values)
+        if decimal_mantissas is not None:
+            encoding = ENCODING_DECIMAL_DELTA
+            scale, values = decimal_mantissas
+        else:
+            encoding = ENCODING_XOR
+            values = values.view(np.uint64)
+
+    if encoding == ENCODING_XOR:
+        residuals = values ^ np.where(has_previous, values[previous_indices], np.uint64(0))
+    else:
+        residuals = zigzag(values - np.where(has_previous, values[previous_indices], 0))
+    header = np.array([len(a_column), len(values), int(is_array), encoding, scale], dtype=HEADER_DTYPE).tobytes()
+    if is_array:
+        return header + shuffle(a_column.lengths().astype(LENGTH_DTYPE)) + shuffle(residuals)
+    return header + shuffle(residuals)
+
+
+def read_header(a_data):
+    # [rows, values, is an array, encoding, scale] and the size of the rest of the chunk
+    header = np.frombuffer(a_data, dtype=HEADER_DTYPE, count=HEADER_FIELDS).tolist()
+    size = header[1] * RESIDUAL_DTYPE.itemsize
+    if header[2]:
+        size += header[0] * LENGTH_DTYPE.itemsize
+    return header, size
+
+
+def accumulate_chains(a_residuals, a_offsets, a_is_xor):
+    # Every level over consecutive rows is a chain of residuals. Ordered by level, then row, every chain is a run whose
+    # values are the running XOR (sum) of the run, i.e. the running XOR (sum) of everything up to there undone by the
+    # one before the run.
+    previous_indices = get_previous_level_indices(a_offsets)
+    order = np.argsort(get_levels(a_offsets)[1], kind="stable")
+    chain_starts = previous_indices[order] < 0
+    chain_ids = np.cumsum(chain_starts) - 1
+    if a_is_xor:
+        running = np.bitwise_xor.accumulate(a_residuals[order])
+    else:
+        running = np.cumsum(unzigzag(a_residuals[order]))
+    start_positions = np.flatnonzero(chain_starts)
+    before_chains = np.zeros(len(start_positions), dtype=running.dtype)
+    before_chains[start_positions > 0] = running[start_positions[start_positions > 0] - 1]
+    values = np.empty_like(running)
+    values[order] = running ^ before_chains[chain_ids] if a_is_xor else running - before_chains[chain_ids]
+    return values
+
+
+def decode_chunk(a_header, a_data):
+    # a_data: the chunk after its header
+    rows, count_values, is_array, encoding, scale = a_header
+    offsets = np.arange(rows + 1)
+    if is_array:
+        lengths_size = rows * LENGTH_DTYPE.itemsize
+        offsets = np.zeros(rows + 1, dtype=np.int64)
+        np.cumsum(unshuffle(a_data[:lengths_size], LENGTH_DTYPE), out=offsets[1:])
+        a_data = a_data[lengths_size:]
+    values = accumulate_chains(unshuffle(a_data, RESIDUAL_DTYPE), offsets, encoding == ENCODING_XOR)
+    if encoding == ENCODING_DECIMAL_DELTA:
+        values = np.divide(values, 10.0 ** scale)
+    elif encoding == ENCODING_XOR:
+        values = values.view(np.float64)
+    return batch.RaggedColumn(values, offsets) if is_array else batch.ScalarColumn(values)
+
+
+def decode_stream(a_data):
+    # every chunk of a whole decompressed stream, concatenated, None if there is none
+    columns = []
+    position = 0
+    while position < len(a_data):
+        header, size = read_header(a_data[position:position + HEADER_SIZE])
+        position += HEADER_SIZE
+        if position + size > len(a_data):
+            raise ValueError("Chunk of {} bytes cut after {} bytes".format(size, len(a_data) - position))
+        columns.append(decode_chunk(header, a_data[position:position + size]))
+        position += size
+    return batch.concatenate_columns(columns) if len(columns) > 0 else None
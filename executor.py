@@ -0,0 +1,113 @@
+import copy
+import multiprocessing
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import clickhouse_connect
+
+import retry
+import utils
+
+# Every worker (a process or a thread, depending on the executor mode) keeps its own connections and args for its
+# whole lifetime, so a block costs one process_block call instead of a python start-up and a TLS handshake. With
+# several replicas, each block comes with the endpoint ([host, port]) to dump it from, and the worker keeps one
+# connection per endpoint it was sent to.
+worker_state = threading.local()
+
+
+def init_worker(args, a_circuit_breakers):
+    retry.set_circuit_breakers(a_circuit_breakers)
+    worker_state.args = args
+    worker_state.clients = {}
+
+
+def get_worker_client(a_endpoint):
+    endpoint_name = retry.get_endpoint_name(a_endpoint[0], a_endpoint[1])
+    if endpoint_name not in worker_state.clients:
+        worker_state.clients[endpoint_name] = clickhouse_connect.get_client(
+            host=a_endpoint[0], port=a_endpoint[1], username='default', password='',
+            send_receive_timeout=worker_state.args.query_timeout)
+    return worker_state.clients[endpoint_name]
+
+
+class BlockResult:
+    def __init__(self, a_instrument, a_date, a_rows_written, a_elapsed_time, a_error=None, a_stats=None,
+                 a_endpoint=None, a_endpoint_failure=False):
+        self.instrument = a_instrument
+        self.date = a_date
+        self.rows_written = a_rows_written
+        self.elapsed_time = a_elapsed_time
+        self.error = a_error
+        self.stats = a_stats  # telemetry.BlockStats of the block, None if it failed
+        self.endpoint = a_endpoint
+        # the block failed because of its endpoint and can be dumped from another replica
+        self.endpoint_failure = a_endpoint_failure
+
+    def ok(self):
+        return self.error is None
+
+    def get_error_summary(self):
+        # the last line of the traceback: the exception type and message
+        lines = [line for line in self.error.splitlines() if line.strip() != ""]
+        return lines[-1] if len(lines) > 0 else self.error
+
+    def __str__(self):
+        return "\tinstrument: {}\n" \
+               "\tdate: {}\n" \
+               "\trows_written: {}\n" \
+               "\telapsed_time: {:0.3f} s\n" \
+               "\terror: {}" \
+            .format(self.instrument,
+                    self.date,
+                    self.rows_written,
+                    self.elapsed_time,
+                    self.error)
+
+
+def run_block(a_block, a_endpoint=None):
+    start_time = time.time()
+    args = worker_state.args
+    if a_endpoint is None:
+        a_endpoint = [args.host, args.port]
+    else:
+        # the retry policy and the circuit breaker go by args.host / args.port
+        args = copy.copy(args)
+        args.host, args.port = a_endpoint
+    try:
+        # a planned block is [instrument, date, BlockInfo], a bare [instrument, date] is looked up by the worker
+        block_info = a_block[2] if len(a_block) > 2 else None
+        block_stats = utils.process_block(get_worker_client(a_endpoint), args, a_block[0], a_block[1], block_info)
+    except (retry.RetriesExhaustedError, retry.EndpointUnavailableError):
+        return BlockResult(a_block[0], a_block[1], 0, time.time() - start_time, traceback.format_exc(),
+                           a_endpoint=a_endpoint, a_endpoint_failure=True)
+    except Exception:
+        return BlockResult(a_block[0], a_block[1], 0, time.time() - start_time, traceback.format_exc(),
+                           a_endpoint=a_endpoint)
+    return BlockResult(a_block[0], a_block[1], block_stats.rows_written, time.time() - start_time,
+                       a_stats=block_stats, a_endpoint=a_endpoint)
+
+
+class BlockExecutor:
+    def __init__(self, args, a_num_workers, a_use_processes=True, a_endpoints=None):
+        # fork explicitly: the callers are plain scripts that must not be re-imported by spawned workers
+        mp_context = multiprocessing.get_context('fork')
+        if a_endpoints is None:
+            a_endpoints = [[args.host, args.port]]
+        # one breaker per endpoint for all workers, in shared memory so forked workers see each other's failures
+        self.circuit_breakers = {}
+        for endpoint in a_endpoints:
+            self.circuit_breakers[retry.get_endpoint_name(endpoint[0], endpoint[1])] = retry.CircuitBreaker(mp_context)
+        if a_use_processes:
+            self.pool = ProcessPoolExecutor(max_workers=a_num_workers, mp_context=mp_context,
+                                            initializer=init_worker, initargs=(args, self.circuit_breakers))
+        else:
+            self.pool = ThreadPoolExecutor(max_workers=a_num_workers, initializer=init_worker,
+                                           initargs=(args, self.circuit_breakers))
+
+    def submit(self, a_block, a_endpoint=None):
+        return self.pool.submit(run_block, a_block, a_endpoint)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,342 @@
+import datetime
+import re
+import zlib
+
+import numpy as np
+
+# A stand-in for a clickhouse_connect client that answers the queries of utils.py from synthetic, uDepthUpdates-shaped
+# data, so the dumper can be run and measured without a ClickHouse server. Only the query shapes used by utils.py are
+# understood; anything else raises ValueError.
+
+COLUMNS = [
+    ["symbol", "LowCardinality(String)"],
+    ["date", "Date"],
+    ["isSnapshot", "UInt8"],
+    ["firstUpdateId", "UInt64"],
+    ["lastUpdateId", "UInt64"],
+    ["eventTime", "UInt64"],
+    ["transactionTime", "UInt64"],
+    ["prevLastUpdateId", "UInt64"],
+    ["asks.price", "Array(Float64)"],
+    ["asks.quantity", "Array(Float64)"],
+    ["bids.price", "Array(Float64)"],
+    ["bids.quantity", "Array(Float64)"],
+]
+COLUMN_NAMES = [column[0] for column in COLUMNS]
+
+MILLISECONDS_PER_DAY = 24 * 3600 * 1000
+
+
+class FakeTableData:
+    # One (symbol, date) block: rows are stored in eventTime order, plus the permutation in which an unordered
+    # `SELECT *` returns them (ClickHouse returns rows part by part, not sorted).
+    def __init__(self, a_symbol, a_date, a_rows_per_day, a_book_depth, a_is_snapshot):
+        self.symbol = a_symbol
+        self.date = a_date
+        random_state = np.random.default_rng(zlib.crc32("{}|{}".format(a_symbol, a_date).encode()))
+        day_start = int(datetime.datetime.strptime(a_date, "%Y-%m-%d").replace(
+            tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+        # bursty arrivals: a quiet base rate per second, a market open spike and random short bursts
+        seconds = np.arange(24 * 3600)
+        rate = np.ones(len(seconds))
+        rate += 20 * np.exp(-((seconds - 13.5 * 3600) / 600.0) ** 2)
+        for burst_start in random_state.integers(0, len(seconds), size=50):
+            rate[burst_start:burst_start + random_state.integers(5, 120)] *= random_state.uniform(5, 50)
+        rate *= a_rows_per_day / rate.sum()
+        rows_per_second = random_state.poisson(rate)
+        count_rows = int(rows_per_second.sum())
+
+        # millisecond timestamps, so busy seconds produce duplicated eventTimes just like the real feed
+        self.event_times = np.sort(day_start + np.repeat(seconds, rows_per_second) * 1000 +
+                                   random_state.integers(0, 1000, size=count_rows)).astype(np.int64)
+        self.is_snapshot = a_is_snapshot
+
+        mid_price = 100 * (1 + np.cumsum(random_state.normal(0, 1e-4, size=count_rows)))
+        depths = np.full(count_rows, a_book_depth) if a_is_snapshot else random_state.integers(
+            1, a_book_depth + 1, size=count_rows)
+        self.asks_price = self.make_ladders(mid_price, depths, 1, random_state)
+        self.asks_quantity = self.make_quantities(depths, random_state)
+        self.bids_price = self.make_ladders(mid_price, depths, -1, random_state)
+        self.bids_quantity = self.make_quantities(depths, random_state)
+
+        self.unordered = np.arange(count_rows)
+        # shuffle inside parts of ~64k rows
+        for part_start in range(0, count_rows, 65536):
+            random_state.shuffle(self.unordered[part_start:part_start + 65536])
+
+    @staticmethod
+    def make_ladders(a_mid_price, a_depths, a_side, a_random_state):
+        ladders = []
+        for mid_price, depth in zip(np.round(a_mid_price, 2).tolist(), a_depths.tolist()):
+            levels = np.arange(1, depth + 1) * 0.01 * a_side
+            ladders.append(np.round(mid_price + levels, 2).tolist())
+        return ladders
+
+    @staticmethod
+    def make_quantities(a_depths, a_random_state):
+        quantities = np.round(a_random_state.exponential(2.0, size=int(a_depths.sum())), 3).tolist()
+        ladders = []
+        offset = 0
+        for depth in a_depths.tolist():
+            ladders.append(quantities[offset:offset + depth])
+            offset += depth
+        return ladders
+
+    def __len__(self):
+        return len(self.event_times)
+
+    def get_row_indices(self, a_event_time_min, a_event_time_max, a_ordered):
+        begin = np.searchsorted(self.event_times, a_event_time_min, side="left")
+        end = np.searchsorted(self.event_times, a_event_time_max, side="right")
+        if a_ordered:
+            return np.arange(begin, end)
+        selected = self.unordered[(self.unordered >= begin) & (self.unordered < end)]
+        return selected
+
+    def get_columns(self, a_row_indices):
+        row_indices = a_row_indices.tolist()
+        count_rows = len(row_indices)
+        event_times = self.event_times[a_row_indices].tolist()
+        # one update per row, numbered in eventTime order like the real feed, whatever order the rows are returned in
+        update_ids = (a_row_indices + 1).tolist()
+        return [
+            [self.symbol] * count_rows,
+            [datetime.date.fromisoformat(self.date)] * count_rows,
+            [self.is_snapshot] * count_rows,
+            update_ids,
+            update_ids,
+            event_times,
+            event_times,
+            row_indices,
+            [self.asks_price[i] for i in row_indices],
+            [self.asks_quantity[i] for i in row_indices],
+            [self.bids_price[i] for i in row_indices],
+            [self.bids_quantity[i] for i in row_indices],
+        ]
+
+
+def get_columns_bytes(a_columns):
+    # roughly what the Native format puts on the wire: 8 bytes per number, 8 bytes per array offset
+    size = 0
+    for column in a_columns:
+        if len(column) > 0 and isinstance(column[0], list):
+            size += 8 * len(column) + 8 * sum(map(len, column))
+        else:
+            size += 8 * len(column)
+    return size
+
+
+class FakeQueryResult:
+    def __init__(self, a_columns, a_column_names):
+        self.result_columns = a_columns
+        self.column_names = a_column_names
+        count_rows = len(a_columns[0]) if len(a_columns) > 0 else 0
+        self.summary = {
+            "read_rows": str(count_rows),
+            "result_rows": str(count_rows),
+            "result_bytes": str(get_columns_bytes(a_columns)),
+        }
+
+    @property
+    def result_rows(self):
+        return [list(row) for row in zip(*self.result_columns)]
+
+    def close(self):
+        pass
+
+
+class FakeStreamContext:
+    def __init__(self, a_source, a_blocks):
+        self.source = a_source
+        self.blocks = a_blocks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.source.close()
+
+    def __iter__(self):
+        return iter(self.blocks)
+
+
+class FakeClient:
+    def __init__(self, a_database="fake_database", a_table="uDepthUpdates", a_symbols=("BTCUSDT", "ETHUSDT"),
+                 a_dates=("2023-01-01", "2023-01-02"), a_rows_per_day=200000, a_book_depth=20, a_is_snapshot=1):
+        self.database = a_database
+        self.table = a_table
+        self.symbols = list(a_symbols)
+        self.dates = list(a_dates)
+        self.rows_per_day = a_rows_per_day
+        self.book_depth = a_book_depth
+        self.is_snapshot = a_is_snapshot
+        self.data = {}
+        self.count_queries = 0
+        self.event_time_max = None  # rows after it are not returned, as if the day was still being written
+
+    def get_data(self, a_symbol, a_date):
+        key = (a_symbol, a_date)
+        if key not in self.data:
+            self.data[key] = FakeTableData(a_symbol, a_date, self.rows_per_day, self.book_depth, self.is_snapshot)
+        return self.data[key]
+
+    def get_selected_data(self, a_query):
+        # the blocks matched by the symbol / date / isSnapshot filters of a query
+        is_snapshot = re.search(r"isSnapshot = (\d+)", a_query)
+        if is_snapshot is not None and int(is_snapshot.group(1)) != self.is_snapshot:
+            return []
+        symbols = self.symbols
+        symbol = re.search(r"symbol = '([^']*)'", a_query)
+        if symbol is not None:
+            symbols = [s for s in symbols if s == symbol.group(1)]
+        symbol_patterns = re.findall(r"match\(symbol, '((?:[^'\\]|\\.)*)'\)", a_query)
+        if len(symbol_patterns) > 0:
+            symbols = [s for s in symbols if any(re.search(unescape(p), s) for p in symbol_patterns)]
+        dates = self.dates
+        date = re.search(r"date = '([^']*)'", a_query)
+        if date is not None:
+            dates = [d for d in dates if d == date.group(1)]
+        date_patterns = re.findall(r"match\(toString\(date\), '((?:[^'\\]|\\.)*)'\)", a_query)
+        if len(date_patterns) > 0:
+            dates = [d for d in dates if any(re.search(unescape(p), d) for p in date_patterns)]
+        date_min = re.search(r"date >= '([^']*)'", a_query)
+        if date_min is not None:
+            dates = [d for d in dates if d >= date_min.group(1)]
+        date_max = re.search(r"date <= '([^']*)'", a_query)
+        if date_max is not None:
+            dates = [d for d in dates if d <= date_max.group(1)]
+        return [self.get_data(symbol, date) for symbol in symbols for date in dates]
+
+    def get_event_time_range(self, a_query):
+        event_time_min = re.search(r"eventTime >= '?(-?\d+)'?", a_query)
+        event_time_max = re.search(r"eventTime <= '?(-?\d+)'?", a_query)
+        event_time_max = int(event_time_max.group(1)) if event_time_max is not None else 1 << 62
+        if self.event_time_max is not None:
+            event_time_max = min(event_time_max, self.event_time_max)
+        return [int(event_time_min.group(1)) if event_time_min is not None else -(1 << 62), event_time_max]
+
+    @staticmethod
+    def get_projection(a_query):
+        # the positions in COLUMNS of the selected columns: `SELECT *` or `SELECT `a`, `b.c` FROM`, None for other queries
+        select_list = re.match(r"SELECT (\*|`[^`]+`(?:, `[^`]+`)*) FROM ", a_query)
+        if select_list is None:
+            return None
+        if select_list.group(1) == "*":
+            return list(range(len(COLUMNS)))
+        column_names = re.findall(r"`([^`]+)`", select_list.group(1))
+        for column_name in column_names:
+            if column_name not in COLUMN_NAMES:
+                raise ValueError("FakeClient has no column {}".format(column_name))
+        return [COLUMN_NAMES.index(column_name) for column_name in column_names]
+
+    def select_rows(self, a_query, a_projection):
+        ordered = "ORDER BY eventTime" in a_query
+        one_by_event_time = "LIMIT 1 BY eventTime" in a_query
+        event_time_range = self.get_event_time_range(a_query)
+        limit = re.search(r"LIMIT (\d+)\s*$", a_query)
+        columns = [[] for _ in a_projection]
+        for data in self.get_selected_data(a_query):
+            row_indices = data.get_row_indices(event_time_range[0], event_time_range[1], ordered)
+            if one_by_event_time:
+                event_times = data.event_times[row_indices]
+                row_indices = row_indices[np.concatenate([[True], event_times[1:] != event_times[:-1]])]
+            data_columns = data.get_columns(row_indices)
+            for column, position in zip(columns, a_projection):
+                column.extend(data_columns[position])
+        if limit is not None:
+            columns = [column[:int(limit.group(1))] for column in columns]
+        return columns
+
+    def query(self, a_query, settings=None):
+        self.count_queries += 1
+        query = " ".join(a_query.split())
+
+        if query == "SHOW DATABASES":
+            return FakeQueryResult([[self.database]], ["name"])
+        if query.startswith("SHOW TABLES IN "):
+            return FakeQueryResult([[self.table]], ["name"])
+        if "FROM system.columns" in query:
+            return FakeQueryResult([[c[0] for c in COLUMNS], [c[1] for c in COLUMNS], list(range(1, len(COLUMNS) + 1))],
+                                   ["name", "type", "position"])
+        if "FROM system.parts" in query and "GROUP BY partition" in query:
+            # one partition per date, as in PARTITION BY date
+            columns = [[] for _ in range(8)]
+            for date in self.dates:
+                count_rows = sum(len(self.get_data(s, date)) for s in self.symbols)
+                for column, value in zip(columns, [date, date.replace("-", ""), datetime.date.fromisoformat(date),
+                                                   datetime.date.fromisoformat(date), count_rows, count_rows * 100,
+                                                   1, 0]):
+                    column.append(value)
+            return FakeQueryResult(columns, ["partition", "partition_id", "min_date", "max_date", "rows",
+                                             "bytes_on_disk", "max_block_number", "modification_time"])
+        if "FROM system.tables" in query:
+            count_rows = sum(len(self.get_data(s, d)) for s in self.symbols for d in self.dates)
+            return FakeQueryResult([[self.database], [self.table], [count_rows * 100], [count_rows * 100],
+                                    [count_rows * 400], [count_rows]],
+                                   ["database", "name", "bytes_on_disk", "bytes_compressed", "bytes_uncompressed",
+                                    "rows"])
+        if "GROUP BY symbol, date" in query:
+            columns = [[], [], [], [], []]
+            for data in self.get_selected_data(query):
+                for column, value in zip(columns, [data.symbol, datetime.date.fromisoformat(data.date),
+                                                   int(data.event_times[0]), int(data.event_times[-1]), len(data)]):
+                    column.append(value)
+            return FakeQueryResult(columns, ["symbol", "date", "min", "max", "count"])
+        if "intDiv(eventTime" in query:
+            bucket_origin, bucket_width = map(int, re.search(r"intDiv\(eventTime - (-?\d+), (\d+)\)", query).groups())
+            event_time_range = self.get_event_time_range(query)
+            buckets = {}
+            for data in self.get_selected_data(query):
+                event_times = data.event_times[data.get_row_indices(event_time_range[0], event_time_range[1], True)]
+                bucket_ids, counts = np.unique((event_times - bucket_origin) // bucket_width, return_counts=True)
+                for bucket_id, count in zip(bucket_ids.tolist(), counts.tolist()):
+                    buckets[bucket_id] = buckets.get(bucket_id, 0) + count
+            bucket_ids = sorted(buckets)
+            return FakeQueryResult([bucket_ids, [buckets[b] for b in bucket_ids]], ["bucket", "count"])
+        if query.startswith("SELECT min(eventTime), max(eventTime), count()"):
+            event_time_range = self.get_event_time_range(query)
+            event_times = [data.event_times[data.get_row_indices(event_time_range[0], event_time_range[1], True)]
+                           for data in self.get_selected_data(query)]
+            event_times = np.concatenate(event_times) if len(event_times) > 0 else np.array([], dtype=np.int64)
+            if len(event_times) == 0:
+                return FakeQueryResult([[0], [0], [0]], ["min", "max", "count"])
+            return FakeQueryResult([[int(event_times.min())], [int(event_times.max())], [len(event_times)]],
+                                   ["min", "max", "count"])
+        projection = self.get_projection(query)
+        if projection is not None:
+            return FakeQueryResult(self.select_rows(query, projection), [COLUMN_NAMES[p] for p in projection])
+        raise ValueError("FakeClient does not understand the query: {}".format(query))
+
+    def query_column_block_stream(self, a_query, settings=None):
+        query = " ".join(a_query.split())
+        projection = self.get_projection(query)
+        if projection is None:
+            raise ValueError("FakeClient does not stream the query: {}".format(query))
+        self.count_queries += 1
+        block_size = int((settings or {}).get("max_block_size", 65536))
+        columns = self.select_rows(query, projection)
+        source = FakeQueryResult(columns, [COLUMN_NAMES[p] for p in projection])
+        blocks = []
+        for block_start in range(0, len(columns[0]), block_size):
+            blocks.append([column[block_start:block_start + block_size] for column in columns])
+        return FakeStreamContext(source, blocks)
+
+    def query_arrow_stream(self, a_query, settings=None):
+        import pyarrow as pa
+
+        # RecordBatches, as the driver yields them from pyarrow.ipc.open_stream
+        stream = self.query_column_block_stream(a_query, settings)
+        record_batches = []
+        for block in stream.blocks:
+            record_batches.append(pa.RecordBatch.from_arrays([pa.array(column) for column in block],
+                                                             names=stream.source.column_names))
+        return FakeStreamContext(stream.source, record_batches)
+
+    def close(self):
+        pass
+
+
+def unescape(a_literal):
+    # inverse of the escaping done by utils.get_match_condition
+    return a_literal.replace("\\'", "'").replace("\\\\", "\\")
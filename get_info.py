@@ -1,3 +1,6 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
 import clickhouse_connect
 import utils
 
@@ -15,24 +18,39 @@ DATABASES_BLACKLIST = [
     '.*common.*'
 ]
 HIDE_EMPTY_DATABASES = True
+GET_DETAILS = 0  # 1 also gets the parts, partitions and dates of every table, one query per database
+DETAILS_THREADS = 8  # databases whose details are queried at the same time, each over its own connection
+JSON_OUTPUT = 0  # 1 prints the inventory as one JSON document instead of the tables, e.g. for monitoring
 ##############################################
 
-print("Attempting to connect...", end="\t")
-client = clickhouse_connect.get_client(host=HOST, port=PORT, username='default', password='')
-print("Connected to ClickHouse!\n")
+def get_client():
+    return clickhouse_connect.get_client(host=HOST, port=PORT, username='default', password='')
 
-print("Getting databases...", end="\t")
-databases = utils.get_databases(client)
 
-databases_info = []
-for database in utils.filter_list_blacklist(databases, DATABASES_BLACKLIST):
-    databases_info.append(utils.DatabaseInfo(database))
-print("Got {} databases!\n".format(len(databases_info)))
+def get_details(a_database_info):
+    a_database_info.get_details(utils.get_thread_client(get_client))
 
-for database in databases_info:
-    print("Getting info for database: {:30}".format(database.database_name + "..."), end="\t")
-    database.get_info(client)
-    print("Done!")
+
+utils.quiet_print(JSON_OUTPUT, "Attempting to connect...", end="\t")
+client = get_client()
+utils.quiet_print(JSON_OUTPUT, "Connected to ClickHouse!\n")
+
+utils.quiet_print(JSON_OUTPUT, "Getting databases...", end="\t")
+databases = utils.filter_list_blacklist(utils.get_databases(client), DATABASES_BLACKLIST)
+databases_info = utils.get_databases_info(client, databases)
+utils.quiet_print(JSON_OUTPUT, "Got {} databases with {} tables!\n".format(
+    len(databases_info), sum(len(database.tables) for database in databases_info)))
+
+if GET_DETAILS:
+    utils.quiet_print(JSON_OUTPUT, "Getting details of every database...", end="\t")
+    with ThreadPoolExecutor(max_workers=DETAILS_THREADS) as details_executor:
+        # list() re-raises the first error of a worker
+        list(details_executor.map(get_details, databases_info))
+    utils.quiet_print(JSON_OUTPUT, "Done!")
+
+if JSON_OUTPUT:
+    print(json.dumps({"databases": [database.to_record() for database in databases_info]}, indent=4, sort_keys=True))
+    exit()
 
 print("\n" + "=" * 100 + "\n")
 
@@ -0,0 +1,427 @@
+import mmap
+import os
+
+import numpy as np
+
+import batch
+import compression
+import delta_codec
+import manifest
+
+# Reads dumped blocks back into numpy arrays, whatever their output format: every stream becomes a batch.ScalarColumn
+# or, for the book levels, a batch.RaggedColumn (values plus row offsets), the representation the dumper formats from.
+# Text is parsed a whole buffer at a time: the line boundaries and the number of levels of every row come from the
+# positions of the newlines and spaces, and all the numbers of the buffer are converted by one numpy call. Uncompressed
+# files are memory mapped instead of read. iterate_block() reads a block one chunk at a time, for a time range or for
+# days that do not fit in memory; with the index of the block it starts decompressing at the first chunk of the range.
+# The delta output format is decoded a chunk at a time by delta_codec.
+
+NEWLINE = ord("\n")
+SPACE = ord(" ")
+TIME_STREAM = batch.get_stream_names([])[0]
+READ_SIZE = compression.CHUNK_SIZE  # bytes of the time stream parsed at a time by iterate_block
+STREAM_SUFFIXES = {"text": ".txt", "delta": delta_codec.FILE_SUFFIX}
+
+
+class BlockData:
+    def __init__(self, a_event_times, a_columns):
+        self.event_times = a_event_times
+        # stream name -> batch.ScalarColumn or batch.RaggedColumn, in stream order
+        self.columns = a_columns
+
+    def __len__(self):
+        return len(self.event_times)
+
+    def take(self, a_indices):
+        return BlockData(self.event_times[a_indices],
+                         {name: column.take(a_indices) for name, column in self.columns.items()})
+
+    def get_time_range(self, a_event_time_min=None, a_event_time_max=None):
+        # rows are ordered by eventTime, both bounds are included
+        start = 0 if a_event_time_min is None else int(np.searchsorted(self.event_times, a_event_time_min, "left"))
+        end = len(self) if a_event_time_max is None else int(np.searchsorted(self.event_times, a_event_time_max,
+                                                                             "right"))
+        if start == 0 and end == len(self):
+            return self
+        return self.take(np.arange(start, end))
+
+
+def concatenate(a_blocks_data):
+    return BlockData(np.concatenate([block_data.event_times for block_data in a_blocks_data]),
+                     {name: batch.concatenate_columns([block_data.columns[name] for block_data in a_blocks_data])
+                      for name in a_blocks_data[0].columns})
+
+
+def parse_stream(a_data, a_dtype, a_is_array):
+    # a_data: a uint8 array of whole lines. a_is_array None guesses it from the text: only arrays have rows with no
+    # value or several values.
+    newlines = np.flatnonzero(a_data == NEWLINE)
+    if len(newlines) == 0:
+        return batch.RaggedColumn(np.empty(0, dtype=a_dtype), np.zeros(1, dtype=np.int64)) if a_is_array else \
+            batch.ScalarColumn(np.empty(0, dtype=a_dtype))
+    values = np.fromstring(a_data, dtype=a_dtype, sep=" ")
+
+    line_starts = np.empty(len(newlines), dtype=np.int64)
+    line_starts[0] = 0
+    line_starts[1:] = newlines[:-1] + 1
+    # spaces only separate the values of a line, so a line holds one more value than spaces, unless it is empty
+    spaces_before = np.searchsorted(np.flatnonzero(a_data == SPACE), newlines)
+    lengths = np.where(newlines > line_starts, np.diff(spaces_before, prepend=0) + 1, 0)
+    if a_is_array is None:
+        a_is_array = bool((lengths != 1).any())
+
+    if len(values) != lengths.sum():
+        raise ValueError("Could not parse {} values out of {} lines".format(lengths.sum() - len(values),
+                                                                            len(newlines)))
+    if not a_is_array:
+        if (lengths != 1).any():
+            raise ValueError("A scalar stream has lines without exactly one value")
+        return batch.ScalarColumn(values)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return batch.RaggedColumn(values, offsets)
+
+
+def get_stream_dtype(a_stream_name):
+    return np.int64 if a_stream_name == TIME_STREAM else np.float64
+
+
+def map_file(a_file_path):
+    # a read-only uint8 array over the pages of the file, the mapping lives as long as the array
+    if os.path.getsize(a_file_path) == 0:
+        return np.empty(0, dtype=np.uint8)
+    with open(a_file_path, "rb") as f:
+        return np.frombuffer(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), dtype=np.uint8)
+
+
+def read_stream_data(a_file_path, a_codec_name):
+    if a_codec_name == "none":
+        return map_file(a_file_path)
+    with compression.open_decompressed(a_codec_name, a_file_path) as f:
+        return np.frombuffer(f.read(), dtype=np.uint8)
+
+
+class BlockLayout:
+    def __init__(self, a_block_folder_path):
+        self.block_folder_path = a_block_folder_path
+        self.output_format = None
+        self.codec_name = None
+        self.stream_names = []
+        self.array_streams = None  # None when the manifest does not say, it is then guessed from the text
+        self.index = None  # the chunks of the streams, when the block has an index that covers all its rows
+
+        block_manifest = manifest.read_manifest(a_block_folder_path)
+        for output_format, stream_suffix in STREAM_SUFFIXES.items():
+            for codec_name, extension in compression.EXTENSIONS.items():
+                if os.path.isfile(os.path.join(a_block_folder_path, TIME_STREAM + stream_suffix + extension)):
+                    self.output_format = output_format
+                    self.codec_name = codec_name
+        if self.output_format is None:
+            import arrow_sink  # pyarrow is only needed for the columnar outputs
+
+            for output_format in arrow_sink.FILE_NAMES:
+                if os.path.isfile(os.path.join(a_block_folder_path, arrow_sink.get_part_file_name(output_format, 0))):
+                    self.output_format = output_format
+        if self.output_format is None:
+            raise ValueError("No dumped block in {}".format(a_block_folder_path))
+
+        if block_manifest is not None and "streams" in block_manifest:
+            self.stream_names = block_manifest["streams"]
+            self.array_streams = block_manifest["array_streams"]
+        elif self.output_format in STREAM_SUFFIXES:
+            # blocks dumped before the manifest listed the streams
+            suffix = STREAM_SUFFIXES[self.output_format] + compression.EXTENSIONS[self.codec_name]
+            self.stream_names = [TIME_STREAM] + sorted(
+                file_name[:-len(suffix)] for file_name in os.listdir(a_block_folder_path)
+                if file_name.endswith(suffix) and file_name != TIME_STREAM + suffix)
+
+        if self.output_format in STREAM_SUFFIXES and block_manifest is not None:
+            index = compression.read_index(a_block_folder_path)
+            if index is not None and sum(chunk["rows"] for chunk in index) == block_manifest.get("rows_written") and \
+                    all(len(chunk["offsets"]) == len(self.stream_names) for chunk in index):
+                self.index = index
+
+    def get_stream_file_path(self, a_stream_name):
+        return os.path.join(self.block_folder_path, a_stream_name + STREAM_SUFFIXES[self.output_format] +
+                            compression.EXTENSIONS[self.codec_name])
+
+    def get_offsets(self, a_event_time_min):
+        # where the first chunk that may hold a_event_time_min starts in every stream, None past the last chunk
+        if self.index is None or a_event_time_min is None:
+            return [0] * len(self.stream_names)
+        for chunk in self.index:
+            if chunk["last_event_time"] >= a_event_time_min:
+                return chunk["offsets"]
+        return None
+
+    def is_array(self, a_stream_name):
+        if a_stream_name == TIME_STREAM:
+            return False
+        return a_stream_name in self.array_streams if self.array_streams is not None else None
+
+
+def from_arrow(a_table):
+    # a pyarrow Table or RecordBatch of a dumped block, the time stream first
+    import pyarrow as pa
+
+    event_times = a_table.column(0).to_numpy().astype(np.int64, copy=False)
+    columns = {}
+    for name in a_table.column_names[1:]:
+        column = a_table.column(name)
+        if isinstance(column, pa.ChunkedArray):
+            column = column.combine_chunks()
+        if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+            # the offsets of a sliced list array point into the values of the whole array
+            offsets = column.offsets.to_numpy().astype(np.int64)
+            values = column.values.to_numpy(zero_copy_only=False)[offsets[0]:offsets[-1]]
+            columns[name] = batch.RaggedColumn(values, offsets - offsets[0])
+        else:
+            columns[name] = batch.ScalarColumn(column.to_numpy(zero_copy_only=False))
+    return BlockData(event_times, columns)
+
+
+def load_delta_block(a_layout):
+    columns = {}
+    for stream_name in a_layout.stream_names:
+        column = delta_codec.decode_stream(read_stream_data(a_layout.get_stream_file_path(stream_name),
+                                                            a_layout.codec_name))
+        if column is None:
+            column = batch.RaggedColumn(np.empty(0), np.zeros(1, dtype=np.int64)) if a_layout.is_array(stream_name) \
+                else batch.ScalarColumn(np.empty(0, dtype=get_stream_dtype(stream_name)))
+        columns[stream_name] = column
+    event_times = columns.pop(TIME_STREAM).values
+    for stream_name, column in columns.items():
+        if len(column) != len(event_times):
+            raise ValueError("{} has {} rows instead of {}".format(stream_name, len(column), len(event_times)))
+    return BlockData(event_times, columns)
+
+
+def load_block(a_block_folder_path):
+    layout = BlockLayout(a_block_folder_path)
+    if layout.output_format == "delta":
+        return load_delta_block(layout)
+    if layout.output_format != "text":
+        import arrow_sink
+
+        return from_arrow(arrow_sink.read_table(layout.output_format, a_block_folder_path))
+
+    event_times = parse_stream(read_stream_data(layout.get_stream_file_path(TIME_STREAM), layout.codec_name),
+                               np.int64, False).values
+    columns = {}
+    for stream_name in layout.stream_names[1:]:
+        columns[stream_name] = parse_stream(read_stream_data(layout.get_stream_file_path(stream_name),
+                                                             layout.codec_name),
+                                            get_stream_dtype(stream_name), layout.is_array(stream_name))
+        if len(columns[stream_name]) != len(event_times):
+            raise ValueError("{} has {} rows instead of {}".format(stream_name, len(columns[stream_name]),
+                                                                  len(event_times)))
+    return BlockData(event_times, columns)
+
+
+class StreamReader:
+    # Whole lines of one text stream, a chunk at a time: sliced straight out of the memory map when the stream is not
+    # compressed, decompressed READ_SIZE bytes at a time otherwise.
+    def __init__(self, a_file_path, a_codec_name, a_offset=0):
+        # a_offset: where the chunk to start from begins in the file (see compression.read_index)
+        self.raw_file = None
+        self.file = None
+        self.data = np.empty(0, dtype=np.uint8)
+        self.position = 0
+        self.end_of_file = True
+        self.bytes_per_line = None
+        if a_codec_name == "none":
+            self.data = map_file(a_file_path)
+            self.position = a_offset
+        else:
+            self.raw_file = open(a_file_path, "rb")
+            self.raw_file.seek(a_offset)
+            self.file = compression.open_decompressed(a_codec_name, self.raw_file)
+            self.end_of_file = False
+
+    def fill(self, a_size):
+        # at least a_size bytes after position, unless the stream ends first
+        while len(self.data) - self.position < a_size and not self.end_of_file:
+            chunk = self.file.read(max(a_size - (len(self.data) - self.position), READ_SIZE))
+            if len(chunk) == 0:
+                self.end_of_file = True
+                break
+            self.data = np.concatenate([self.data[self.position:], np.frombuffer(chunk, dtype=np.uint8)])
+            self.position = 0
+
+    def read_exactly(self, a_size):
+        # the next a_size bytes, fewer only at the end of the stream
+        self.fill(a_size)
+        data = self.data[self.position:self.position + a_size]
+        self.position += len(data)
+        return data
+
+    def read_delta_chunk(self):
+        # the next chunk of a delta stream, None at the end of the stream
+        header_data = self.read_exactly(delta_codec.HEADER_SIZE)
+        if len(header_data) == 0:
+            return None
+        if len(header_data) < delta_codec.HEADER_SIZE:
+            raise ValueError("Stream ended inside a chunk header")
+        header, size = delta_codec.read_header(header_data)
+        data = self.read_exactly(size)
+        if len(data) < size:
+            raise ValueError("Chunk of {} bytes cut after {} bytes".format(size, len(data)))
+        return header, data
+
+    def read_chunk(self, a_size):
+        # the whole lines within the next a_size bytes, more if a single line is longer, empty at the end
+        size = a_size
+        while True:
+            self.fill(size)
+            window = self.data[self.position:self.position + size]
+            newlines = np.flatnonzero(window == NEWLINE)
+            if len(newlines) > 0:
+                end = self.position + newlines[-1] + 1
+                break
+            if len(window) < size:
+                # the end of the stream, without a final newline only if it was cut
+                end = self.position + len(window)
+                break
+            size *= 2
+        chunk = self.data[self.position:end]
+        self.position = end
+        return chunk
+
+    def read_lines(self, a_count_lines):
+        if a_count_lines == 0:
+            return np.empty(0, dtype=np.uint8)
+        size = READ_SIZE if self.bytes_per_line is None else int(self.bytes_per_line * a_count_lines * 1.1) + 1
+        while True:
+            self.fill(size)
+            window = self.data[self.position:self.position + size]
+            newlines = np.flatnonzero(window == NEWLINE)
+            if len(newlines) >= a_count_lines:
+                end = self.position + newlines[a_count_lines - 1] + 1
+                break
+            if len(window) < size:
+                raise ValueError("Stream ended after {} of {} lines".format(len(newlines), a_count_lines))
+            size *= 2
+        chunk = self.data[self.position:end]
+        self.position = end
+        self.bytes_per_line = len(chunk) / a_count_lines
+        return chunk
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.raw_file.close()
+
+
+def iterate_arrow_block(a_layout, a_event_time_min):
+    import arrow_sink
+    import pyarrow as pa
+    import pyarrow.parquet
+
+    for file_path in arrow_sink.get_part_file_paths(a_layout.output_format, a_layout.block_folder_path):
+        if a_layout.output_format == "parquet":
+            # the row groups before the range are skipped on the eventTime statistics of their footer
+            parquet_file = pyarrow.parquet.ParquetFile(file_path, memory_map=True)
+            for row_group_id in range(parquet_file.num_row_groups):
+                statistics = parquet_file.metadata.row_group(row_group_id).column(0).statistics
+                if a_event_time_min is not None and statistics is not None and statistics.has_min_max and \
+                        statistics.max < a_event_time_min:
+                    continue
+                yield from_arrow(parquet_file.read_row_group(row_group_id))
+        else:
+            with pa.memory_map(file_path) as source:
+                reader = pa.ipc.open_file(source)
+                for batch_id in range(reader.num_record_batches):
+                    record_batch = reader.get_batch(batch_id)
+                    # a record batch is only a view over the mapped file until it is converted
+                    if a_event_time_min is not None and len(record_batch) > 0 and \
+                            record_batch.column(0)[-1].as_py() < a_event_time_min:
+                        continue
+                    yield from_arrow(record_batch)
+
+
+def iterate_delta_block(a_layout, a_event_time_min):
+    offsets = a_layout.get_offsets(a_event_time_min)
+    if offsets is None:
+        return
+    readers = {stream_name: StreamReader(a_layout.get_stream_file_path(stream_name), a_layout.codec_name, offset)
+               for stream_name, offset in zip(a_layout.stream_names, offsets)}
+    try:
+        while True:
+            time_chunk = readers[TIME_STREAM].read_delta_chunk()
+            if time_chunk is None:
+                break
+            event_times = delta_codec.decode_chunk(*time_chunk).values
+            chunks = {stream_name: readers[stream_name].read_delta_chunk() for stream_name in a_layout.stream_names[1:]}
+            if any(chunk is None or chunk[0][0] != len(event_times) for chunk in chunks.values()):
+                raise ValueError("The streams of {} are not cut at the same rows".format(a_layout.block_folder_path))
+            if a_event_time_min is not None and event_times[-1] < a_event_time_min:
+                continue
+            yield BlockData(event_times, {stream_name: delta_codec.decode_chunk(*chunk)
+                                          for stream_name, chunk in chunks.items()})
+    finally:
+        for reader in readers.values():
+            reader.close()
+
+
+def iterate_text_block(a_layout, a_event_time_min, a_read_size):
+    offsets = a_layout.get_offsets(a_event_time_min)
+    if offsets is None:
+        return
+    readers = {stream_name: StreamReader(a_layout.get_stream_file_path(stream_name), a_layout.codec_name, offset)
+               for stream_name, offset in zip(a_layout.stream_names, offsets)}
+    try:
+        while True:
+            event_times = parse_stream(readers[TIME_STREAM].read_chunk(a_read_size), np.int64, False).values
+            if len(event_times) == 0:
+                break
+            if a_event_time_min is not None and event_times[-1] < a_event_time_min:
+                # nothing of the range in this chunk, the other streams are only moved past its lines
+                for stream_name in a_layout.stream_names[1:]:
+                    readers[stream_name].read_lines(len(event_times))
+                continue
+            columns = {}
+            for stream_name in a_layout.stream_names[1:]:
+                columns[stream_name] = parse_stream(readers[stream_name].read_lines(len(event_times)),
+                                                    get_stream_dtype(stream_name), a_layout.is_array(stream_name))
+            yield BlockData(event_times, columns)
+    finally:
+        for reader in readers.values():
+            reader.close()
+
+
+def iterate_block(a_block_folder_path, a_event_time_min=None, a_event_time_max=None, a_read_size=READ_SIZE):
+    # BlockData pieces of the block in eventTime order, restricted to [a_event_time_min, a_event_time_max]; only one
+    # piece of every stream is in memory at a time
+    layout = BlockLayout(a_block_folder_path)
+    if layout.output_format == "text":
+        pieces = iterate_text_block(layout, a_event_time_min, a_read_size)
+    elif layout.output_format == "delta":
+        pieces = iterate_delta_block(layout, a_event_time_min)
+    else:
+        pieces = iterate_arrow_block(layout, a_event_time_min)
+    for block_data in pieces:
+        if len(block_data) == 0:
+            continue
+        if a_event_time_max is not None and block_data.event_times[0] > a_event_time_max:
+            break
+        block_data = block_data.get_time_range(a_event_time_min, a_event_time_max)
+        if len(block_data) > 0:
+            yield block_data
+
+
+def iterate_windows(a_block_folder_path, a_window, a_event_time_min=None, a_event_time_max=None):
+    # [window_start, BlockData] for every eventTime window of a_window (aligned on its multiples) that holds rows
+    pending = []
+    pending_window_id = None
+    for block_data in iterate_block(a_block_folder_path, a_event_time_min, a_event_time_max):
+        window_ids = block_data.event_times // a_window
+        bounds = [0] + (np.flatnonzero(np.diff(window_ids)) + 1).tolist() + [len(block_data)]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            window_id = int(window_ids[start])
+            if pending_window_id is not None and window_id != pending_window_id:
+                yield [pending_window_id * a_window, concatenate(pending)]
+                pending = []
+            pending_window_id = window_id
+            pending.append(block_data.take(np.arange(start, end)))
+    if len(pending) > 0:
+        yield [pending_window_id * a_window, concatenate(pending)]
@@ -0,0 +1,190 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import socket
+import time
+
+# A block is dumped into a hidden temporary folder next to its final folder. It only becomes
+# <root>/<instrument>/<date> once every file is closed and the manifest describing them is written, so a block folder
+# with a valid manifest is always complete, and anything else is redone on the next run.
+# With --incremental, a complete block is instead extended in place with the rows after its last eventTime: the
+# manifest is marked "appending" first, and a run interrupted before the manifest is complete again is rolled back to
+# the file sizes it lists by the next one.
+MANIFEST_FILE_NAME = "_manifest.json"
+IN_PROGRESS_FILE_NAME = "_in_progress.json"
+TEMP_FOLDER_FORMAT = ".{}.tmp"
+OLD_FOLDER_FORMAT = ".{}.old"
+VERIFY_FOLDER_FORMAT = ".{}.verify"
+
+
+def get_block_folder(a_root_folder_path, a_instrument, a_date):
+    return os.path.join(a_root_folder_path, str(a_instrument), str(a_date))
+
+
+def get_temp_folder_name(a_date):
+    return TEMP_FOLDER_FORMAT.format(a_date)
+
+
+def get_verify_folder_name(a_date):
+    return VERIFY_FOLDER_FORMAT.format(a_date)
+
+
+def write_json_atomic(a_file_path, a_object):
+    temp_file_path = a_file_path + ".tmp"
+    with open(temp_file_path, "w") as f:
+        json.dump(a_object, f, indent=4, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file_path, a_file_path)
+
+
+def read_json(a_file_path):
+    try:
+        with open(a_file_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def get_file_checksum(a_file_path):
+    sha256 = hashlib.sha256()
+    with open(a_file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_files_info(a_folder_path, a_unchanged_files=None):
+    # a_unchanged_files: files known not to have changed since they were listed, their checksum is not computed again
+    files = {}
+    for file_name in sorted(os.listdir(a_folder_path)):
+        if file_name in (MANIFEST_FILE_NAME, IN_PROGRESS_FILE_NAME):
+            continue
+        file_path = os.path.join(a_folder_path, file_name)
+        size = os.path.getsize(file_path)
+        if a_unchanged_files is not None and file_name in a_unchanged_files and \
+                a_unchanged_files[file_name]["size"] == size:
+            files[file_name] = a_unchanged_files[file_name]
+            continue
+        files[file_name] = {
+            "size": size,
+            "sha256": get_file_checksum(file_path),
+        }
+    return files
+
+
+def mark_in_progress(a_temp_folder_path, a_instrument, a_date):
+    write_json_atomic(os.path.join(a_temp_folder_path, IN_PROGRESS_FILE_NAME), {
+        "instrument": a_instrument,
+        "date": a_date,
+        "host": socket.gethostname(),
+        "pid": os.getpid(),
+        "started_at": time.time(),
+    })
+
+
+def commit_block(a_temp_folder_path, a_block_folder_path, a_instrument, a_date, a_rows_written, a_last_event_time,
+                 a_streams, a_array_streams):
+    manifest = {
+        "instrument": a_instrument,
+        "date": a_date,
+        "status": "complete",
+        "rows_written": a_rows_written,
+        "last_event_time": a_last_event_time,
+        # the output streams in column order, and which of them hold one array per row (see loader.py)
+        "streams": a_streams,
+        "array_streams": a_array_streams,
+        "files": get_files_info(a_temp_folder_path),
+        "finished_at": time.time(),
+    }
+    write_json_atomic(os.path.join(a_temp_folder_path, MANIFEST_FILE_NAME), manifest)
+    os.remove(os.path.join(a_temp_folder_path, IN_PROGRESS_FILE_NAME))
+
+    # a directory cannot be renamed over a non-empty one, so a previous dump is moved aside first
+    old_folder_path = os.path.join(os.path.dirname(a_block_folder_path), OLD_FOLDER_FORMAT.format(a_date))
+    if os.path.exists(a_block_folder_path):
+        shutil.rmtree(old_folder_path, ignore_errors=True)
+        os.rename(a_block_folder_path, old_folder_path)
+    os.rename(a_temp_folder_path, a_block_folder_path)
+    shutil.rmtree(old_folder_path, ignore_errors=True)
+
+    return manifest
+
+
+def read_manifest(a_block_folder_path):
+    return read_json(os.path.join(a_block_folder_path, MANIFEST_FILE_NAME))
+
+
+def can_append(a_block_folder_path, a_manifest, a_file_names):
+    # the block must have been dumped into the same files (columns, codec, output format) and with a known last
+    # eventTime, which manifests written before incremental dumps existed do not have
+    if a_manifest is None or a_manifest.get("status") not in ("complete", "appending") or \
+            a_manifest.get("last_event_time") is None:
+        return False
+    for file_name in a_file_names:
+        if file_name not in a_manifest["files"]:
+            return False
+    for file_name, file_info in a_manifest["files"].items():
+        file_path = os.path.join(a_block_folder_path, file_name)
+        if not os.path.isfile(file_path) or os.path.getsize(file_path) < file_info["size"]:
+            return False
+    return True
+
+
+def begin_append(a_block_folder_path, a_manifest):
+    # cuts off whatever an interrupted append left behind, so the files are exactly the ones of the manifest again
+    for file_name in os.listdir(a_block_folder_path):
+        if file_name == MANIFEST_FILE_NAME:
+            continue
+        file_path = os.path.join(a_block_folder_path, file_name)
+        if file_name not in a_manifest["files"]:
+            os.remove(file_path)
+        elif os.path.getsize(file_path) != a_manifest["files"][file_name]["size"]:
+            os.truncate(file_path, a_manifest["files"][file_name]["size"])
+    write_json_atomic(os.path.join(a_block_folder_path, MANIFEST_FILE_NAME), dict(a_manifest, status="appending"))
+
+
+def commit_append(a_block_folder_path, a_manifest, a_rows_written, a_last_event_time):
+    manifest = dict(a_manifest)
+    manifest["status"] = "complete"
+    manifest["rows_written"] = a_manifest["rows_written"] + a_rows_written
+    manifest["last_event_time"] = a_last_event_time
+    manifest["files"] = get_files_info(a_block_folder_path, a_manifest["files"])
+    manifest["appended_at"] = time.time()
+    write_json_atomic(os.path.join(a_block_folder_path, MANIFEST_FILE_NAME), manifest)
+    return manifest
+
+
+def is_block_complete(a_root_folder_path, a_instrument, a_date, a_verify_checksums=False):
+    block_folder_path = get_block_folder(a_root_folder_path, a_instrument, a_date)
+    manifest = read_manifest(block_folder_path)
+    if manifest is None or manifest.get("status") != "complete":
+        return False
+    for file_name, file_info in manifest["files"].items():
+        file_path = os.path.join(block_folder_path, file_name)
+        if not os.path.isfile(file_path) or os.path.getsize(file_path) != file_info["size"]:
+            return False
+        if a_verify_checksums and get_file_checksum(file_path) != file_info["sha256"]:
+            return False
+    return True
+
+
+def get_in_progress_blocks(a_root_folder_path):
+    blocks = []
+    for marker_path in glob.glob(os.path.join(a_root_folder_path, "*", TEMP_FOLDER_FORMAT.format("*"),
+                                              IN_PROGRESS_FILE_NAME)):
+        marker = read_json(marker_path)
+        if marker is not None:
+            blocks.append([marker["instrument"], marker["date"]])
+    blocks.sort()
+    return blocks
+
+
+def filter_complete_blocks(a_root_folder_path, a_blocks, a_verify_checksums=False):
+    blocks_to_dump = []
+    for block in a_blocks:
+        if not is_block_complete(a_root_folder_path, block[0], block[1], a_verify_checksums):
+            blocks_to_dump.append(block)
+    return blocks_to_dump
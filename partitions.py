@@ -0,0 +1,236 @@
+import datetime
+import os
+
+import manifest
+import utils
+
+# Blocks are planned from the metadata of the table parts (system.parts) instead of one GROUP BY symbol, date over the
+# whole table: the partitions give the dates, row counts and sizes without reading any data. Only the symbols of a
+# partition, with their eventTime range and row count, still need a query on the data, restricted to the dates of that
+# partition. Its result is cached per partition along with a fingerprint of the partition's parts (rows, highest block
+# number, last modification), so a run only scans the partitions that changed since the previous one, e.g. today's.
+# The same metadata lets clear_table_by_date.py drop whole partitions instead of rewriting them with a mutation.
+
+ZERO_DATE = "1970-01-01"  # min_date / max_date of the parts of a table whose partition key has no Date column
+
+
+class PartitionInfo:
+    def __init__(self, a_partition, a_partition_id, a_min_date, a_max_date, a_rows, a_bytes_on_disk, a_fingerprint):
+        self.partition = a_partition
+        self.partition_id = a_partition_id
+        self.min_date = a_min_date
+        self.max_date = a_max_date
+        self.rows = a_rows
+        self.bytes_on_disk = a_bytes_on_disk
+        self.fingerprint = a_fingerprint
+
+    def get_dates(self):
+        dates = []
+        date = datetime.date.fromisoformat(self.min_date)
+        while date <= datetime.date.fromisoformat(self.max_date):
+            dates.append(str(date))
+            date += datetime.timedelta(days=1)
+        return dates
+
+
+class BlocksPlan:
+    def __init__(self):
+        self.blocks = []
+        self.partitions = []
+        self.count_scanned_partitions = 0
+        self.count_cached_partitions = 0
+
+    def get_summary(self):
+        if len(self.partitions) == 0:
+            return "no date partitions, planned with a full scan"
+        return "{} partitions, {} rows, {:0.1f} GB on disk ({} scanned, {} cached)".format(
+            len(self.partitions),
+            utils.pretty_print_number(sum(p.rows for p in self.partitions)),
+            sum(p.bytes_on_disk for p in self.partitions) / 1e9,
+            self.count_scanned_partitions,
+            self.count_cached_partitions)
+
+
+def get_partitions(
+        client,
+        a_database,
+        a_table
+):
+    query_get_partitions_string = """SELECT
+    partition,
+    any(partition_id),
+    min(min_date),
+    max(max_date),
+    sum(rows),
+    sum(bytes_on_disk),
+    max(max_block_number),
+    toUnixTimestamp(max(modification_time))
+FROM system.parts
+WHERE active AND database = '{}' AND table = '{}'
+GROUP BY partition
+ORDER BY partition""".format(a_database, a_table)
+
+    partitions = []
+    for row in client.query(query_get_partitions_string).result_rows:
+        partitions.append(PartitionInfo(row[0], row[1], str(row[2]), str(row[3]), int(row[4]), int(row[5]),
+                                        [int(row[4]), int(row[6]), int(row[7])]))
+    return partitions
+
+
+def read_cache(a_cache_path):
+    cache = manifest.read_json(a_cache_path) if a_cache_path is not None else None
+    return cache if cache is not None else {}
+
+
+def write_cache(a_cache_path, a_cache):
+    os.makedirs(os.path.dirname(os.path.abspath(a_cache_path)), exist_ok=True)
+    manifest.write_json_atomic(a_cache_path, a_cache)
+
+
+def get_blocks_plan(
+        client,
+        a_database,
+        a_table,
+        a_is_snapshot,
+        a_instrument_white_list,
+        a_date_white_list,
+        a_cache_path=None
+):
+    plan = BlocksPlan()
+    partitions = get_partitions(client, a_database, a_table)
+    if len(partitions) == 0 or any(p.min_date == ZERO_DATE for p in partitions):
+        # not partitioned by date (or not a MergeTree table at all): the dates can only come from the data
+        plan.blocks = utils.get_blocks_plan(client, a_database, a_table, a_is_snapshot, a_instrument_white_list,
+                                            a_date_white_list)
+        return plan
+
+    cache = read_cache(a_cache_path)
+    table_key = "{}.{}".format(a_database, a_table)
+    # cached blocks are valid for the filters they were queried with, or for any filters if they were queried unfiltered
+    filters = [str(a_is_snapshot), list(a_instrument_white_list), list(a_date_white_list)]
+    valid_filters = [filters, [str(a_is_snapshot), [".*"], [".*"]]]
+    table_cache = cache.get(table_key, {})
+    # entries of dropped partitions go away
+    new_table_cache = {p.partition: table_cache[p.partition] for p in partitions if p.partition in table_cache}
+
+    for partition in partitions:
+        if len(utils.filter_list_whitelist(partition.get_dates(), a_date_white_list)) == 0:
+            continue
+        plan.partitions.append(partition)
+
+        cached_partition = table_cache.get(partition.partition)
+        if cached_partition is not None and cached_partition["fingerprint"] == partition.fingerprint and \
+                cached_partition["filters"] in valid_filters:
+            plan.count_cached_partitions += 1
+            rows = [row for row in cached_partition["blocks"]
+                    if len(utils.filter_list_whitelist([row[0]], a_instrument_white_list)) > 0 and
+                    len(utils.filter_list_whitelist([row[1]], a_date_white_list)) > 0]
+        else:
+            plan.count_scanned_partitions += 1
+            rows = []
+            for block in utils.get_blocks_plan(client, a_database, a_table, a_is_snapshot, a_instrument_white_list,
+                                               a_date_white_list, partition.min_date, partition.max_date):
+                rows.append([block[0], block[1], block[2].min_event_time, block[2].max_event_time,
+                             block[2].count_rows])
+            new_table_cache[partition.partition] = {
+                "fingerprint": partition.fingerprint,
+                "filters": filters,
+                "blocks": rows,
+            }
+        for row in rows:
+            plan.blocks.append([row[0], row[1], utils.BlockInfo(row[2], row[3], row[4])])
+
+    if a_cache_path is not None and plan.count_scanned_partitions > 0:
+        cache[table_key] = new_table_cache
+        write_cache(a_cache_path, cache)
+
+    plan.blocks.sort(key=lambda block: [block[0], block[1]])
+    return plan
+
+
+def get_mutation_ids(
+        client,
+        a_database,
+        a_table
+):
+    query_get_mutation_ids_string = "SELECT mutation_id FROM system.mutations WHERE database = '{}' AND table = '{}'" \
+        .format(a_database, a_table)
+    return set(row[0] for row in client.query(query_get_mutation_ids_string).result_rows)
+
+
+class TableClearing:
+    # Clears the rows before a date from one table: partitions holding only older dates are dropped, which just
+    # detaches their parts, and only a partition that straddles the date is rewritten, by a mutation restricted to it.
+    # A table not partitioned by date can only be cleared by a mutation over the whole table.
+    def __init__(self, a_database, a_table, a_date_until):
+        self.database = a_database
+        self.table = a_table
+        self.date_until = a_date_until
+        self.partitions_to_drop = []
+        self.partitions_to_mutate = []
+        self.mutate_whole_table = False
+        self.mutation_ids = []
+        self.error = None  # the exception that stopped run(), the queries before it took effect
+
+    def plan(self, a_client):
+        table_partitions = get_partitions(a_client, self.database, self.table)
+        if any(p.min_date == ZERO_DATE for p in table_partitions):
+            self.mutate_whole_table = True
+            return
+        for partition in table_partitions:
+            if partition.max_date < self.date_until:
+                self.partitions_to_drop.append(partition)
+            elif partition.min_date < self.date_until:
+                self.partitions_to_mutate.append(partition)
+
+    def is_empty(self):
+        return len(self.partitions_to_drop) == 0 and len(self.partitions_to_mutate) == 0 and \
+            not self.mutate_whole_table
+
+    def run(self, a_client):
+        mutation_ids_before = get_mutation_ids(a_client, self.database, self.table)
+        try:
+            for partition in self.partitions_to_drop:
+                a_client.query("ALTER TABLE {}.{} DROP PARTITION ID '{}'".format(self.database, self.table,
+                                                                                 partition.partition_id))
+            for partition in self.partitions_to_mutate:
+                a_client.query("ALTER TABLE {}.{} DELETE IN PARTITION ID '{}' WHERE date < '{}'".format(
+                    self.database, self.table, partition.partition_id, self.date_until))
+            if self.mutate_whole_table:
+                utils.clear_table_by_date(a_client, self.database, self.table, self.date_until)
+        except Exception as e:
+            # e.g. a partition over max_partition_size_to_drop
+            self.error = e
+        # the mutations are only created by the ALTER queries, they run in the background; those started before a
+        # failed query are tracked too
+        self.mutation_ids = sorted(get_mutation_ids(a_client, self.database, self.table) - mutation_ids_before)
+
+    def __str__(self):
+        if self.mutate_whole_table:
+            return "mutation over the whole table (not partitioned by date)"
+        return "drop {} partitions ({} rows), mutate {} partitions ({} rows)".format(
+            len(self.partitions_to_drop),
+            utils.pretty_print_number(sum(p.rows for p in self.partitions_to_drop)),
+            len(self.partitions_to_mutate),
+            utils.pretty_print_number(sum(p.rows for p in self.partitions_to_mutate)))
+
+
+def get_unfinished_mutations(
+        client,
+        a_database,
+        a_table_clearings
+):
+    # [table, mutation_id, parts_to_do, latest_fail_reason] of every mutation started by the clearings and not done yet
+    mutation_keys = ["('{}', '{}')".format(table_clearing.table, mutation_id)
+                     for table_clearing in a_table_clearings for mutation_id in table_clearing.mutation_ids]
+    if len(mutation_keys) == 0:
+        return []
+    query_get_mutations_string = """SELECT
+    table,
+    mutation_id,
+    parts_to_do,
+    latest_fail_reason
+FROM system.mutations
+WHERE database = '{}' AND (table, mutation_id) IN ({}) AND NOT is_done
+ORDER BY table, mutation_id""".format(a_database, ", ".join(mutation_keys))
+    return client.query(query_get_mutations_string).result_rows
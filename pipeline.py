@@ -0,0 +1,96 @@
+import queue
+import threading
+
+QUEUE_SIZE = 2
+QUEUE_POLL_INTERVAL = 0.1
+
+END_OF_STREAM = object()
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+def run_sequential(a_source, a_stages):
+    outputs = []
+    for item in a_source:
+        for stage in a_stages:
+            item = stage(item)
+        outputs.append(item)
+    return outputs
+
+
+def run_pipeline(a_source, a_stages, a_pipelined=True, a_queue_size=QUEUE_SIZE):
+    # Runs a_source (an iterable, e.g. the batch fetching generator) and every function of a_stages in a thread of its
+    # own, connected by bounded queues, so fetching batch N + 1 overlaps with transforming batch N and writing batch
+    # N - 1. Every stage has exactly one thread, so items keep their order (needed by the cross-batch deduplication),
+    # and at most a_queue_size items wait between two stages. Returns the outputs of the last stage, in order.
+    if not a_pipelined:
+        return run_sequential(a_source, a_stages)
+
+    queues = [queue.Queue(maxsize=a_queue_size) for _ in range(len(a_stages))]
+    outputs = []
+    errors = []
+    abort_event = threading.Event()
+
+    def put(a_queue, a_item):
+        while not abort_event.is_set():
+            try:
+                a_queue.put(a_item, timeout=QUEUE_POLL_INTERVAL)
+                return
+            except queue.Full:
+                continue
+        raise PipelineAborted()
+
+    def get(a_queue):
+        while not abort_event.is_set():
+            try:
+                return a_queue.get(timeout=QUEUE_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+        raise PipelineAborted()
+
+    def fail(a_exception):
+        if not isinstance(a_exception, PipelineAborted):
+            errors.append(a_exception)
+        abort_event.set()
+
+    def run_source():
+        source = iter(a_source)
+        try:
+            for item in source:
+                put(queues[0], item)
+            put(queues[0], END_OF_STREAM)
+        except BaseException as e:
+            fail(e)
+        finally:
+            if hasattr(source, "close"):
+                source.close()
+
+    def run_stage(a_stage_id):
+        try:
+            while True:
+                item = get(queues[a_stage_id])
+                if item is END_OF_STREAM:
+                    break
+                item = a_stages[a_stage_id](item)
+                if a_stage_id + 1 < len(a_stages):
+                    put(queues[a_stage_id + 1], item)
+                else:
+                    outputs.append(item)
+            if a_stage_id + 1 < len(a_stages):
+                put(queues[a_stage_id + 1], END_OF_STREAM)
+        except BaseException as e:
+            fail(e)
+
+    threads = [threading.Thread(target=run_source, daemon=True)]
+    for stage_id in range(len(a_stages)):
+        threads.append(threading.Thread(target=run_stage, args=(stage_id,), daemon=True))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+    return outputs
@@ -0,0 +1,164 @@
+import multiprocessing
+import random
+import re
+import time
+
+from clickhouse_connect.driver.exceptions import OperationalError, StreamFailureError
+
+# Failed queries are retried with exponential backoff and full jitter, up to MAX_ATTEMPTS times in a row, and only for
+# errors that can go away by themselves (network, timeouts, an overloaded server). Every failure and success is also
+# counted by the circuit breaker of the endpoint (host:port), shared by all workers: after BREAKER_FAILURE_THRESHOLD
+# consecutive failures against it, every worker waits BREAKER_COOLDOWN before its next attempt, instead of each one
+# hammering a sick server. With --failover, workers give the block up instead, so it can be moved to another replica.
+
+MAX_ATTEMPTS = 8
+BASE_DELAY = 0.5  # seconds
+MAX_DELAY = 60.0
+QUERY_TIMEOUT = 300  # seconds, max_execution_time of a batch query and socket timeout of the client
+
+BREAKER_FAILURE_THRESHOLD = 10
+BREAKER_COOLDOWN = 30.0
+BREAKER_JITTER = 5.0  # so the workers do not all come back at the same instant
+
+# ClickHouse error codes worth retrying: timeouts, network errors, too many queries / parts, memory limits, replicas
+RETRYABLE_SERVER_CODES = {3, 159, 160, 202, 203, 209, 210, 241, 242, 252, 285, 319, 394, 425, 999}
+
+circuit_breakers = {}
+
+
+class RetriesExhaustedError(Exception):
+    pass
+
+
+class EndpointUnavailableError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Lives in shared memory, so one instance created before the workers are forked (or started as threads) is shared
+    # by all of them.
+    def __init__(self, a_mp_context=multiprocessing):
+        self.consecutive_failures = a_mp_context.Value('i', 0)
+        self.open_until = a_mp_context.Value('d', 0.0)
+
+    def get_open_until(self):
+        with self.open_until.get_lock():
+            return self.open_until.value
+
+    def is_open(self):
+        return self.get_open_until() > time.time()
+
+    def wait(self, a_quiet):
+        # utils imports this module, so it can only be imported once both are loaded
+        import utils
+
+        while True:
+            with self.open_until.get_lock():
+                remaining_time = self.open_until.value - time.time()
+            if remaining_time <= 0:
+                return
+            utils.quiet_print(a_quiet, "Circuit breaker open, waiting {:0.1f} s...".format(remaining_time))
+            time.sleep(remaining_time + random.uniform(0, BREAKER_JITTER))
+
+    def record_success(self):
+        with self.consecutive_failures.get_lock():
+            self.consecutive_failures.value = 0
+
+    def record_failure(self):
+        with self.consecutive_failures.get_lock():
+            self.consecutive_failures.value += 1
+            # stays above the threshold after the cooldown, so the first failure after it opens the breaker again
+            if self.consecutive_failures.value >= BREAKER_FAILURE_THRESHOLD:
+                with self.open_until.get_lock():
+                    self.open_until.value = max(self.open_until.value, time.time() + BREAKER_COOLDOWN)
+
+
+def get_endpoint_name(a_host, a_port):
+    return "{}:{}".format(a_host, a_port)
+
+
+def set_circuit_breakers(a_circuit_breakers):
+    global circuit_breakers
+    circuit_breakers = a_circuit_breakers
+
+
+def get_circuit_breaker(a_endpoint_name):
+    # the executor creates the breakers of all endpoints before starting the workers, a standalone
+    # clickhouse_dumper.py run gets its own
+    if a_endpoint_name not in circuit_breakers:
+        circuit_breakers[a_endpoint_name] = CircuitBreaker()
+    return circuit_breakers[a_endpoint_name]
+
+
+def get_server_code(a_exception):
+    code = re.search(r"Code: (\d+)\.", str(a_exception))
+    return int(code.group(1)) if code is not None else None
+
+
+def is_retryable(a_exception):
+    server_code = get_server_code(a_exception)
+    if server_code is not None:
+        return server_code in RETRYABLE_SERVER_CODES
+    http_status = re.search(r"response code (\d+)", str(a_exception))
+    if http_status is not None:
+        return int(http_status.group(1)) in (429, 502, 503, 504)
+    # anything else (a syntax error, a missing table, a bug of ours) fails the same way on every attempt
+    return isinstance(a_exception, (OperationalError, StreamFailureError, ConnectionError, TimeoutError))
+
+
+def get_backoff_delay(a_attempt):
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** a_attempt))
+
+
+class Retrier:
+    # The retry state of one operation: a query, or a stream that is reopened where it failed. on_success resets the
+    # attempt count, so a long stream that makes progress between failures is not given up on.
+    def __init__(self, args, a_description):
+        self.quiet = args.quiet
+        self.description = a_description
+        self.endpoint_name = get_endpoint_name(args.host, args.port)
+        self.circuit_breaker = get_circuit_breaker(self.endpoint_name)
+        self.failover = args.failover
+        self.attempt = 0
+
+    def before_attempt(self):
+        if self.failover and self.circuit_breaker.is_open():
+            raise EndpointUnavailableError("{}: circuit breaker open".format(self.endpoint_name))
+        self.circuit_breaker.wait(self.quiet)
+
+    def on_success(self):
+        self.circuit_breaker.record_success()
+        self.attempt = 0
+
+    def on_failure(self, a_exception):
+        # called from an except block: raises if the operation must not be retried, sleeps otherwise
+        if not is_retryable(a_exception):
+            raise a_exception
+        self.circuit_breaker.record_failure()
+        if self.failover and self.circuit_breaker.is_open():
+            raise EndpointUnavailableError("{}: circuit breaker open".format(self.endpoint_name)) from a_exception
+        self.attempt += 1
+        if self.attempt >= MAX_ATTEMPTS:
+            raise RetriesExhaustedError("{} failed {} times in a row".format(self.description,
+                                                                           self.attempt)) from a_exception
+        # see CircuitBreaker.wait
+        import utils
+
+        delay = get_backoff_delay(self.attempt)
+        utils.quiet_print(self.quiet, "Exception: {}".format(a_exception))
+        utils.quiet_print(self.quiet, "Retrying {} in {:0.1f} s (attempt {} of {})...".format(
+            self.description, delay, self.attempt + 1, MAX_ATTEMPTS))
+        time.sleep(delay)
+
+
+def call_with_retry(args, a_description, a_function):
+    retrier = Retrier(args, a_description)
+    while True:
+        retrier.before_attempt()
+        try:
+            result = a_function()
+        except Exception as e:
+            retrier.on_failure(e)
+            continue
+        retrier.on_success()
+        return result
@@ -0,0 +1,125 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import executor
+import retry
+import utils
+
+# Blocks are handed out largest first (LPT: longest processing time first), by planned row count, so that the few huge
+# blocks (BTCUSDT days) start right away and the run ends on small blocks that fill the gaps, instead of 28 idle
+# workers waiting for the last two. Each block goes to the replica expected to finish it soonest, among the ones below
+# their own limit of blocks in flight and whose circuit breaker is closed. A block that fails because of its replica
+# is queued again for another one. The scheduler sleeps in wait() until a block finishes, it never polls.
+
+ENDPOINT_SMOOTHING = 0.3  # weight of the last block in the seconds per row of an endpoint
+
+
+def get_planned_rows(a_block):
+    # a planned block is [instrument, date, BlockInfo], a bare [instrument, date] has no known size
+    return a_block[2].count_rows if len(a_block) > 2 else 0
+
+
+def order_longest_first(a_blocks):
+    return sorted(a_blocks, key=get_planned_rows, reverse=True)
+
+
+class EndpointState:
+    def __init__(self, a_endpoint, a_max_in_flight, a_circuit_breaker):
+        self.endpoint = a_endpoint
+        self.name = retry.get_endpoint_name(a_endpoint[0], a_endpoint[1])
+        self.max_in_flight = a_max_in_flight
+        self.circuit_breaker = a_circuit_breaker
+        self.in_flight = 0
+        self.seconds_per_row = None  # observed on the blocks it finished, None until the first one
+
+    def is_available(self):
+        return self.in_flight < self.max_in_flight and not self.circuit_breaker.is_open()
+
+    def get_expected_load(self):
+        # an endpoint without measurements yet is tried first, then endpoints are compared by how long their queue
+        # takes at the speed they showed so far
+        seconds_per_row = self.seconds_per_row if self.seconds_per_row is not None else 0.0
+        return [(self.in_flight + 1) * seconds_per_row, self.in_flight]
+
+    def on_block_done(self, a_result, a_planned_rows):
+        self.in_flight -= 1
+        if a_result.ok() and a_planned_rows > 0:
+            seconds_per_row = a_result.elapsed_time / a_planned_rows
+            if self.seconds_per_row is None:
+                self.seconds_per_row = seconds_per_row
+            else:
+                self.seconds_per_row = (1 - ENDPOINT_SMOOTHING) * self.seconds_per_row + \
+                                       ENDPOINT_SMOOTHING * seconds_per_row
+
+
+class BlockScheduler:
+    def __init__(self, a_block_executor, a_blocks, a_max_in_flight, a_endpoints, a_max_in_flight_per_endpoint):
+        self.block_executor = a_block_executor
+        # [block, names of the endpoints it failed on], a stack with the largest block last
+        self.pending_blocks = [[block, []] for block in reversed(order_longest_first(a_blocks))]
+        self.max_in_flight = a_max_in_flight
+        self.endpoints = []
+        for endpoint in a_endpoints:
+            circuit_breaker = a_block_executor.circuit_breakers[retry.get_endpoint_name(endpoint[0], endpoint[1])]
+            self.endpoints.append(EndpointState(endpoint, a_max_in_flight_per_endpoint, circuit_breaker))
+        self.in_flight = {}
+
+    def choose_endpoint(self, a_excluded_endpoint_names):
+        candidates = [endpoint for endpoint in self.endpoints
+                      if endpoint.is_available() and endpoint.name not in a_excluded_endpoint_names]
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key=lambda endpoint: endpoint.get_expected_load())
+
+    def submit_pending(self):
+        position = len(self.pending_blocks) - 1
+        while position >= 0 and len(self.in_flight) < self.max_in_flight:
+            block, excluded_endpoint_names = self.pending_blocks[position]
+            endpoint = self.choose_endpoint(excluded_endpoint_names)
+            if endpoint is None:
+                # no endpoint for this one right now, the next smaller block may still fit elsewhere
+                position -= 1
+                continue
+            self.pending_blocks.pop(position)
+            position -= 1
+            endpoint.in_flight += 1
+            future = self.block_executor.submit(block, endpoint.endpoint)
+            self.in_flight[future] = [block, excluded_endpoint_names, endpoint]
+
+    def get_time_until_available(self):
+        open_until = [endpoint.circuit_breaker.get_open_until() for endpoint in self.endpoints
+                      if endpoint.circuit_breaker.is_open()]
+        return max(0.0, min(open_until) - time.time()) if len(open_until) > 0 else 0.0
+
+    def results(self):
+        # yields [block, executor.BlockResult] in completion order, once per block
+        while len(self.in_flight) > 0 or len(self.pending_blocks) > 0:
+            self.submit_pending()
+            if len(self.in_flight) == 0:
+                # every endpoint a pending block can go to is paused by its circuit breaker
+                time.sleep(self.get_time_until_available() + 1.0)
+                continue
+
+            done_futures, _ = wait(self.in_flight, return_when=FIRST_COMPLETED)
+            finished_blocks = []
+            for future in done_futures:
+                block, excluded_endpoint_names, endpoint = self.in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:  # the worker itself died (e.g. a killed process)
+                    result = executor.BlockResult(block[0], block[1], 0, 0.0, repr(e))
+                endpoint.on_block_done(result, get_planned_rows(block))
+
+                if result.endpoint_failure and len(excluded_endpoint_names) + 1 < len(self.endpoints):
+                    utils.quiet_print(False, utils.make_red("Block: Instrument: {}, Date: {} failed on {}, moving it "
+                                                            "to another replica: {}".format(
+                                                                block[0], block[1], endpoint.name,
+                                                                result.get_error_summary())))
+                    self.pending_blocks.append([block, excluded_endpoint_names + [endpoint.name]])
+                    continue
+                finished_blocks.append([block, result])
+
+            # refill the freed slots before the caller handles the results
+            self.submit_pending()
+            for finished_block in finished_blocks:
+                yield finished_block
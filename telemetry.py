@@ -0,0 +1,231 @@
+import json
+import os
+import socket
+import threading
+import time
+
+# Per-batch and per-block performance records. Workers append them as JSON lines to --telemetry_path (one os.write per
+# line on an O_APPEND file, so lines of concurrent workers do not interleave); threader.py aggregates the block records
+# it gets back from the workers into a per-worker report and, optionally, a Prometheus textfile.
+
+STAGE_TIMES = ["fetch_time", "build_time", "sort_time", "format_time", "write_time"]
+
+
+class BatchStats:
+    def __init__(self, a_batch_id):
+        self.batch_id = a_batch_id
+        self.fetch_time = 0.0
+        # bytes of the query result on the wire, not known per block when streaming (text or arrow)
+        self.bytes_received = None
+        self.rows_in = 0
+        self.rows_written = 0
+        self.build_time = 0.0
+        self.sort_time = 0.0
+        self.format_time = 0.0
+        self.write_time = 0.0
+
+    def to_record(self, a_block_stats):
+        # the stages of a pipelined batch run in threads of their own, the batch belongs to the worker of its block
+        return {
+            "type": "batch",
+            "instrument": a_block_stats.instrument,
+            "date": a_block_stats.date,
+            "worker": a_block_stats.worker,
+            "batch_id": self.batch_id,
+            "fetch_time": self.fetch_time,
+            "bytes_received": self.bytes_received,
+            "rows_in": self.rows_in,
+            "rows_written": self.rows_written,
+            "build_time": self.build_time,
+            "sort_time": self.sort_time,
+            "format_time": self.format_time,
+            "write_time": self.write_time,
+            "time": time.time(),
+        }
+
+
+class BlockStats:
+    def __init__(self, a_instrument, a_date):
+        self.instrument = a_instrument
+        self.date = a_date
+        self.worker = get_worker_name()
+        self.start_time = time.time()
+        self.total_time = 0.0
+        self.count_batches = 0
+        self.bytes_received = None  # None while no batch of the block knew it
+        self.rows_in = 0
+        self.rows_written = 0
+        self.fetch_time = 0.0
+        self.build_time = 0.0
+        self.sort_time = 0.0
+        self.format_time = 0.0
+        self.write_time = 0.0
+        self.compress_time = 0.0
+        self.skipped = False
+
+    def add_batch(self, a_batch_stats):
+        self.count_batches += 1
+        self.bytes_received = add_bytes(self.bytes_received, a_batch_stats.bytes_received)
+        self.rows_in += a_batch_stats.rows_in
+        self.rows_written += a_batch_stats.rows_written
+        self.fetch_time += a_batch_stats.fetch_time
+        self.build_time += a_batch_stats.build_time
+        self.sort_time += a_batch_stats.sort_time
+        self.format_time += a_batch_stats.format_time
+        self.write_time += a_batch_stats.write_time
+
+    def finish(self):
+        self.total_time = time.time() - self.start_time
+
+    def to_record(self):
+        return {
+            "type": "block",
+            "instrument": self.instrument,
+            "date": self.date,
+            "worker": self.worker,
+            "start_time": self.start_time,
+            "total_time": self.total_time,
+            "count_batches": self.count_batches,
+            "bytes_received": self.bytes_received,
+            "rows_in": self.rows_in,
+            "rows_written": self.rows_written,
+            "fetch_time": self.fetch_time,
+            "build_time": self.build_time,
+            "sort_time": self.sort_time,
+            "format_time": self.format_time,
+            "write_time": self.write_time,
+            "compress_time": self.compress_time,
+            "time": time.time(),
+        }
+
+
+def add_bytes(a_bytes, a_more_bytes):
+    # sums of received bytes stay None (unknown) until some are known
+    if a_more_bytes is None:
+        return a_bytes
+    return a_more_bytes if a_bytes is None else a_bytes + a_more_bytes
+
+
+def format_megabytes(a_bytes, a_format="{:0.1f}"):
+    return "n/a" if a_bytes is None else a_format.format(a_bytes / 1e6)
+
+
+def get_worker_name():
+    # a worker process, or a thread of the process with the thread executor (USE_PROCESSES = 0)
+    worker_name = "{}:{}".format(socket.gethostname(), os.getpid())
+    if threading.current_thread() is not threading.main_thread():
+        worker_name += ":{}".format(threading.current_thread().name)
+    return worker_name
+
+
+def emit(a_telemetry_path, a_record):
+    if a_telemetry_path is None:
+        return
+    line = (json.dumps(a_record, sort_keys=True) + "\n").encode("utf-8")
+    fd = os.open(a_telemetry_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+class WorkerStats:
+    def __init__(self, a_worker):
+        self.worker = a_worker
+        self.count_blocks = 0
+        self.busy_time = 0.0
+        self.bytes_received = None
+        self.rows_in = 0
+        self.rows_written = 0
+        self.stage_times = {stage: 0.0 for stage in STAGE_TIMES + ["compress_time"]}
+
+    def add_block(self, a_block_stats):
+        self.count_blocks += 1
+        self.busy_time += a_block_stats.total_time
+        self.bytes_received = add_bytes(self.bytes_received, a_block_stats.bytes_received)
+        self.rows_in += a_block_stats.rows_in
+        self.rows_written += a_block_stats.rows_written
+        for stage in self.stage_times:
+            self.stage_times[stage] += getattr(a_block_stats, stage)
+
+    def rows_per_second(self):
+        return self.rows_in / self.busy_time if self.busy_time > 0 else 0.0
+
+
+def aggregate(a_blocks_stats):
+    workers_stats = {}
+    for block_stats in a_blocks_stats:
+        if block_stats.worker not in workers_stats:
+            workers_stats[block_stats.worker] = WorkerStats(block_stats.worker)
+        workers_stats[block_stats.worker].add_block(block_stats)
+    # slowest first
+    return sorted(workers_stats.values(), key=lambda w: w.rows_per_second())
+
+
+def print_report(a_blocks_stats, a_wall_time):
+    workers_stats = aggregate(a_blocks_stats)
+    total_rows = sum(w.rows_in for w in workers_stats)
+    # not known when streaming (STREAMING = 1 or parquet / arrow output), shown as n/a rather than 0
+    total_bytes = None
+    for worker_stats in workers_stats:
+        total_bytes = add_bytes(total_bytes, worker_stats.bytes_received)
+
+    table_width = 100
+    print("{:^100}".format("Throughput report ({} blocks, {} workers)".format(len(a_blocks_stats),
+                                                                          len(workers_stats))))
+    print("-" * table_width)
+    print("{:27}|{:^8}|{:^12}|{:^12}|{:^12}|{:^24}|".format("Worker (slowest first)", "Blocks", "Rows",
+                                                             "Rows/s", "MB recv", "fetch/format/write %"))
+    print("-" * table_width)
+    for worker_stats in workers_stats:
+        busy_time = worker_stats.busy_time if worker_stats.busy_time > 0 else 1.0
+        print("{:27}|{:^8}|{:^12}|{:^12}|{:^12}|{:^24}|".format(
+            worker_stats.worker[-27:],
+            worker_stats.count_blocks,
+            str(worker_stats.rows_in),
+            "{:0.0f}".format(worker_stats.rows_per_second()),
+            format_megabytes(worker_stats.bytes_received),
+            "{:0.0f} / {:0.0f} / {:0.0f}".format(
+                worker_stats.stage_times["fetch_time"] / busy_time * 100,
+                (worker_stats.stage_times["build_time"] + worker_stats.stage_times["sort_time"] +
+                 worker_stats.stage_times["format_time"]) / busy_time * 100,
+                worker_stats.stage_times["write_time"] / busy_time * 100),
+        ))
+    print("-" * table_width)
+    if a_wall_time > 0:
+        print("Total: {} rows, {} MB received, {:0.0f} rows/s, {} MB/s".format(
+            total_rows, format_megabytes(total_bytes), total_rows / a_wall_time,
+            format_megabytes(total_bytes / a_wall_time if total_bytes is not None else None, "{:0.2f}")))
+
+
+def write_prometheus_textfile(a_file_path, a_blocks_stats):
+    lines = []
+    metrics = [
+        ["clickhouse_dumper_blocks_total", "counter", "Blocks dumped", lambda w: w.count_blocks],
+        ["clickhouse_dumper_rows_in_total", "counter", "Rows received", lambda w: w.rows_in],
+        ["clickhouse_dumper_rows_written_total", "counter", "Rows written after deduplication",
+         lambda w: w.rows_written],
+        ["clickhouse_dumper_bytes_received_total", "counter", "Bytes received", lambda w: w.bytes_received],
+        ["clickhouse_dumper_busy_seconds_total", "counter", "Time spent processing blocks", lambda w: w.busy_time],
+    ]
+    workers_stats = aggregate(a_blocks_stats)
+    for name, metric_type, help_text, getter in metrics:
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        for worker_stats in workers_stats:
+            # no sample at all for a value that is not known
+            if getter(worker_stats) is not None:
+                lines.append('{}{{worker="{}"}} {}'.format(name, worker_stats.worker, getter(worker_stats)))
+    name = "clickhouse_dumper_stage_seconds_total"
+    lines.append("# HELP {} Time spent per stage".format(name))
+    lines.append("# TYPE {} counter".format(name))
+    for worker_stats in workers_stats:
+        for stage, stage_time in worker_stats.stage_times.items():
+            lines.append('{}{{worker="{}",stage="{}"}} {}'.format(name, worker_stats.worker, stage[:-len("_time")],
+                                                               stage_time))
+
+    # node_exporter reads textfiles at any moment, so the file is replaced atomically
+    temp_file_path = a_file_path + ".tmp"
+    with open(temp_file_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temp_file_path, a_file_path)
@@ -1,9 +1,13 @@
 import datetime
-import subprocess
 import time
-import threading
 import clickhouse_connect
 
+import batch
+import executor
+import manifest
+import partitions
+import scheduler
+import telemetry
 import utils
 
 ##############################################
@@ -11,42 +15,69 @@ import utils
 JUST_PRINT = 0
 
 NUM_THREADS = 30
+MAX_BLOCKS_PER_ENDPOINT = 30  # blocks dumped at the same time from one replica
+USE_PROCESSES = 1  # 0 runs the workers as threads of this process
 INTENDED_BATCH_SIZE = 20000
 
 ROOT_FOLDER_PATH = "./binance_futures_all_instruments_2022-11-12_2023-01-08"
 
 DATABASE = "restore_binance_futures_history_backup_all_tables_08_01_2023"
 TABLE = "uDepthUpdates"
+COLUMNS = batch.DEFAULT_COLUMNS  # dumped after eventTime, e.g. ["price", "quantity"] for trades
 IS_SNAPSHOT = 1
 INSTRUMENTS_WHITE_LIST = ['.*']
 DATE_WHITE_LIST = ['.*']
 
-HOST = "clickhouse.giant.agtrading.ru"
+HOST = "clickhouse.giant.agtrading.ru"  # used for planning
 PORT = 443
+# replicas the blocks are spread over, [host, port] each; with more than one, a block whose replica fails is moved
+# to another one
+ENDPOINTS = [[HOST, PORT]]
 
 QUIET = 1
 USE_GZIP = 1
+CODEC = "gzip"  # gzip, zstd, lz4 or none
+COMPRESSION_LEVEL = 9
+COMPRESSION_THREADS = 2  # per worker
+# eventTime units, text streams are cut into chunks at every multiple of it, so that the block index can point a reader
+# to the start of any such window (0: chunks only end when a buffer is full)
+INDEX_INTERVAL = 0
+OUTPUT_FORMAT = "text"  # text, delta (binary, see delta_codec.py), parquet or arrow
+STREAMING = 1  # one ordered query per block instead of one query per time interval
+PIPELINED = 1  # fetch, format and write/compress batches in overlapping stages
+# orders the rows of an eventTime, None (or a table without it) keeps the first one the server returns
+ORDER_COLUMN = batch.DEFAULT_ORDER_COLUMN
+PUSHDOWN = 0  # 1 lets the server order and deduplicate the rows (ORDER BY eventTime, ORDER_COLUMN LIMIT 1 BY eventTime)
+VERIFY_PUSHDOWN = 0  # 1 also dumps every block client side and fails it if the outputs differ (twice the queries)
+# histogram (row balanced batches), uniform (equal eventTime slices) or adaptive (sized on the fly from the measured
+# fetch time and bytes per row, INTENDED_BATCH_SIZE is only the first guess), without STREAMING
+BATCH_PLANNER = "histogram"
+FORCE = 0  # 1 re-dumps blocks that already have a complete manifest
+# 1 appends the rows after the last dumped eventTime to complete blocks instead of skipping them, e.g. from cron for
+# today's blocks with DATE_WHITE_LIST
+INCREMENTAL = 0
+VERIFY_CHECKSUMS = 0  # 1 re-reads existing blocks to check them against their manifest before skipping them
+PLAN_CACHE_PATH = "./plan_cache.json"  # symbols of every unchanged partition, None scans all partitions every run
+QUERY_TIMEOUT = 300  # seconds, per batch query and per socket read of a stream
+TELEMETRY_PATH = None  # per-batch and per-block JSON lines are appended here, e.g. "./telemetry.jsonl"
+PROMETHEUS_TEXTFILE_PATH = None  # e.g. "/var/lib/node_exporter/textfile_collector/clickhouse_dumper.prom"
 ##############################################
 
 utils.quiet_print(False, "Attempting to connect...", end="\t")
-client = clickhouse_connect.get_client(host=HOST, port=PORT, username='default', password='')
+client = clickhouse_connect.get_client(host=HOST, port=PORT, username='default', password='',
+                                       send_receive_timeout=QUERY_TIMEOUT)
 utils.quiet_print(False, "Connected to ClickHouse!\n")
 
-utils.quiet_print(False, "Getting instruments...", end="\t")
-instruments = utils.get_instruments(client, DATABASE, TABLE)
-instruments = utils.filter_list_whitelist(instruments, INSTRUMENTS_WHITE_LIST)
-instruments.sort()
-utils.quiet_print(False, "Got {} instruments after filtering!\n".format(len(instruments)))
+# fails before planning if a column is missing, and the forked workers inherit the table schema
+utils.get_column_layout(client, DATABASE, TABLE, COLUMNS)
 
-instrument_dates = {}
-
-for instrument in instruments:
-    utils.quiet_print(False, "Getting dates for instrument {0:20}".format(instrument + "..."), end="\t")
-    instrument_dates[instrument] = utils.get_instrument_dates(client, DATABASE, TABLE, instrument)
-    instrument_dates[instrument] = utils.filter_list_whitelist(instrument_dates[instrument], DATE_WHITE_LIST)
-    instrument_dates[instrument].sort()
-    utils.quiet_print(False, "Got {} dates after filtering!".format(len(instrument_dates[instrument])))
-utils.quiet_print(False, )
+utils.quiet_print(False, "Planning blocks...", end="\t")
+blocks_plan = partitions.get_blocks_plan(client, DATABASE, TABLE, IS_SNAPSHOT, INSTRUMENTS_WHITE_LIST, DATE_WHITE_LIST,
+                                         PLAN_CACHE_PATH)
+blocks = blocks_plan.blocks
+instrument_dates = utils.get_instrument_dates_from_plan(blocks)
+utils.quiet_print(False, "Got {} blocks for {} instruments after filtering, from {}!\n".format(
+    len(blocks), len(instrument_dates), blocks_plan.get_summary()))
 
 utils.quiet_print(False,
                   "====================================================================================================")
@@ -58,96 +89,117 @@ utils.quiet_print(False,
 if JUST_PRINT:
     exit()
 
-blocks = []
-
-for instrument in instruments:
-    for date in instrument_dates[instrument]:
-        blocks.append([instrument, date])
-
-blocks.reverse()  # to pop from the 'beginning'
+if not FORCE and not INCREMENTAL:
+    interrupted_blocks = manifest.get_in_progress_blocks(ROOT_FOLDER_PATH)
+    if len(interrupted_blocks) > 0:
+        utils.quiet_print(False, "Found {} interrupted blocks, they will be redone: {}".format(len(interrupted_blocks),
+                                                                                         interrupted_blocks))
+    count_blocks = len(blocks)
+    blocks = manifest.filter_complete_blocks(ROOT_FOLDER_PATH, blocks, VERIFY_CHECKSUMS)
+    utils.quiet_print(False, "Skipping {} already complete blocks!\n".format(count_blocks - len(blocks)))
 
 total_blocks = len(blocks)
 processed_blocks = 0
+total_rows = sum(scheduler.get_planned_rows(block) for block in blocks)
+processed_rows = 0
 count_errors = 0
 
-
-def launch_thread(a_block):
-    global processed_blocks, count_errors
-
-    command_array_copy = command_array.copy()
-    command_array_copy.append("--dump_one_block")
-    command_array_copy.extend(a_block)
-    utils.quiet_print(False, "Launching thread for block: {}".format(a_block))
-    p = subprocess.Popen(command_array_copy,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT)
-
-    for line in iter(p.stdout.readline, b''):
-        utils.quiet_print(False, line.decode('utf-8').rstrip())
-    while p.poll() is None:
-        time.sleep(0.1)
-    if p.returncode != 0:
-        utils.quiet_print(False, utils.make_red(
-            "Error while processing block: Instrument: {}, Date: {}, return code: {}".format(a_block[0], a_block[1],
-                                                                                             p.returncode)))
-        count_errors += 1
-    processed_blocks += 1
-
-
 utils.quiet_print(False, "{:^100}".format(
-    "Starting processing of {} blocks in up to {} threads:".format(total_blocks, NUM_THREADS)))
+    "Starting processing of {} blocks ({} rows) in up to {} workers on {} endpoints, largest first:".format(
+        total_blocks, utils.pretty_print_number(total_rows), NUM_THREADS, len(ENDPOINTS))))
 utils.quiet_print(False,
                   "====================================================================================================\n")
 
 ##############################################
-# Create command array:
-command_array = [
-    "python3", "clickhouse_dumper.py",
+# Create dumper arguments:
+dumper_arguments = [
     "--root_folder_path", ROOT_FOLDER_PATH,
     "--intended_batch_size", str(INTENDED_BATCH_SIZE),
     "--database", DATABASE,
     "--table", TABLE,
     "--is_snapshot", str(IS_SNAPSHOT),
     "--host", HOST,
-    "--port", str(PORT)
-]
+    "--port", str(PORT),
+    "--output_format", OUTPUT_FORMAT,
+    "--batch_planner", BATCH_PLANNER,
+    "--query_timeout", str(QUERY_TIMEOUT),
+    "--columns"
+] + COLUMNS
 if QUIET:
-    command_array.append("--quiet")
+    dumper_arguments.append("--quiet")
 
 if USE_GZIP:
-    command_array.append("--use_gzip")
+    dumper_arguments.append("--use_gzip")
+
+dumper_arguments.extend(["--codec", CODEC,
+                         "--compression_level", str(COMPRESSION_LEVEL),
+                         "--compression_threads", str(COMPRESSION_THREADS),
+                         "--index_interval", str(INDEX_INTERVAL)])
+
+if STREAMING:
+    dumper_arguments.append("--streaming")
+
+if PIPELINED:
+    dumper_arguments.append("--pipelined")
+
+if ORDER_COLUMN is not None:
+    dumper_arguments.extend(["--order_column", ORDER_COLUMN])
+else:
+    dumper_arguments.append("--order_column")
+
+if PUSHDOWN:
+    dumper_arguments.append("--pushdown")
+
+if VERIFY_PUSHDOWN:
+    dumper_arguments.append("--verify_pushdown")
+
+if TELEMETRY_PATH is not None:
+    dumper_arguments.extend(["--telemetry_path", TELEMETRY_PATH])
+
+if INCREMENTAL:
+    dumper_arguments.append("--incremental")
+
+if len(ENDPOINTS) > 1:
+    dumper_arguments.append("--failover")
 ##############################################
+args = utils.get_args_parser().parse_args(dumper_arguments)
 
 process_blocks_start_time = time.time()
 
-for i in range(NUM_THREADS):
-    if len(blocks) == 0:
-        break
-    block = blocks.pop()
-    t = threading.Thread(target=launch_thread, args=(block,))
-    t.start()
-    time.sleep(0.1)
-
-processed_blocks_registered = 0
-
-# Active wait for threads to finish, launch new threads if any blocks left:
-while True:
-    while processed_blocks_registered == processed_blocks:
-        time.sleep(0.01)
-    processed_blocks_registered = processed_blocks
-    utils.print_progress(total_blocks, processed_blocks, process_blocks_start_time)
-    if processed_blocks == total_blocks:
-        break
-    if len(blocks) > 0:
-        block = blocks.pop()
-        t = threading.Thread(target=launch_thread, args=(block,))
-        t.start()
+block_executor = executor.BlockExecutor(args, NUM_THREADS, USE_PROCESSES, ENDPOINTS)
+block_scheduler = scheduler.BlockScheduler(block_executor, blocks, NUM_THREADS, ENDPOINTS, MAX_BLOCKS_PER_ENDPOINT)
+blocks_stats = []
+failed_blocks = []
+
+for block, result in block_scheduler.results():
+    processed_blocks += 1
+    processed_rows += scheduler.get_planned_rows(block)
+    if not result.ok():
+        utils.quiet_print(False, utils.make_red(
+            "Error while processing block: Instrument: {}, Date: {}\n{}".format(result.instrument, result.date,
+                                                                               result.error)))
+        count_errors += 1
+        failed_blocks.append(result)
+    else:
+        blocks_stats.append(result.stats)
+    utils.print_progress(total_blocks, processed_blocks, total_rows, processed_rows, process_blocks_start_time)
+
+block_executor.shutdown()
 
 utils.quiet_print(False,
                   "====================================================================================================")
 if count_errors > 0:
-    utils.quiet_print(False, utils.make_red("Finished with {} errors!".format(count_errors)))
-utils.quiet_print(False, "All threads finished! Done in {} (h:m:s).".format(
+    utils.quiet_print(False, utils.make_red("Finished with {} errors! Failed blocks, redone on the next run:".format(
+        count_errors)))
+    for result in failed_blocks:
+        utils.quiet_print(False, utils.make_red("\t{:20} {:10} {}".format(result.instrument, str(result.date),
+                                                                          result.get_error_summary())))
+utils.quiet_print(False, "All workers finished! Done in {} (h:m:s).".format(
     datetime.timedelta(seconds=int(time.time() - process_blocks_start_time))))
+utils.quiet_print(False,
+                  "====================================================================================================")
+telemetry.print_report(blocks_stats, time.time() - process_blocks_start_time)
+if PROMETHEUS_TEXTFILE_PATH is not None:
+    telemetry.write_prometheus_textfile(PROMETHEUS_TEXTFILE_PATH, blocks_stats)
 utils.quiet_print(False,
                   "====================================================================================================\n")
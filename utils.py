@@ -1,13 +1,83 @@
+import copy
 import datetime
-import gzip
 import os
 import glob
 import re
+import shutil
 import sys
+import threading
 import time
 import random
+from argparse import ArgumentParser
+
+import numpy as np
+
+import batch
+import batch_sizing
+import compression
+import delta_codec
+import manifest
+import pipeline
+import retry
+import telemetry
 
 MAX_BUFFER_LIMIT = 1000000
+table_schemas = {}
+thread_clients = threading.local()
+HISTOGRAM_BUCKETS_PER_BATCH = 16
+
+
+def get_args_parser():
+    parser = ArgumentParser()
+    parser.add_argument("--root_folder_path", dest="root_folder_path", default='./data', nargs='?')
+    parser.add_argument("--intended_batch_size", dest="intended_batch_size", default=100000, nargs='?', type=int)
+    parser.add_argument("--database", dest="database", nargs='?', required=True)
+    parser.add_argument("--table", dest="table", nargs='?', required=True)
+    parser.add_argument("--is_snapshot", dest="is_snapshot", default=1, nargs='?')
+    parser.add_argument("--host", dest="host", default="clickhouse.giant.agtrading.ru", nargs='?')
+    parser.add_argument("--port", dest="port", default=443, nargs='?', type=int)
+    parser.add_argument("--dump_one_block", dest="dump_one_block", default=None, nargs='+')
+    parser.add_argument("--instrument_white_list", dest="instrument_white_list", default=['.*'], nargs='+')
+    parser.add_argument("--date_white_list", dest="date_white_list", default=['.*'], nargs='+')
+    # dumped columns, each one into its own stream, after batch.TIME_COLUMN which is always dumped first
+    parser.add_argument("--columns", dest="columns", default=batch.DEFAULT_COLUMNS, nargs='+')
+    parser.add_argument("--quiet", dest="quiet", const=1, default=0, nargs='?')
+    parser.add_argument("--use_gzip", dest="use_gzip", const=1, default=0, nargs='?')
+    # text output compression, defaults to gzip with --use_gzip and to none without it
+    parser.add_argument("--codec", dest="codec", default=None, nargs='?', choices=compression.CODECS)
+    parser.add_argument("--compression_level", dest="compression_level", default=None, nargs='?', type=int)
+    # threads compressing chunks in parallel in every worker, 0 compresses inline
+    parser.add_argument("--compression_threads", dest="compression_threads", default=2, nargs='?', type=int)
+    parser.add_argument("--output_format", dest="output_format", default="text", nargs='?',
+                        choices=["text", "delta", "parquet", "arrow"])
+    parser.add_argument("--streaming", dest="streaming", const=1, default=0, nargs='?')
+    parser.add_argument("--pipelined", dest="pipelined", const=1, default=0, nargs='?')
+    # the server returns every batch ordered by eventTime with one row per eventTime, the client only formats it
+    parser.add_argument("--pushdown", dest="pushdown", const=1, default=0, nargs='?')
+    # with --pushdown, dump every block a second time the client side way and fail it unless both outputs are equal
+    parser.add_argument("--verify_pushdown", dest="verify_pushdown", const=1, default=0, nargs='?')
+    # orders the rows of an eventTime, so that the one kept is the same every time; left out if the table has no such
+    # column (the bare flag never uses one), unless --verify_pushdown needs it
+    parser.add_argument("--order_column", dest="order_column", default=batch.DEFAULT_ORDER_COLUMN, nargs='?')
+    # per-batch and per-block performance records are appended to this file as JSON lines
+    parser.add_argument("--telemetry_path", dest="telemetry_path", default=None, nargs='?')
+    # adaptive sizes every batch from the cost of the previous ones, intended_batch_size is then only the first guess
+    parser.add_argument("--batch_planner", dest="batch_planner", default="histogram", nargs='?',
+                        choices=["histogram", "uniform", "adaptive"])
+    parser.add_argument("--force", dest="force", const=1, default=0, nargs='?')
+    parser.add_argument("--verify_checksums", dest="verify_checksums", const=1, default=0, nargs='?')
+    # seconds, max_execution_time of every batch query and socket timeout of the client
+    parser.add_argument("--query_timeout", dest="query_timeout", default=retry.QUERY_TIMEOUT, nargs='?', type=int)
+    # give a block up as soon as the circuit breaker of its endpoint opens, so threader.py can move it to a replica
+    parser.add_argument("--failover", dest="failover", const=1, default=0, nargs='?')
+    # append the rows after the last dumped eventTime to already complete blocks instead of skipping them
+    parser.add_argument("--incremental", dest="incremental", const=1, default=0, nargs='?')
+    # the symbols found in every partition are cached in this file and only queried again once the partition changes
+    parser.add_argument("--plan_cache_path", dest="plan_cache_path", default=None, nargs='?')
+    # eventTime units, the text streams are also cut into chunks at every multiple of it, so that the block index can
+    # point a reader to the start of any such window (0: chunks only end when a buffer is full)
+    parser.add_argument("--index_interval", dest="index_interval", default=0, nargs='?', type=int)
+    return parser
 
 
 def pretty_print_number(a_number):
@@ -21,30 +91,46 @@ def pretty_print_number(a_number):
         return "{:.2f} B".format(a_number / 1e9)
 
 
+def pretty_print_size(a_bytes):
+    # the units of ClickHouse formatReadableSize, computed client side from the raw byte counts
+    size = float(a_bytes)
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if size < 1024 or unit == "TiB":
+            return "{:.2f} {}".format(size, unit)
+        size /= 1024
+
+
 class TableInfo:
-    def __init__(self, a_database, a_table):
+    def __init__(self, a_database, a_table, a_bytes_on_disk=0, a_bytes_compressed=0, a_bytes_uncompressed=0, a_rows=0):
         self.database_name = a_database
         self.table_name = a_table
 
-        self.size_on_disk = None
-        self.size_compressed = None
-        self.size_uncompressed = None
-        self.rows = None
-
-    def get_info(self, a_client):
-        query_get_table_info_string = """SELECT
-    formatReadableSize(sum(bytes_on_disk)) AS size_on_disk,
-    formatReadableSize(sum(data_compressed_bytes)) AS size_compressed,
-    formatReadableSize(sum(data_uncompressed_bytes)) AS size_uncompressed,
-    sum(rows) AS rows
-FROM system.parts
-WHERE active AND database='{}' and table='{}'""".format(self.database_name, self.table_name)
-
-        query_get_table_info_result = a_client.query(query_get_table_info_string)
-        self.size_on_disk = query_get_table_info_result.result_rows[0][0]
-        self.size_compressed = query_get_table_info_result.result_rows[0][1]
-        self.size_uncompressed = query_get_table_info_result.result_rows[0][2]
-        self.rows = int(query_get_table_info_result.result_rows[0][3])
+        self.bytes_on_disk = a_bytes_on_disk
+        self.bytes_compressed = a_bytes_compressed
+        self.bytes_uncompressed = a_bytes_uncompressed
+        self.rows = a_rows
+
+        # filled by DatabaseInfo.get_details
+        self.count_parts = None
+        self.count_partitions = None
+        self.min_date = None
+        self.max_date = None
+        self.last_modification_time = None
+
+    def to_record(self):
+        return {
+            "database": self.database_name,
+            "table": self.table_name,
+            "bytes_on_disk": self.bytes_on_disk,
+            "bytes_compressed": self.bytes_compressed,
+            "bytes_uncompressed": self.bytes_uncompressed,
+            "rows": self.rows,
+            "count_parts": self.count_parts,
+            "count_partitions": self.count_partitions,
+            "min_date": self.min_date,
+            "max_date": self.max_date,
+            "last_modification_time": self.last_modification_time,
+        }
 
     def __lt__(self, other):
         return self.rows > other.rows
@@ -54,26 +140,64 @@ class DatabaseInfo:
     def __init__(self, a_database):
         self.database_name = a_database
         self.tables = []
+        self.has_details = False
+
+    def get_details(self, a_client):
+        # parts, partitions and date range of every table, one query for the whole database
+        query_get_details_string = """SELECT
+    table,
+    count(),
+    uniqExact(partition),
+    min(min_date),
+    max(max_date),
+    toUnixTimestamp(max(modification_time))
+FROM system.parts
+WHERE active AND database = '{}'
+GROUP BY table""".format(self.database_name)
 
-    def get_info(self, a_client):
-        for table in get_tables(a_client, self.database_name):
-            self.tables.append(TableInfo(self.database_name, table))
-            self.tables[-1].get_info(a_client)
-
-        self.tables.sort()
+        tables = {table.table_name: table for table in self.tables}
+        for row in a_client.query(query_get_details_string).result_rows:
+            if row[0] not in tables:
+                continue
+            table = tables[row[0]]
+            table.count_parts = int(row[1])
+            table.count_partitions = int(row[2])
+            table.min_date = str(row[3])
+            table.max_date = str(row[4])
+            table.last_modification_time = int(row[5])
+        self.has_details = True
+
+    def get_rows(self):
+        return sum(table.rows for table in self.tables)
+
+    def to_record(self):
+        return {
+            "database": self.database_name,
+            "bytes_on_disk": sum(table.bytes_on_disk for table in self.tables),
+            "rows": self.get_rows(),
+            "tables": [table.to_record() for table in self.tables],
+        }
 
     def print(self, a_hide_empty_tables):
         table_string = ""
+        details_string = ""
         for table in self.tables:
             if table.rows == 0 and a_hide_empty_tables:
                 continue
             table_string += "{:35}|{:^15}|{:^15}|{:^15}|{:^15}|\n".format(
                 table.table_name,
-                table.size_on_disk,
-                table.size_compressed,
-                table.size_uncompressed,
+                pretty_print_size(table.bytes_on_disk),
+                pretty_print_size(table.bytes_compressed),
+                pretty_print_size(table.bytes_uncompressed),
                 pretty_print_number(table.rows),
             )
+            if self.has_details and table.count_parts is not None:
+                details_string += "{:35}|{:^15}|{:^15}|{:^31}|\n".format(
+                    table.table_name,
+                    table.count_parts,
+                    table.count_partitions,
+                    "{} - {}".format(table.min_date, table.max_date),
+                )
         table_width = 100
         output = ("{:^" + str(table_width) + "}\n").format(self.database_name)
         output += "-" * table_width + "\n"
@@ -87,10 +211,60 @@ class DatabaseInfo:
         output += "-" * table_width + "\n"
         output += table_string
         output += "-" * table_width + "\n"
+        if details_string != "":
+            output += "{:35}|{:^15}|{:^15}|{:^31}|\n".format(
+                "Table",
+                "Parts",
+                "Partitions",
+                "Dates",
+            )
+            output += "-" * table_width + "\n"
+            output += details_string
+            output += "-" * table_width + "\n"
 
         print(output)
 
 
+def get_databases_info(
+        client,
+        a_databases
+):
+    # Every table of the given databases with the raw sizes and rows of its active parts, in one query. Tables without
+    # parts (empty, views, other engines) are listed with zeros, as the join fills the missing sums with defaults.
+    if len(a_databases) == 0:
+        return []
+    query_get_databases_info_string = """SELECT
+    tables.database,
+    tables.name,
+    parts.bytes_on_disk,
+    parts.bytes_compressed,
+    parts.bytes_uncompressed,
+    parts.rows
+FROM system.tables AS tables
+LEFT JOIN (
+    SELECT
+        database,
+        table,
+        sum(bytes_on_disk) AS bytes_on_disk,
+        sum(data_compressed_bytes) AS bytes_compressed,
+        sum(data_uncompressed_bytes) AS bytes_uncompressed,
+        sum(rows) AS rows
+    FROM system.parts
+    WHERE active
+    GROUP BY database, table
+) AS parts ON tables.database = parts.database AND tables.name = parts.table
+WHERE tables.database IN ({})
+ORDER BY tables.database, tables.name""".format(", ".join("'{}'".format(database) for database in a_databases))
+
+    databases_info = {database: DatabaseInfo(database) for database in a_databases}
+    for row in client.query(query_get_databases_info_string, settings={'join_use_nulls': 0}).result_rows:
+        databases_info[row[0]].tables.append(TableInfo(row[0], row[1], int(row[2]), int(row[3]), int(row[4]),
+                                                       int(row[5])))
+    for database_info in databases_info.values():
+        database_info.tables.sort()
+    return [databases_info[database] for database in a_databases]
+
+
 def make_red(a_string):
     return "\033[91m{}\033[00m".format(a_string)
 
@@ -149,15 +323,24 @@ def clear_table_by_date(client, a_database, a_table, a_date_until):
     client.query(query_string)
 
 
-def print_progress(a_total_blocks, a_processed_blocks, process_blocks_start_time):
-    seconds_to_finish = int(
-        (time.time() - process_blocks_start_time)
-        / a_processed_blocks * (a_total_blocks - a_processed_blocks)
-    )
-    print("Finished a block, progress: {}/{} ({:4.1f}%) ETA: {} (h:m:s)".format(
+def print_progress(a_total_blocks, a_processed_blocks, a_total_rows, a_processed_rows, process_blocks_start_time):
+    # weighted by rows: blocks differ in size by orders of magnitude, and the largest ones are processed first
+    if a_processed_rows > 0:
+        seconds_to_finish = int(
+            (time.time() - process_blocks_start_time)
+            / a_processed_rows * (a_total_rows - a_processed_rows)
+        )
+    else:
+        seconds_to_finish = int(
+            (time.time() - process_blocks_start_time)
+            / a_processed_blocks * (a_total_blocks - a_processed_blocks)
+        )
+    print("Finished a block, progress: {}/{} blocks, {}/{} rows ({:4.1f}%) ETA: {} (h:m:s)".format(
         a_processed_blocks,
         a_total_blocks,
-        a_processed_blocks / a_total_blocks * 100,
+        pretty_print_number(a_processed_rows),
+        pretty_print_number(a_total_rows),
+        a_processed_rows / a_total_rows * 100 if a_total_rows > 0 else a_processed_blocks / a_total_blocks * 100,
         datetime.timedelta(seconds=seconds_to_finish)),
     )
 
@@ -202,6 +385,13 @@ def create_folders(a_folder_path, a_instrument, a_date):
     return destination_folder
 
 
+def get_thread_client(a_get_client):
+    # a clickhouse_connect client runs one query at a time, so every thread of a pool has its own, made by a_get_client
+    if not hasattr(thread_clients, "client"):
+        thread_clients.client = a_get_client()
+    return thread_clients.client
+
+
 def get_databases(
         client
 ):
@@ -227,35 +417,53 @@ def get_tables(
     return tables
 
 
-def get_instruments(
-        client,
-        a_database,
-        a_table
-):
-    query_get_instruments_string = "SELECT DISTINCT symbol FROM {}.{}".format(a_database, a_table)
-    query_get_instruments_result = client.query(query_get_instruments_string)
-    instruments = []
-    for row in query_get_instruments_result.result_rows:
-        instruments.append(row[0])
-    instruments.sort()
-    return instruments
+def get_table_schema(client, a_database, a_table):
+    # name -> type of every column, queried once per process (forked workers inherit what the parent already got)
+    if (a_database, a_table) not in table_schemas:
+        query_get_columns_string = "SELECT name, type FROM system.columns " \
+                                   "WHERE database = '{}' AND table = '{}' ORDER BY position".format(a_database,
+                                                                                                    a_table)
+        query_get_columns_result = client.query(query_get_columns_string)
+        table_schemas[(a_database, a_table)] = dict(zip(query_get_columns_result.result_columns[0],
+                                                        query_get_columns_result.result_columns[1]))
+    return table_schemas[(a_database, a_table)]
 
 
-def get_instrument_dates(
-        client,
-        a_database,
-        a_table,
-        a_instrument
-):
-    query_get_instrument_dates_string = "SELECT DISTINCT date FROM {}.{} WHERE symbol = '{}'".format(
-        a_database, a_table, a_instrument
-    )
-    query_get_instrument_dates_result = client.query(query_get_instrument_dates_string)
-    dates = []
-    for row in query_get_instrument_dates_result.result_rows:
-        dates.append(str(row[0]))
-    dates.sort()
-    return dates
+def get_column_layout(client, a_database, a_table, a_columns):
+    # whether each of the dumped columns is an Array, which decides how batch.Batch stores and formats it
+    table_schema = get_table_schema(client, a_database, a_table)
+    missing_columns = [column for column in batch.get_selected_columns(a_columns) if column not in table_schema]
+    if len(missing_columns) > 0:
+        raise ValueError("Columns {} not found in {}.{}, it has: {}".format(missing_columns, a_database, a_table,
+                                                                           list(table_schema)))
+    return [table_schema[column].startswith("Array(") for column in a_columns]
+
+
+def get_order_column_args(client, args):
+    # args without an order column if the table has none: rows with equal eventTime are then kept in server order,
+    # which only --verify_pushdown cannot do with (both paths must keep the same row)
+    if args.order_column is None or args.order_column in get_table_schema(client, args.database, args.table):
+        return args
+    if args.pushdown and args.verify_pushdown:
+        raise ValueError("--verify_pushdown needs the order column {} to tell rows with equal eventTime apart, {}.{} "
+                         "has no such column (see --order_column)".format(args.order_column, args.database,
+                                                                         args.table))
+    args = copy.copy(args)
+    args.order_column = None
+    return args
+
+
+def get_select_list(a_columns, a_order_column=None):
+    return ", ".join("`{}`".format(column) for column in batch.get_selected_columns(a_columns, a_order_column))
+
+
+def get_order_clause(a_pushdown, a_order_column=None):
+    # the order batch.Batch.sorted gives on the client, so that both keep the same row of an eventTime
+    order_clause = "ORDER BY {}".format(", ".join(batch.get_selected_columns([], a_order_column)))
+    if a_pushdown:
+        # one row per eventTime, the same deduplication batch.deduplication_mask does on the client
+        return "{} LIMIT 1 BY {}".format(order_clause, batch.TIME_COLUMN)
+    return order_clause
 
 
 def get_batch(
@@ -266,7 +474,11 @@ def get_batch(
         a_symbol,
         a_date,
         a_event_time_min,
-        a_event_time_max
+        a_event_time_max,
+        a_columns,
+        a_pushdown=0,
+        a_timeout=None,
+        a_order_column=None
 ):
     query_filters = ["isSnapshot = {}".format(a_is_snapshot),
                      "symbol = '{}'".format(a_symbol),
@@ -274,16 +486,21 @@ def get_batch(
                      "eventTime >= '{}'".format(a_event_time_min),
                      "eventTime <= '{}'".format(a_event_time_max)]
 
-    query_get_batch_string = "SELECT * FROM {}.{} WHERE {} LIMIT {}".format(a_database, a_table,
-                                                                            " AND ".join(query_filters),
-                                                                            MAX_BUFFER_LIMIT)
+    # without pushdown the client sorts the rows, so it also needs their order column
+    query_get_batch_string = "SELECT {} FROM {}.{} WHERE {} {}LIMIT {}".format(
+        get_select_list(a_columns, a_order_column if not a_pushdown else None),
+        a_database, a_table,
+        " AND ".join(query_filters),
+        get_order_clause(a_pushdown, a_order_column) + " " if a_pushdown else "",
+        MAX_BUFFER_LIMIT
+    )
 
     query_start_time = time.time()
 
-    query = client.query(query_get_batch_string)
-    # force deflate (for accurate benchmarking) and check if buffer limit reached
-    if len(query.result_rows) == MAX_BUFFER_LIMIT:
-        print("Buffer limit reached!", file=sys.stderr)
+    query = client.query(query_get_batch_string,
+                         settings={'max_execution_time': a_timeout} if a_timeout is not None else None)
+    # force deflate (for accurate benchmarking), a result at the buffer limit is split by the caller
+    query.result_columns
 
     query_end_time = time.time()
 
@@ -297,46 +514,57 @@ def get_batch(
     return query
 
 
-def get_min_max_event_time(
+def get_block_stream(
         client,
         a_database,
         a_table,
         a_is_snapshot,
         a_symbol,
         a_date,
+        a_event_time_min,
+        a_block_size,
+        a_columns,
+        a_pushdown=0,
+        a_order_column=None
 ):
     query_filters = ["isSnapshot = {}".format(a_is_snapshot),
                      "symbol = '{}'".format(a_symbol),
-                     "date = '{}'".format(a_date)]
-
-    query_get_min_event_time_string = "SELECT min(eventTime) FROM {}.{} WHERE {}".format(a_database, a_table,
-                                                                                         " AND ".join(query_filters))
-
-    query_get_max_event_time_string = "SELECT max(eventTime) FROM {}.{} WHERE {}".format(a_database, a_table,
-                                                                                         " AND ".join(query_filters))
+                     "date = '{}'".format(a_date),
+                     "eventTime >= '{}'".format(a_event_time_min)]
 
-    query_get_min_event_time_result = client.query(query_get_min_event_time_string)
-    query_get_max_event_time_result = client.query(query_get_max_event_time_string)
+    query_get_block_string = "SELECT {} FROM {}.{} WHERE {} {}".format(get_select_list(a_columns),
+                                                                       a_database, a_table,
+                                                                       " AND ".join(query_filters),
+                                                                       get_order_clause(a_pushdown, a_order_column))
 
-    return [query_get_min_event_time_result.result_rows[0][0], query_get_max_event_time_result.result_rows[0][0]]
+    # no LIMIT here: the whole block is consumed incrementally, one server block (max_block_size rows) at a time
+    return client.query_column_block_stream(query_get_block_string, settings={'max_block_size': a_block_size})
 
 
-def get_count_rows(
+def get_block_arrow_stream(
         client,
         a_database,
         a_table,
         a_is_snapshot,
         a_symbol,
         a_date,
+        a_event_time_min,
+        a_block_size,
+        a_columns,
+        a_pushdown=0,
+        a_order_column=None
 ):
     query_filters = ["isSnapshot = {}".format(a_is_snapshot),
                      "symbol = '{}'".format(a_symbol),
-                     "date = '{}'".format(a_date)]
+                     "date = '{}'".format(a_date),
+                     "eventTime >= '{}'".format(a_event_time_min)]
 
-    query_get_count_row_string = "SELECT count() FROM {}.{} WHERE {}".format(a_database, a_table,
-                                                                             " AND ".join(query_filters))
+    query_get_block_string = "SELECT {} FROM {}.{} WHERE {} {}".format(get_select_list(a_columns),
+                                                                       a_database, a_table,
+                                                                       " AND ".join(query_filters),
+                                                                       get_order_clause(a_pushdown, a_order_column))
 
-    return client.query(query_get_count_row_string).result_rows[0][0]
+    return client.query_arrow_stream(query_get_block_string, settings={'max_block_size': a_block_size})
 
 
 class BlockInfo:
@@ -377,200 +605,757 @@ def get_block_info(
         a_is_snapshot,
         a_symbol,
         a_date,
+        a_event_time_min=None
+):
+    query_filters = ["isSnapshot = {}".format(a_is_snapshot),
+                     "symbol = '{}'".format(a_symbol),
+                     "date = '{}'".format(a_date)]
+    if a_event_time_min is not None:
+        query_filters.append("eventTime >= '{}'".format(a_event_time_min))
+
+    query_get_block_info_string = "SELECT min(eventTime), max(eventTime), count() FROM {}.{} WHERE {}".format(
+        a_database, a_table, " AND ".join(query_filters))
+
+    query_get_block_info_result = client.query(query_get_block_info_string)
+    return BlockInfo(query_get_block_info_result.result_rows[0][0],
+                     query_get_block_info_result.result_rows[0][1],
+                     query_get_block_info_result.result_rows[0][2])
+
+
+def get_event_time_histogram(
+        client,
+        a_database,
+        a_table,
+        a_is_snapshot,
+        a_symbol,
+        a_date,
+        a_event_time_min,
+        a_event_time_max,
+        a_count_buckets
 ):
-    min_max_event_time = get_min_max_event_time(client, a_database, a_table, a_is_snapshot, a_symbol, a_date)
-    count_rows = get_count_rows(client, a_database, a_table, a_is_snapshot, a_symbol, a_date)
+    bucket_width = max(1, -(-(a_event_time_max - a_event_time_min + 1) // a_count_buckets))
 
-    return BlockInfo(min_max_event_time[0], min_max_event_time[1], count_rows)
+    query_filters = ["isSnapshot = {}".format(a_is_snapshot),
+                     "symbol = '{}'".format(a_symbol),
+                     "date = '{}'".format(a_date),
+                     "eventTime >= '{}'".format(a_event_time_min),
+                     "eventTime <= '{}'".format(a_event_time_max)]
+
+    query_get_histogram_string = """SELECT
+    intDiv(eventTime - {0}, {1}) AS bucket,
+    count()
+FROM {2}.{3}
+WHERE {4}
+GROUP BY bucket
+ORDER BY bucket""".format(a_event_time_min, bucket_width, a_database, a_table, " AND ".join(query_filters))
+
+    # buckets without rows are not returned at all
+    histogram = []
+    for row in client.query(query_get_histogram_string).result_rows:
+        bucket_min = a_event_time_min + row[0] * bucket_width
+        histogram.append([bucket_min, min(bucket_min + bucket_width - 1, a_event_time_max), row[1]])
+    return histogram
+
+
+def get_balanced_intervals(
+        client,
+        a_database,
+        a_table,
+        a_is_snapshot,
+        a_symbol,
+        a_date,
+        a_block_info,
+        a_intended_batch_size
+):
+    # Market data is bursty, so instead of cutting the day into equal eventTime slices, the exact row count of many
+    # small eventTime buckets is fetched and consecutive buckets are merged until they hold intended_batch_size rows.
+    # Buckets that alone hold more than that are split again with a finer histogram of their own range.
+    if a_block_info.count_rows == 0:
+        return []
+
+    count_batches = -(-a_block_info.count_rows // a_intended_batch_size)
+    histogram = get_event_time_histogram(client, a_database, a_table, a_is_snapshot, a_symbol, a_date,
+                                         a_block_info.min_event_time, a_block_info.max_event_time,
+                                         count_batches * HISTOGRAM_BUCKETS_PER_BATCH)
+
+    buckets = []
+    while len(histogram) > 0:
+        bucket = histogram.pop(0)
+        if bucket[2] > a_intended_batch_size and bucket[1] > bucket[0]:
+            histogram = get_event_time_histogram(client, a_database, a_table, a_is_snapshot, a_symbol, a_date,
+                                                 bucket[0], bucket[1],
+                                                 -(-bucket[2] // a_intended_batch_size) * HISTOGRAM_BUCKETS_PER_BATCH
+                                                 ) + histogram
+            continue
+        buckets.append(bucket)
+
+    # intervals are [event_time_min, event_time_max, expected_rows], bounds included, without gaps or overlaps
+    intervals = []
+    interval_min = a_block_info.min_event_time
+    interval_count_rows = 0
+    for bucket in buckets:
+        if interval_count_rows > 0 and interval_count_rows + bucket[2] > a_intended_batch_size:
+            intervals.append([interval_min, bucket[0] - 1, interval_count_rows])
+            interval_min = bucket[0]
+            interval_count_rows = 0
+        interval_count_rows += bucket[2]
+    intervals.append([interval_min, a_block_info.max_event_time, interval_count_rows])
+
+    return intervals
+
+
+def get_match_condition(a_expression, a_regex_list):
+    # re.match() only anchors at the beginning of the string, ClickHouse match() does not anchor at all
+    conditions = []
+    for regex_string in a_regex_list:
+        conditions.append("match({}, '^(?:{})')".format(a_expression,
+                                                         regex_string.replace("\\", "\\\\").replace("'", "\\'")))
+    return "({})".format(" OR ".join(conditions))
+
+
+def get_blocks_plan(
+        client,
+        a_database,
+        a_table,
+        a_is_snapshot,
+        a_instrument_white_list,
+        a_date_white_list,
+        a_date_min=None,
+        a_date_max=None
+):
+    query_filters = ["isSnapshot = {}".format(a_is_snapshot),
+                     get_match_condition("symbol", a_instrument_white_list),
+                     get_match_condition("toString(date)", a_date_white_list)]
+    # the dates of one partition, see partitions.py
+    if a_date_min is not None:
+        query_filters.append("date >= '{}'".format(a_date_min))
+    if a_date_max is not None:
+        query_filters.append("date <= '{}'".format(a_date_max))
+
+    query_get_blocks_plan_string = """SELECT
+    symbol,
+    date,
+    min(eventTime),
+    max(eventTime),
+    count()
+FROM {}.{}
+WHERE {}
+GROUP BY symbol, date
+ORDER BY symbol, date""".format(a_database, a_table, " AND ".join(query_filters))
+
+    query_get_blocks_plan_result = client.query(query_get_blocks_plan_string)
+    blocks = []
+    for row in query_get_blocks_plan_result.result_rows:
+        blocks.append([row[0], str(row[1]), BlockInfo(row[2], row[3], row[4])])
+    return blocks
+
+
+def get_instrument_dates_from_plan(a_blocks):
+    instrument_dates = {}
+    for block in a_blocks:
+        instrument_dates.setdefault(block[0], []).append(block[1])
+    return instrument_dates
 
 
 class BufferedFileWriter:
-    def __init__(self, a_use_gzip, a_file_path):
-        self.use_gzip = a_use_gzip
+    def __init__(self, a_codec, a_file_path, a_append=False):
         self.file_path = a_file_path
-        self.buffer = ""
-        if self.use_gzip:
-            self.file = gzip.open(self.file_path, mode='wb', compresslevel=9)
-        else:
-            self.file = open(self.file_path, "w")
+        self.buffer = []
+        self.buffer_size = 0
+        self.file = compression.CompressedFileWriter(a_codec, self.file_path, a_append)
 
-    def write(self, a_string):
-        self.buffer += a_string
-        if len(self.buffer) > 1e5:
-            self.flush()
+    def write(self, a_rows, a_size):
+        # a_rows: a piece of the stream, kept until the BufferedFileWriterSet ends the chunk
+        self.buffer.append(a_rows)
+        self.buffer_size += a_size
 
     def flush(self):
-        if self.use_gzip:
-            self.file.write(self.buffer.encode('utf-8'))
-        else:
-            self.file.write(self.buffer)
-        self.buffer = ""
-
-    def __del__(self):
+        if self.buffer_size > 0:
+            self.file.write_chunk(b"".join(self.buffer))
+        self.buffer = []
+        self.buffer_size = 0
+
+    def close(self):
+        if self.file.closed:
+            return
         self.flush()
         self.file.close()
 
+    def __del__(self):
+        self.close()
 
-class BufferedFileWriterSet:
-    def __init__(self, a_use_gzip, a_directory):
-        self.directory = a_directory
-        if a_use_gzip:
-            self.bfw_event_times = BufferedFileWriter(
-                a_use_gzip, os.path.join(self.directory, "event_times.txt.gz")
-            )
-            self.bfw_asks_prices = BufferedFileWriter(
-                a_use_gzip, os.path.join(self.directory, "asks_prices.txt.gz")
-            )
-            self.bfw_asks_quantities = BufferedFileWriter(
-                a_use_gzip, os.path.join(self.directory, "asks_quantities.txt.gz")
-            )
-            self.bfw_bids_prices = BufferedFileWriter(
-                a_use_gzip, os.path.join(self.directory, "bids_prices.txt.gz")
-            )
-            self.bfw_bids_quantities = BufferedFileWriter(
-                a_use_gzip, os.path.join(self.directory, "bids_quantities.txt.gz")
-            )
-        else:
-            self.bfw_event_times = BufferedFileWriter(
-                a_use_gzip, os.path.join(self.directory, "event_times.txt")
-            )
-            self.bfw_asks_prices = BufferedFileWriter(
-                a_use_gzip, os.path.join(self.directory, "asks_prices.txt")
-            )
-            self.bfw_asks_quantities = BufferedFileWriter(
-                a_use_gzip, os.path.join(self.directory, "asks_quantities.txt")
-            )
-            self.bfw_bids_prices = BufferedFileWriter(
-                a_use_gzip, os.path.join(self.directory, "bids_prices.txt")
-            )
-            self.bfw_bids_quantities = BufferedFileWriter(
-                a_use_gzip, os.path.join(self.directory, "bids_quantities.txt")
-            )
 
+class DeltaFileWriter(BufferedFileWriter):
+    # the pieces are columns, encoded together when the chunk ends
+    def flush(self):
+        if self.buffer_size > 0:
+            self.file.write_chunk(delta_codec.encode_chunk(batch.concatenate_columns(self.buffer)))
+        self.buffer = []
+        self.buffer_size = 0
 
-class Row:
-    def __init__(self, a_event_time, a_asks_price, a_asks_quantity, a_bids_price, a_bids_quantity):
-        self.event_time = a_event_time
-        self.asks_price = a_asks_price
-        self.asks_quantity = a_asks_quantity
-        self.bids_price = a_bids_price
-        self.bids_quantity = a_bids_quantity
 
-    def __lt__(self, other):  # for sorting
-        return self.event_time <= other.event_time
+def get_text_file_name(a_codec, a_stream_name):
+    return a_stream_name + ".txt" + a_codec.extension
 
-    def __str__(self):
-        return "\tevent_time: {}\n" \
-               "\tasks_price: {}\n" \
-               "\tasks_quantity: {}\n" \
-               "\tbids_price: {}\n" \
-               "\tbids_quantity: {}" \
-            .format(self.event_time,
-                    self.asks_price,
-                    self.asks_quantity,
-                    self.bids_price,
-                    self.bids_quantity)
-
-    def write_to_files_deduplicated(self, a_prev_event_time, a_buffered_file_writer_set):
-        # price_formatter = "{0:0.8f}"
-        # quantity_formatter = "{0:0.8f}"
-        price_formatter = "{}"
-        quantity_formatter = "{}"
-        if self.event_time != a_prev_event_time:
-            a_buffered_file_writer_set.bfw_event_times.write("{}\n".format(self.event_time))
-            a_buffered_file_writer_set.bfw_asks_prices.write(
-                "{}\n".format(" ".join(price_formatter.format(ask_price) for ask_price in self.asks_price)))
-            a_buffered_file_writer_set.bfw_asks_quantities.write(
-                "{}\n".format(" ".join(quantity_formatter.format(ask_quantity) for ask_quantity in self.asks_quantity)))
-            a_buffered_file_writer_set.bfw_bids_prices.write(
-                "{}\n".format(" ".join(price_formatter.format(bid_price) for bid_price in self.bids_price)))
-            a_buffered_file_writer_set.bfw_bids_quantities.write(
-                "{}\n".format(" ".join(quantity_formatter.format(bid_quantity) for bid_quantity in self.bids_quantity)))
-            return 1
-        return 0
+
+# the output formats written one file per stream by a BufferedFileWriterSet
+STREAM_OUTPUT_FORMATS = ["text", "delta"]
+
+
+def get_stream_file_name(a_output_format, a_codec, a_stream_name):
+    if a_output_format == "delta":
+        return delta_codec.get_file_name(a_codec, a_stream_name)
+    return get_text_file_name(a_codec, a_stream_name)
+
+
+class BufferedFileWriterSet:
+    # The streams of a text block, cut into chunks at the same rows: before the first row of every a_index_interval
+    # eventTime window (0: no time windows) and after the row that fills one of the buffers to CHUNK_SIZE. Every chunk
+    # gets an entry in the index of the block (see compression.write_index).
+    def __init__(self, a_codec, a_directory, a_stream_names, a_append=False, a_index_interval=0):
+        self.directory = a_directory
+        self.append = a_append
+        self.index_interval = a_index_interval
+        self.buffered_file_writers = [self.create_file_writer(a_codec, stream_name, a_append)
+                                      for stream_name in a_stream_names]
+        # [first_event_time, last_event_time, rows] of every chunk, the stream offsets are only known once written
+        self.chunks = []
+        self.chunk_rows = 0
+        self.chunk_first_event_time = None
+        self.chunk_last_event_time = None
+        self.chunk_window = None
+
+    def create_file_writer(self, a_codec, a_stream_name, a_append):
+        return BufferedFileWriter(a_codec, os.path.join(self.directory, get_text_file_name(a_codec, a_stream_name)),
+                                  a_append)
+
+    @staticmethod
+    def get_row_ends(a_stream):
+        # a_stream: the text of some rows, as bytes; returns it in the form get_rows() slices and the end of every row
+        return a_stream, np.flatnonzero(np.frombuffer(a_stream, dtype=np.uint8) == ord("\n")) + 1
+
+    @staticmethod
+    def get_rows(a_data, a_start, a_end, a_start_byte, a_end_byte):
+        return a_data[a_start_byte:a_end_byte]
+
+    def write(self, a_event_times, a_streams):
+        # a_event_times: the eventTimes of the rows of a_streams, in order
+        datas, row_ends = zip(*[self.get_row_ends(stream) for stream in a_streams])
+        windows = a_event_times // self.index_interval if self.index_interval > 0 else np.zeros(len(a_event_times))
+        start = 0
+        while start < len(a_event_times):
+            if self.chunk_rows > 0 and windows[start] != self.chunk_window:
+                self.flush_chunk()
+            if self.chunk_rows == 0:
+                self.chunk_window = windows[start]
+                self.chunk_first_event_time = int(a_event_times[start])
+            # the rows of the current window, up to the one that fills a buffer
+            end = start + int(np.searchsorted(windows[start:], self.chunk_window, "right"))
+            for buffered_file_writer, stream_row_ends in zip(self.buffered_file_writers, row_ends):
+                start_byte = stream_row_ends[start - 1] if start > 0 else 0
+                end = min(end, int(np.searchsorted(stream_row_ends, start_byte + compression.CHUNK_SIZE -
+                                                   buffered_file_writer.buffer_size, "left")) + 1)
+            for buffered_file_writer, data, stream_row_ends in zip(self.buffered_file_writers, datas, row_ends):
+                start_byte = stream_row_ends[start - 1] if start > 0 else 0
+                buffered_file_writer.write(self.get_rows(data, start, end, start_byte, stream_row_ends[end - 1]),
+                                           int(stream_row_ends[end - 1] - start_byte))
+            self.chunk_rows += end - start
+            self.chunk_last_event_time = int(a_event_times[end - 1])
+            if any(buffered_file_writer.buffer_size >= compression.CHUNK_SIZE
+                   for buffered_file_writer in self.buffered_file_writers):
+                self.flush_chunk()
+            start = end
+
+    def flush_chunk(self):
+        if self.chunk_rows == 0:
+            return
+        # every row takes some bytes in every stream, so each stream writes exactly one chunk
+        for buffered_file_writer in self.buffered_file_writers:
+            buffered_file_writer.flush()
+        self.chunks.append([self.chunk_first_event_time, self.chunk_last_event_time, self.chunk_rows])
+        self.chunk_rows = 0
+
+    def close(self):
+        if all(buffered_file_writer.file.closed for buffered_file_writer in self.buffered_file_writers):
+            return
+        self.flush_chunk()
+        for buffered_file_writer in self.buffered_file_writers:
+            buffered_file_writer.close()
+        compression.write_index(self.directory, [
+            chunk + [[buffered_file_writer.file.chunk_offsets[chunk_id]
+                      for buffered_file_writer in self.buffered_file_writers]]
+            for chunk_id, chunk in enumerate(self.chunks)], self.append)
+
+    def get_compress_time(self):
+        return sum(buffered_file_writer.file.compress_time for buffered_file_writer in self.buffered_file_writers)
+
+
+class DeltaFileWriterSet(BufferedFileWriterSet):
+    # the streams of the delta output format (see delta_codec.py): the rows are kept as columns, sized by their encoding
+    def create_file_writer(self, a_codec, a_stream_name, a_append):
+        return DeltaFileWriter(a_codec, os.path.join(self.directory, delta_codec.get_file_name(a_codec, a_stream_name)),
+                               a_append)
+
+    @staticmethod
+    def get_row_ends(a_stream):
+        return a_stream, np.cumsum(delta_codec.get_row_sizes(a_stream))
+
+    @staticmethod
+    def get_rows(a_data, a_start, a_end, a_start_byte, a_end_byte):
+        return a_data.take(np.arange(a_start, a_end))
+
+
+def dump_block(
+        a_client,
+        args,
+        a_instrument,
+        a_instrument_date,
+        a_block_info,
+        a_column_layout,
+        a_directory,
+        a_block_stats,
+        a_last_event_time=0,
+        a_append=False
+):
+    # a_last_event_time: the last eventTime already in the output, when appending to it; returns the last eventTime
+    # in the output once the block is dumped
+    if args.output_format not in STREAM_OUTPUT_FORMATS:
+        import arrow_sink  # pyarrow is only needed for the columnar outputs
+
+        return arrow_sink.dump_block_arrow(a_client, args, a_instrument, a_instrument_date, a_block_info, a_directory,
+                                           a_block_stats, a_last_event_time, a_append)
+
+    file_writer_set_class = DeltaFileWriterSet if args.output_format == "delta" else BufferedFileWriterSet
+    buffered_file_writer_set = file_writer_set_class(compression.get_codec(args), a_directory,
+                                                     batch.get_stream_names(args.columns), a_append,
+                                                     args.index_interval)
+    if args.streaming:
+        last_event_time = dump_block_streaming(a_client, args, a_instrument, a_instrument_date, a_block_info,
+                                               a_column_layout, buffered_file_writer_set, a_block_stats,
+                                               a_last_event_time, a_append)
+    else:
+        last_event_time = dump_block_intervals(a_client, args, a_instrument, a_instrument_date, a_block_info,
+                                               a_column_layout, buffered_file_writer_set, a_block_stats,
+                                               a_last_event_time, a_append)
+    buffered_file_writer_set.close()
+    a_block_stats.compress_time = buffered_file_writer_set.get_compress_time()
+    return last_event_time
+
+
+def get_output_file_names(args):
+    # the files of a dumped block that an incremental dump appends to
+    if args.output_format not in STREAM_OUTPUT_FORMATS:
+        import arrow_sink
+
+        return [arrow_sink.get_part_file_name(args.output_format, 0)]
+    codec = compression.get_codec(args)
+    # a block dumped before the index existed is dumped again rather than getting an index of its new rows only
+    return [get_stream_file_name(args.output_format, codec, stream_name)
+            for stream_name in batch.get_stream_names(args.columns)] + [compression.INDEX_FILE_NAME]
+
+
+def compare_text_outputs(args, a_expected_directory, a_directory):
+    # the first difference between the decompressed streams of two text (or delta) dumps, None if they are identical.
+    # The chunks only depend on the rows, not on how they were fetched, so equal rows give equal delta streams.
+    codec = compression.get_codec(args)
+    for stream_name in batch.get_stream_names(args.columns):
+        file_name = get_stream_file_name(args.output_format, codec, stream_name)
+        with compression.open_decompressed(codec.name, os.path.join(a_expected_directory, file_name)) as expected, \
+                compression.open_decompressed(codec.name, os.path.join(a_directory, file_name)) as actual:
+            offset = 0
+            count_lines = 0
+            while True:
+                expected_chunk = expected.read(compression.CHUNK_SIZE)
+                actual_chunk = actual.read(compression.CHUNK_SIZE)
+                if expected_chunk != actual_chunk:
+                    position = 0
+                    while position < min(len(expected_chunk), len(actual_chunk)) and \
+                            expected_chunk[position] == actual_chunk[position]:
+                        position += 1
+                    return "{}: first difference at byte {} (line {})".format(
+                        file_name, offset + position, count_lines + expected_chunk.count(b"\n", 0, position) + 1)
+                if len(expected_chunk) == 0:
+                    break
+                offset += len(expected_chunk)
+                count_lines += expected_chunk.count(b"\n")
+    return None
+
+
+def verify_pushdown(
+        a_client,
+        args,
+        a_instrument,
+        a_instrument_date,
+        a_block_info,
+        a_column_layout,
+        a_directory
+):
+    # dumps the block again with the client side sort and deduplication and compares both outputs. Both keep the row
+    # with the smallest order column of every eventTime, so they only differ if one of them is wrong.
+    quiet_print(args.quiet, "Verifying pushdown output against the client side path...")
+    verify_folder_path = create_folders(args.root_folder_path, a_instrument,
+                                        manifest.get_verify_folder_name(a_instrument_date))
+    purge_folder(args.quiet, verify_folder_path)
+
+    client_side_args = copy.copy(args)
+    client_side_args.pushdown = 0
+    client_side_args.telemetry_path = None
+    try:
+        dump_block(a_client, client_side_args, a_instrument, a_instrument_date, a_block_info, a_column_layout,
+                   verify_folder_path, telemetry.BlockStats(a_instrument, a_instrument_date))
+        if args.output_format not in STREAM_OUTPUT_FORMATS:
+            import arrow_sink
+
+            difference = arrow_sink.compare_outputs(args.output_format, verify_folder_path, a_directory)
+        else:
+            difference = compare_text_outputs(args, verify_folder_path, a_directory)
+    finally:
+        shutil.rmtree(verify_folder_path, ignore_errors=True)
+
+    if difference is not None:
+        raise RuntimeError("Pushdown output differs from the client side output: {}".format(difference))
+    quiet_print(args.quiet, "Pushdown output verified!\n")
 
 
 def process_block(
         a_client,
         args,
         a_instrument,
-        a_instrument_date
+        a_instrument_date,
+        a_block_info=None
 ):
     quiet_print(args.quiet, "==================================================")
     quiet_print(args.quiet, "Instrument: {0:20} Date: {1:10}".format(a_instrument, a_instrument_date))
     quiet_print(args.quiet, "==================================================\n")
     process_block_start_time = time.time()
+    block_stats = telemetry.BlockStats(a_instrument, a_instrument_date)
+    column_layout = retry.call_with_retry(args, "table schema", lambda: get_column_layout(
+        a_client, args.database, args.table, args.columns))
+    args = retry.call_with_retry(args, "table schema", lambda: get_order_column_args(a_client, args))
+    block_folder_path = manifest.get_block_folder(args.root_folder_path, a_instrument, a_instrument_date)
+
+    block_manifest = manifest.read_manifest(block_folder_path) if args.incremental else None
+    if manifest.can_append(block_folder_path, block_manifest, get_output_file_names(args)):
+        append_block(a_client, args, a_instrument, a_instrument_date, column_layout, block_folder_path, block_manifest,
+                     block_stats)
+    else:
+        if args.incremental:
+            quiet_print(args.quiet, "No complete dump to append to, dumping the whole block\n")
+        dump_whole_block(a_client, args, a_instrument, a_instrument_date, a_block_info, column_layout,
+                         block_folder_path, block_stats)
+
+    process_block_end_time = time.time()
+    quiet_print(args.quiet, "==================================================")
+    quiet_print(args.quiet,
+                "Total block processing time: {0:0.3f} s".format(process_block_end_time - process_block_start_time))
+    quiet_print(args.quiet, "==================================================\n")
+
+    block_stats.finish()
+    telemetry.emit(args.telemetry_path, block_stats.to_record())
+    return block_stats
 
-    content_folder_path = create_folders(args.root_folder_path, a_instrument, a_instrument_date)
-    quiet_print(args.quiet, "Content folder path: {}\n".format(content_folder_path))
 
-    block_info = get_block_info(
+def dump_whole_block(
         a_client,
-        args.database,
-        args.table,
-        args.is_snapshot,
+        args,
         a_instrument,
-        a_instrument_date
-    )
+        a_instrument_date,
+        a_block_info,
+        a_column_layout,
+        a_block_folder_path,
+        a_block_stats
+):
+    # the block is written to a temporary folder and only moved to its final place once complete (see manifest.py)
+    content_folder_path = create_folders(args.root_folder_path, a_instrument,
+                                         manifest.get_temp_folder_name(a_instrument_date))
+    quiet_print(args.quiet, "Content folder path: {}\n".format(content_folder_path))
 
-    quiet_print(args.quiet, "Block info:\n{}\n".format(block_info))
+    # normally planned for all blocks at once by get_blocks_plan, only fetched here for a standalone block
+    block_info = a_block_info
+    if block_info is None:
+        block_info = retry.call_with_retry(args, "block info", lambda: get_block_info(
+            a_client,
+            args.database,
+            args.table,
+            args.is_snapshot,
+            a_instrument,
+            a_instrument_date
+        ))
 
-    intervals = block_info.get_intervals(args.intended_batch_size)
+    quiet_print(args.quiet, "Block info:\n{}\n".format(block_info))
 
     quiet_print(args.quiet, "Purging folder contents: {}".format(content_folder_path))
-    purge_folder(args, content_folder_path)
+    purge_folder(args.quiet, content_folder_path)
     quiet_print(args.quiet, "Folder purged!\n")
+    manifest.mark_in_progress(content_folder_path, a_instrument, a_instrument_date)
 
-    buffered_file_writer_set = BufferedFileWriterSet(args, content_folder_path)
+    last_event_time = dump_block(a_client, args, a_instrument, a_instrument_date, block_info, a_column_layout,
+                                 content_folder_path, a_block_stats)
+    if args.pushdown and args.verify_pushdown:
+        verify_pushdown(a_client, args, a_instrument, a_instrument_date, block_info, a_column_layout,
+                        content_folder_path)
 
-    quiet_print(args.quiet, "Dumping {} batches to files:".format(len(intervals)))
-    quiet_print(args.quiet, "------------------------------------")
+    stream_names = batch.get_stream_names(args.columns)
+    manifest.commit_block(content_folder_path, a_block_folder_path, a_instrument, a_instrument_date,
+                          a_block_stats.rows_written, last_event_time, stream_names,
+                          [name for name, is_array in zip(stream_names[1:], a_column_layout) if is_array])
+    quiet_print(args.quiet, "Block committed to: {}\n".format(a_block_folder_path))
 
-    last_event_time = 0
 
-    for i in range(len(intervals)):
-        quiet_print(args.quiet,
-                    "Getting batch {} of {} (Instrument: {} Date: {})".format(i + 1, len(intervals), a_instrument,
-                                                                              a_instrument_date))
-        while True:
-            try:
-                batch_query = get_batch(
+def append_block(
+        a_client,
+        args,
+        a_instrument,
+        a_instrument_date,
+        a_column_layout,
+        a_block_folder_path,
+        a_block_manifest,
+        a_block_stats
+):
+    # only the rows after the last eventTime of the dump are fetched and appended to its files in place, as new gzip
+    # members / zstd or lz4 frames for text and as a new part file for parquet and arrow
+    last_event_time = a_block_manifest["last_event_time"]
+    block_info = retry.call_with_retry(args, "block info", lambda: get_block_info(
+        a_client,
+        args.database,
+        args.table,
+        args.is_snapshot,
+        a_instrument,
+        a_instrument_date,
+        last_event_time + 1
+    ))
+    quiet_print(args.quiet, "Appending rows after eventTime {} to: {}".format(last_event_time, a_block_folder_path))
+    quiet_print(args.quiet, "Block info:\n{}\n".format(block_info))
+    if block_info.count_rows == 0 and a_block_manifest["status"] == "complete":
+        quiet_print(args.quiet, "No new rows!\n")
+        return
+
+    manifest.begin_append(a_block_folder_path, a_block_manifest)
+    last_event_time = dump_block(a_client, args, a_instrument, a_instrument_date, block_info, a_column_layout,
+                                 a_block_folder_path, a_block_stats, last_event_time, True)
+    manifest.commit_append(a_block_folder_path, a_block_manifest, a_block_stats.rows_written, last_event_time)
+    quiet_print(args.quiet, "Appended {} rows to: {}\n".format(a_block_stats.rows_written, a_block_folder_path))
+
+
+class BatchWriter:
+    # The transform and write stages of a text (or delta) dump. transform() carries last_event_time from batch to batch,
+    # so batches must reach it in order; write() only appends already formatted text to the files. The delta format is
+    # encoded a chunk at a time by its writers, transform() only hands them the columns.
+    def __init__(self, args, a_column_layout, a_buffered_file_writer_set, a_sort, a_block_stats, a_last_event_time=0):
+        self.quiet = args.quiet
+        self.output_format = args.output_format
+        self.column_layout = a_column_layout
+        self.telemetry_path = args.telemetry_path
+        self.buffered_file_writer_set = a_buffered_file_writer_set
+        self.sort = a_sort
+        self.order_column = args.order_column
+        self.block_stats = a_block_stats
+        self.last_event_time = a_last_event_time
+
+    def transform(self, a_fetched_batch):
+        columns, batch_stats = a_fetched_batch
+
+        build_start_time = time.time()
+        rows = batch.Batch.from_columns(columns, self.column_layout)
+        sort_start_time = time.time()
+        if self.sort:
+            # the last column is the order column, selected by get_batch when the client sorts
+            rows = rows.sorted(np.asarray(columns[-1]) if self.order_column is not None else None)
+        format_start_time = time.time()
+        deduplicated_rows = rows.deduplicated(self.last_event_time)
+        self.last_event_time = rows.last_event_time(self.last_event_time)
+        if self.output_format == "delta":
+            streams = deduplicated_rows.get_stream_columns()
+        else:
+            streams = deduplicated_rows.format_streams()
+        format_end_time = time.time()
+
+        batch_stats.rows_in = len(rows)
+        batch_stats.rows_written = len(deduplicated_rows)
+        batch_stats.build_time = sort_start_time - build_start_time
+        batch_stats.sort_time = format_start_time - sort_start_time
+        batch_stats.format_time = format_end_time - format_start_time
+        return [deduplicated_rows.event_times, streams, batch_stats]
+
+    def write(self, a_transformed_batch):
+        event_times, streams, batch_stats = a_transformed_batch
+        write_start_time = time.time()
+        batch.write_streams(self.buffered_file_writer_set, event_times, streams)
+        batch_stats.write_time = time.time() - write_start_time
+
+        self.block_stats.add_batch(batch_stats)
+        telemetry.emit(self.telemetry_path, batch_stats.to_record(self.block_stats))
+        quiet_print(self.quiet, "\tBatch {0}: fetch: {1:0.3f} s, processing: {2:0.3f} s, write: {3:0.3f} s "
+                                "(got: {4} rows, wrote: {5} rows)".format(batch_stats.batch_id + 1,
+                                                                          batch_stats.fetch_time,
+                                                                          batch_stats.build_time +
+                                                                          batch_stats.sort_time +
+                                                                          batch_stats.format_time,
+                                                                          batch_stats.write_time,
+                                                                          batch_stats.rows_in,
+                                                                          batch_stats.rows_written))
+        return batch_stats.rows_written
+
+
+def fetch_interval_batches(
+        a_client,
+        args,
+        a_instrument,
+        a_instrument_date,
+        a_intervals
+):
+    # a_intervals: a batch_sizing interval source. A batch that comes back at MAX_BUFFER_LIMIT rows may be truncated,
+    # so it is dropped and its interval fetched again in smaller parts.
+    count_batches = 0
+    while not a_intervals.done():
+        interval = a_intervals.next_interval()
+        quiet_print(args.quiet, "Getting batch {}{} (Instrument: {} Date: {})".format(
+            count_batches + 1, " of {}".format(a_intervals.count_batches) if a_intervals.count_batches else "",
+            a_instrument, a_instrument_date))
+        if len(interval) > 2:
+            quiet_print(args.quiet, "\tExpected rows: {}".format(interval[2]))
+        batch_stats = telemetry.BatchStats(count_batches)
+        fetch_start_time = time.time()
+        batch_query = retry.call_with_retry(
+            args, "batch [{}, {}]".format(interval[0], interval[1]),
+            lambda: get_batch(a_client, args.database, args.table, args.is_snapshot, a_instrument, a_instrument_date,
+                              interval[0], interval[1], args.columns, args.pushdown, args.query_timeout,
+                              args.order_column))
+        batch_stats.fetch_time = time.time() - fetch_start_time
+        if "result_bytes" in batch_query.summary:
+            batch_stats.bytes_received = int(batch_query.summary["result_bytes"])
+        columns = batch_query.result_columns
+        count_rows = len(columns[0]) if len(columns) > 0 else 0
+
+        if count_rows >= MAX_BUFFER_LIMIT:
+            quiet_print(args.quiet, "\tBuffer limit reached, splitting the interval [{}, {}]".format(interval[0],
+                                                                                                   interval[1]))
+            a_intervals.on_overflow(interval)
+            continue
+        a_intervals.on_batch(interval, count_rows, batch_stats.bytes_received, batch_stats.fetch_time)
+        count_batches += 1
+        yield [columns, batch_stats]
+
+
+def fetch_stream_blocks(
+        a_client,
+        args,
+        a_instrument,
+        a_instrument_date,
+        a_event_time_min=0
+):
+    # The server returns rows ordered by eventTime, so if the connection drops mid-block, the stream can be
+    # reopened from the last eventTime handed out: rows with that eventTime are dropped again by deduplication.
+    last_event_time = a_event_time_min
+    count_blocks = 0
+    retrier = retry.Retrier(args, "stream of {} {}".format(a_instrument, a_instrument_date))
+    while True:
+        retrier.before_attempt()
+        try:
+            fetch_start_time = time.time()
+            with get_block_stream(
                     a_client,
                     args.database,
                     args.table,
                     args.is_snapshot,
                     a_instrument,
                     a_instrument_date,
-                    intervals[i][0],
-                    intervals[i][1]
-                )
-            except Exception as e:
-                quiet_print(args.quiet, "Exception: {}".format(e))
-                quiet_print(args.quiet, "Retrying...")
-                continue
-            break
-        quiet_print(args.quiet, "Processing batch...")
-        processing_start_time = time.time()
+                    last_event_time,
+                    args.intended_batch_size,
+                    args.columns,
+                    args.pushdown,
+                    args.order_column
+            ) as stream:
+                for block in stream:
+                    if len(block) == 0 or len(block[0]) == 0:
+                        continue
+                    retrier.on_success()
+                    batch_stats = telemetry.BatchStats(count_blocks)
+                    batch_stats.fetch_time = time.time() - fetch_start_time
+                    count_blocks += 1
+                    yield [block, batch_stats]
+                    last_event_time = block[0][-1]
+                    fetch_start_time = time.time()
+        except Exception as e:
+            retrier.on_failure(e)
+            quiet_print(args.quiet, "Reopening stream from eventTime {}...".format(last_event_time))
+            continue
+        break
 
-        rows = []
-        for row in batch_query.result_rows:
-            rows.append(Row(row[5], row[8], row[9], row[10], row[11]))
-        rows.sort()
 
-        count_row_written = 0
+def dump_block_intervals(
+        a_client,
+        args,
+        a_instrument,
+        a_instrument_date,
+        a_block_info,
+        a_column_layout,
+        a_buffered_file_writer_set,
+        a_block_stats,
+        a_last_event_time=0,
+        a_append=False
+):
+    # as for streaming, an appended block never fetches the rows up to the end of the output again
+    event_time_min = a_last_event_time + 1 if a_append else None
+    if args.batch_planner == "adaptive":
+        intervals = batch_sizing.AdaptiveIntervals(a_block_info, args.intended_batch_size, MAX_BUFFER_LIMIT,
+                                                   event_time_min)
+        quiet_print(args.quiet, "Dumping adaptively sized batches to files:")
+    else:
+        if a_block_info.count_rows == 0:
+            planned_intervals = []
+        elif args.batch_planner == "histogram":
+            planned_intervals = retry.call_with_retry(args, "batch plan", lambda: get_balanced_intervals(
+                a_client, args.database, args.table, args.is_snapshot, a_instrument, a_instrument_date, a_block_info,
+                args.intended_batch_size))
+        else:
+            planned_intervals = a_block_info.get_intervals(args.intended_batch_size)
+        intervals = batch_sizing.PlannedIntervals(planned_intervals, event_time_min)
+        quiet_print(args.quiet, "Dumping {} batches to files:".format(intervals.count_batches))
+    quiet_print(args.quiet, "------------------------------------")
 
-        for row in rows:
-            count_row_written += row.write_to_files_deduplicated(last_event_time, buffered_file_writer_set)
-            last_event_time = row.event_time
+    # the intervals are disjoint, so rows ordered and deduplicated by the server need no more work across batches
+    batch_writer = BatchWriter(args, a_column_layout, a_buffered_file_writer_set, not args.pushdown, a_block_stats,
+                               a_last_event_time)
+    pipeline.run_pipeline(
+        fetch_interval_batches(a_client, args, a_instrument, a_instrument_date, intervals),
+        [batch_writer.transform, batch_writer.write],
+        args.pipelined
+    )
 
-        processing_end_time = time.time()
-        quiet_print(args.quiet, "\tBatch processing time: {0:0.3f} s (wrote: {1} rows)".format(
-            processing_end_time - processing_start_time,
-            count_row_written))
-        quiet_print(args.quiet, "------------------------------------")
+    quiet_print(args.quiet, "------------------------------------")
+    return batch_writer.last_event_time
 
-    process_block_end_time = time.time()
-    quiet_print(args.quiet, "==================================================")
-    quiet_print(args.quiet,
-                "Total block processing time: {0:0.3f} s".format(process_block_end_time - process_block_start_time))
-    quiet_print(args.quiet, "==================================================\n")
+
+def dump_block_streaming(
+        a_client,
+        args,
+        a_instrument,
+        a_instrument_date,
+        a_block_info,
+        a_column_layout,
+        a_buffered_file_writer_set,
+        a_block_stats,
+        a_last_event_time=0,
+        a_append=False
+):
+    quiet_print(args.quiet, "Streaming block to files (block size: {} rows, expected rows: {}):".format(
+        args.intended_batch_size, a_block_info.count_rows))
+    quiet_print(args.quiet, "------------------------------------")
+
+    # already ordered by the server, no need to sort
+    batch_writer = BatchWriter(args, a_column_layout, a_buffered_file_writer_set, False, a_block_stats,
+                               a_last_event_time)
+    # an appended block only has to stream the rows after the output, whatever the block info says: after an
+    # interrupted append without new rows it comes back empty, with a min_event_time of 0
+    pipeline.run_pipeline(
+        fetch_stream_blocks(a_client, args, a_instrument, a_instrument_date,
+                            max(a_last_event_time + 1, a_block_info.min_event_time) if a_append else 0),
+        [batch_writer.transform, batch_writer.write],
+        args.pipelined
+    )
+
+    quiet_print(args.quiet, "------------------------------------")
+    quiet_print(args.quiet, "Streamed {} blocks (wrote: {} rows)".format(a_block_stats.count_batches,
+                                                                       a_block_stats.rows_written))
+    return batch_writer.last_event_time